@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк сервера мессенджера
+Сравнивает режимы threaded и asyncio при 100, 1000 и 5000 одновременных подключениях,
+а с --workers - масштабирование режима sharded по числу процессов
+
+Пример:
+    python messenger_bench.py --connections 100 1000 5000 --rounds 20
+    python messenger_bench.py --workers 1 2 4 8 --connections 1000 --active 100
+
+Каждое подключение держится открытым (поток или задача на сервере),
+а --active из них входят в чат и обмениваются сообщениями по кругу.
+Остальные в чат не входят: прогон измеряет цену открытого подключения
+(память, потоки) и задержку сообщений между активными клиентами.
+Активные клиенты входят с поддержкой дельт присутствия: вошедший получает
+полный список один раз, а остальным сервер рассылает только дельты presence,
+склеивая входы за --presence-delay. Обмен начинается, когда последний
+вошедший видит в своем списке всех активных.
+"""
+
+import argparse
+import asyncio
+import json
+import shlex
+import time
+
+from messenger_loadgen import (LoadClient, free_port, percentile, process_stats,
+                               raise_fd_limit, start_server, stop_server)
+
+
+async def open_idle(host, port, count, concurrency=200):
+    """Открытие подключений, которые не входят в чат"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            return await asyncio.open_connection(host, port)
+
+    results = await asyncio.gather(*(one() for _ in range(count)), return_exceptions=True)
+    writers = [r[1] for r in results if not isinstance(r, BaseException)]
+    failed = sum(1 for r in results if isinstance(r, BaseException))
+    return writers, failed
+
+
+async def run_active(host, port, active, rounds):
+    """Обмен сообщениями между активными клиентами; возвращает задержки в секундах"""
+    latencies = []
+    clients = [LoadClient(f'bench{i}', latencies) for i in range(active)]
+    for client in clients:
+        await client.connect(host, port)
+        await client.join()
+    # Ждем, пока последний вошедший увидит всех
+    while True:
+        message = await clients[-1].queue.get()
+        if message['type'] == 'user_list' and len(message['users']) >= active:
+            break
+
+    async def sender(client):
+        for seq in range(rounds):
+            sent_at = time.perf_counter()
+            client.send({'type': 'message', 'text': f'bench {client.username} {seq} {sent_at!r}'})
+            # Замкнутый цикл: ждем собственное эхо перед следующей отправкой
+            while True:
+                message = await client.queue.get()
+                if (message['type'] == 'message' and message['username'] == client.username
+                        and message['text'].split()[2] == str(seq)):
+                    break
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(client) for client in clients))
+    elapsed = time.perf_counter() - started
+    for client in clients:
+        await client.close()
+    return latencies, elapsed
+
+
+async def run_scenario(mode, connections, active, rounds, server_args=()):
+    """Один прогон: сервер в режиме mode под connections подключениями"""
+    port = free_port()
+    # Подключения без входа держатся весь прогон: отключение по простою выключаем
+    proc = start_server(mode, port, ['--idle-timeout', '0', *server_args])
+    try:
+        started = time.perf_counter()
+        writers, failed = await open_idle('127.0.0.1', port, max(0, connections - active))
+        connect_time = time.perf_counter() - started
+        await asyncio.sleep(0.5)
+        idle_stats = process_stats(proc.pid)
+
+        latencies, elapsed = await run_active('127.0.0.1', port, active, rounds)
+        latencies.sort()
+
+        for writer in writers:
+            writer.close()
+        return {
+            'mode': mode,
+            'server_args': ' '.join(server_args),
+            'connections': connections,
+            'failed_connections': failed,
+            'connect_seconds': round(connect_time, 3),
+            'server_rss_kb': idle_stats['rss_kb'],
+            'server_threads': idle_stats['threads'],
+            'delivered': len(latencies),
+            'throughput_msg_s': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'latency_p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        }
+    finally:
+        stop_server(proc)
+
+
+def print_table(results):
+    """Вывод результатов таблицей"""
+    columns = ['mode', 'server_args', 'connections', 'failed_connections', 'connect_seconds', 'server_rss_kb',
+               'server_threads', 'throughput_msg_s', 'latency_p50_ms', 'latency_p99_ms']
+    print(' | '.join(columns))
+    for row in results:
+        print(' | '.join(str(row[c]) for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк режимов сервера мессенджера')
+    parser.add_argument('--modes', nargs='+', default=['threaded', 'asyncio'])
+    parser.add_argument('--workers', nargs='+', type=int,
+                        help='проверить режим sharded с указанным числом процессов')
+    parser.add_argument('--connections', nargs='+', type=int, default=[100, 1000, 5000])
+    parser.add_argument('--active', type=int, default=20, help='клиентов, обменивающихся сообщениями')
+    parser.add_argument('--rounds', type=int, default=20, help='сообщений от каждого активного клиента')
+    parser.add_argument('--server-args', default='',
+                        help='дополнительные аргументы сервера, например "--flush-window 0.002"')
+    parser.add_argument('--json', help='файл для сохранения результатов')
+    args = parser.parse_args(argv)
+
+    limit = raise_fd_limit()
+    # Каждое подключение занимает дескриптор и у клиента, и у сервера
+    if 2 * max(args.connections) + 64 > limit:
+        print(f"[БЕНЧМАРК] Внимание: лимит открытых файлов {limit} мал для {max(args.connections)} подключений")
+
+    server_args = shlex.split(args.server_args)
+    if args.workers:
+        scenarios = [('sharded', server_args + ['--workers', str(n)]) for n in args.workers]
+    else:
+        scenarios = [(mode, server_args) for mode in args.modes]
+
+    results = []
+    for connections in args.connections:
+        for mode, extra in scenarios:
+            print(f"[БЕНЧМАРК] {mode} {' '.join(extra)}, {connections} подключений...")
+            results.append(asyncio.run(run_scenario(mode, connections, args.active, args.rounds,
+                                                    extra)))
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
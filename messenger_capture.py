@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Запись входящего трафика сервера для воспроизведения
+Сервер с --capture пишет, кто и когда подключился, вошел, что отправил и когда
+отключился, - без содержимого: имена и комнаты заменены псевдонимами, от
+текста остается только длина. По такой записи messenger_replay.py воспроизводит
+настоящую форму нагрузки (утренняя волна входов, рассылка объявления).
+
+Обработчик клиента только кладет событие в буфер; псевдонимы и запись в
+сжатый файл - в фоновом потоке, как у журнала событий.
+
+Формат: gzip, первая строка - заголовок JSON, дальше по строке на событие:
+[время_мкс, тип, номер_соединения, аргументы...]. Время - от начала записи
+по монотонным часам; строки идут почти по порядку, читатель их сортирует.
+
+    [t, "connect", c]
+    [t, "join", c, имя, {кодировки и возможности клиента}]
+    [t, "message", c, длина]
+    [t, "private", c, получатель, длина]
+    [t, "room_join" | "room_leave", c, комната]
+    [t, "room_message", c, комната, длина]
+    [t, "user_list" | "leave", c]
+    [t, "disconnect", c]
+"""
+
+import gzip
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+from collections import deque
+
+from messenger_log import log
+
+CAPTURE_VERSION = 1
+# Как часто фоновый поток пишет накопившееся, сек
+FLUSH_INTERVAL = 0.1
+# Событий в буфере, после которых новые отбрасываются
+BUFFER_SIZE = 1000000
+# Ключ псевдонимов: общий для процессов sharded (создан до fork), свой у каждого запуска
+KEY = secrets.token_bytes(16)
+# Поля join, которые влияют на работу сервера с клиентом
+JOIN_OPTIONS = ('encodings', 'compress', 'presence', 'heartbeat')
+# Сообщения клиента без аргументов, которые тоже воспроизводятся
+PLAIN_TYPES = frozenset(('user_list', 'leave'))
+
+
+def alias(prefix, name):
+    """Псевдоним имени: по нему нельзя восстановить имя, но одно имя - один псевдоним"""
+    digest = hmac.new(KEY, name.encode('utf-8'), hashlib.sha256).hexdigest()
+    return prefix + digest[:10]
+
+
+class TrafficCapture:
+    """Буфер входящих событий и поток, который пишет их в файл"""
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.monotonic()
+        self.records = deque()
+        self.dropped = 0
+        self.connections = {}   # {соединение: номер} после join
+        self.accepted = {}      # {соединение: время подключения} до join
+        self.aliases = {}
+        self.next_id = 0
+        self.file = gzip.open(path, 'wb')
+        header = {'capture': CAPTURE_VERSION, 'clock': self.started,
+                  'started': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.file.write(json.dumps(header).encode('utf-8') + b'\n')
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def connect(self, client):
+        """Новое соединение"""
+        self.append((time.monotonic(), 'connect', client, None))
+
+    def message(self, client, message):
+        """Сообщение клиента, как оно пришло, до обработки"""
+        self.append((time.monotonic(), 'message', client, message))
+
+    def disconnect(self, client):
+        """Соединение закрыто"""
+        self.append((time.monotonic(), 'disconnect', client, None))
+
+    def append(self, record):
+        """Событие в буфер; при отставании потока - пропуск, а не ожидание"""
+        if len(self.records) >= BUFFER_SIZE:
+            self.dropped += 1
+            return
+        self.records.append(record)
+
+    def run(self):
+        """Фоновый поток: запись накопившегося раз в FLUSH_INTERVAL"""
+        while not self.stopping.wait(FLUSH_INTERVAL):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """Запись всех накопившихся событий"""
+        records = self.records
+        lines = []
+        while records:
+            for event in self.convert(*records.popleft()):
+                lines.append(json.dumps(event, separators=(',', ':')).encode('utf-8') + b'\n')
+        if lines:
+            self.file.write(b''.join(lines))
+
+    def stamp(self, when):
+        """Время от начала записи, мкс"""
+        return int((when - self.started) * 1000000)
+
+    def name(self, prefix, name):
+        """Псевдоним с запоминанием: HMAC считается один раз на имя"""
+        key = (prefix, name)
+        result = self.aliases.get(key)
+        if result is None:
+            self.aliases[key] = result = alias(prefix, name)
+        return result
+
+    def convert(self, when, kind, client, message):
+        """Строки записи для события: пусто, если оно не записывается"""
+        if kind == 'connect':
+            # Соединения данных для файлов и брошенные до входа не нужны:
+            # подключение пишется вместе с join
+            self.accepted[client] = when
+            return ()
+        if kind == 'disconnect':
+            self.accepted.pop(client, None)
+            conn = self.connections.pop(client, None)
+            return () if conn is None else ([self.stamp(when), 'disconnect', conn],)
+
+        message_type = message.get('type')
+        if message_type == 'join':
+            conn = self.next_id
+            self.next_id += 1
+            self.connections[client] = conn
+            options = {key: message[key] for key in JOIN_OPTIONS if key in message}
+            accepted = self.accepted.pop(client, when)
+            return ([self.stamp(accepted), 'connect', conn],
+                    [self.stamp(when), 'join', conn,
+                     self.name('u', str(message.get('username'))), options])
+        conn = self.connections.get(client)
+        if conn is None:
+            return ()
+        event = [self.stamp(when), message_type, conn]
+        text = message.get('text')
+        text = text if isinstance(text, str) else ''
+        if message_type == 'message':
+            event.append(len(text))
+        elif message_type == 'private':
+            event += [self.name('u', str(message.get('target'))), len(text)]
+        elif message_type in ('room_join', 'room_leave'):
+            event.append(self.name('r', str(message.get('room'))))
+        elif message_type == 'room_message':
+            event += [self.name('r', str(message.get('room'))), len(text)]
+        elif message_type not in PLAIN_TYPES:
+            # ping, pong, поиск, файлы: на форму нагрузки почти не влияют
+            return ()
+        return (event,)
+
+    def close(self):
+        """Запись остатка и закрытие файла"""
+        self.stopping.set()
+        self.thread.join(timeout=5.0)
+        if self.dropped:
+            log.warning('ЗАХВАТ', 'Пропущено событий при перегрузке: %d', self.dropped)
+        self.file.close()
+        log.info('ЗАХВАТ', 'Трафик записан в %s', self.path)
+
+
+def read_capture(path):
+    """Заголовок и события записи по времени: (заголовок, [(сек, тип, соединение, аргументы)])"""
+    events = []
+    with gzip.open(path, 'rb') as f:
+        header = json.loads(f.readline())
+        if header.get('capture') != CAPTURE_VERSION:
+            raise ValueError(f'{path}: неизвестная версия записи {header.get("capture")}')
+        try:
+            for line in f:
+                stamp, kind, conn, *args = json.loads(line)
+                events.append((stamp / 1000000, kind, conn, args))
+        except EOFError:
+            # Сервер завершился аварийно: берем то, что успело записаться
+            pass
+    events.sort(key=lambda event: event[0])
+    return header, events
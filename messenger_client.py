@@ -4,20 +4,76 @@
 Запустите этот файл на каждом устройстве для подключения к серверу
 """
 
-import socket
+import argparse
+import asyncio
+import bisect
+import itertools
+import queue
 import threading
-import json
+from collections import deque
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
+from tkinter import ttk, filedialog, messagebox, scrolledtext
 from datetime import datetime
 
+from messenger_client_core import (CONNECT_TIMEOUT, IDLE_TIMEOUT, PING_INTERVAL, ChatClient,
+                                   JoinRejected)
+from messenger_files import format_size
+
+GENERAL_CHAT = "Общий чат"
+# Сколько строк хранить в каждой комнате и в окне чата
+SCROLLBACK = 2000
+# Период разбора входящих событий в потоке интерфейса, мс
+UI_INTERVAL = 50
+# Максимум событий за один проход, чтобы интерфейс не замирал
+UI_BATCH = 1000
+# Больше изменений списка пользователей за проход - перерисовываем его целиком
+USERS_REBUILD = 200
+# Сколько имен из одной дельты присутствия показывать в чате поименно
+PRESENCE_NOTICES = 10
+# Задержка применения фильтра пользователей после ввода, мс
+FILTER_DELAY = 150
+
 class MessengerClient:
-    def __init__(self):
-        self.client = None
+    def __init__(self, scrollback=SCROLLBACK, ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 connect_timeout=CONNECT_TIMEOUT):
+        self.core = None   # ChatClient - сетевая часть без интерфейса
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.loop = None   # цикл событий сети в фоновом потоке
         self.username = None
         self.connected = False
+        self.connecting = None    # подключение, которое еще идет в потоке сети
         self.active_users = []
         
+        # Комнаты: сообщения каждой комнаты и непрочитанные
+        self.scrollback = scrollback
+        self.current_room = GENERAL_CHAT
+        self.room_messages = {GENERAL_CHAT: deque(maxlen=scrollback)}
+        self.unread = {}
+        
+        # Сеть кладет события в очередь, интерфейс разбирает ее по таймеру
+        self.events = queue.SimpleQueue()
+        self.pending_lines = []   # строки текущей комнаты, еще не выведенные в окно
+        self.rooms_dirty = False
+        
+        # Пользователи онлайн: отсортированный список и дельты для окна
+        self.users = []
+        self.user_set = set()
+        self.presence_seq = None
+        self.visible_users = []   # то, что сейчас показано в списке (с учетом фильтра)
+        self.user_filter = ''
+        self.filter_job = None
+        self.users_ops = []       # изменения списка, еще не выведенные в окно
+        self.users_rebuild = False
+        
+        # Передачи файлов: предложенные нами, ожидающие согласия, и идущие сейчас
+        self.file_refs = itertools.count(1)
+        self.offered = {}         # {ref: путь} - до ответа сервера с id
+        self.outgoing = {}        # {id: путь} - ждут согласия получателя
+        self.transfers = {}       # {id: (подпись, передано, размер)}
+        self.transfers_dirty = False
+        
         # Создаем главное окно
         self.root = tk.Tk()
         self.root.title("Мессенджер")
@@ -88,25 +144,27 @@ class MessengerClient:
         self.port_entry.insert(0, "5555")
         
         # Кнопка подключения
-        connect_btn = tk.Button(main_frame, text="ПОДКЛЮЧИТЬСЯ", 
-                               font=("Arial", 12, "bold"),
-                               bg='#4CAF50', fg='white',
-                               command=self.connect_to_server,
-                               cursor="hand2")
-        connect_btn.grid(row=4, column=0, columnspan=2, pady=20)
+        self.connect_btn = tk.Button(main_frame, text="ПОДКЛЮЧИТЬСЯ", 
+                                     font=("Arial", 12, "bold"),
+                                     bg='#4CAF50', fg='white',
+                                     command=self.connect_to_server,
+                                     cursor="hand2")
+        self.connect_btn.grid(row=4, column=0, columnspan=2, pady=20)
         
         # Информация
-        info_text = "Для подключения к серверу в локальной сети\nиспользуйте IP адрес компьютера с сервером"
-        info_label = tk.Label(main_frame, text=info_text,
-                             font=("Arial", 10),
-                             bg='#2b2b2b', fg='#888888')
-        info_label.grid(row=5, column=0, columnspan=2, pady=10)
+        self.info_text = "Для подключения к серверу в локальной сети\nиспользуйте IP адрес компьютера с сервером"
+        self.info_label = tk.Label(main_frame, text=self.info_text,
+                                   font=("Arial", 10),
+                                   bg='#2b2b2b', fg='#888888')
+        self.info_label.grid(row=5, column=0, columnspan=2, pady=10)
         
         # Bind Enter для подключения
         self.root.bind('<Return>', lambda e: self.connect_to_server())
     
     def connect_to_server(self):
-        """Подключение к серверу"""
+        """Подключение к серверу в потоке сети; окно не ждет ответа сервера"""
+        if self.connecting is not None:
+            return
         self.username = self.name_entry.get().strip()
         host = self.ip_entry.get().strip()
         port = self.port_entry.get().strip()
@@ -121,33 +179,67 @@ class MessengerClient:
             messagebox.showerror("Ошибка", "Неверный порт")
             return
         
+        # Подключаемся и входим в чат: имя и поддерживаемые кодировки
+        self.start_network()
+        self.core = ChatClient(self.username, ping_interval=self.ping_interval,
+                               idle_timeout=self.idle_timeout)
+        self.connecting = asyncio.run_coroutine_threadsafe(
+            self.core.connect(host, port, self.connect_timeout), self.loop)
+        self.connect_btn.config(state=tk.DISABLED)
+        self.info_label.config(text=f"Подключение к {host}:{port}...")
+        self.root.after(UI_INTERVAL, self.check_connection)
+    
+    def check_connection(self):
+        """Проверка по таймеру, чем закончилось подключение"""
+        future = self.connecting
+        if not future.done():
+            self.root.after(UI_INTERVAL, self.check_connection)
+            return
+        self.connecting = None
         try:
-            # Создаем соединение
-            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client.connect((host, port))
-            
-            # Отправляем имя пользователя
-            join_message = {
-                'type': 'join',
-                'username': self.username
-            }
-            self.client.send(json.dumps(join_message).encode('utf-8'))
-            
-            # Получаем подтверждение
-            response = self.client.recv(1024).decode('utf-8')
-            response = json.loads(response)
-            
-            if response['type'] == 'system':
-                self.connected = True
-                self.create_chat_screen()
-                
-                # Запускаем поток для получения сообщений
-                receive_thread = threading.Thread(target=self.receive_messages)
-                receive_thread.daemon = True
-                receive_thread.start()
-        
+            future.result()
         except Exception as e:
-            messagebox.showerror("Ошибка подключения", f"Не удалось подключиться к серверу:\n{str(e)}")
+            self.connect_btn.config(state=tk.NORMAL)
+            self.info_label.config(text=self.info_text)
+            if isinstance(e, asyncio.TimeoutError):
+                text = f"Сервер не ответил за {self.connect_timeout:.0f} с"
+            else:
+                text = str(e)
+            messagebox.showerror("Ошибка подключения", f"Не удалось подключиться к серверу:\n{text}")
+            return
+        
+        self.connected = True
+        self.create_chat_screen()
+        
+        # Получение сообщений - задача в цикле событий сети
+        asyncio.run_coroutine_threadsafe(self.receive_messages(), self.loop)
+    
+    def start_network(self):
+        """Запуск цикла событий сети в фоновом потоке (один на все время работы)"""
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            network_thread = threading.Thread(target=self.loop.run_forever)
+            network_thread.daemon = True
+            network_thread.start()
+    
+    def submit(self, coro):
+        """Отправка через ChatClient без ожидания в потоке интерфейса"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self.report_send)
+        return future
+    
+    def report_send(self, future):
+        """Сообщение об ошибке отправки или о том, что сообщение ждет связи"""
+        if future.cancelled() or not self.connected:
+            return
+        if future.exception() is not None:
+            self.post_system(f"Ошибка отправки сообщения: {future.exception()}")
+        elif future.result() is False:
+            self.post_system("Нет связи: сообщение будет отправлено после переподключения")
+    
+    def post_system(self, text):
+        """Системное сообщение из потока сети - через очередь событий"""
+        self.events.put({'type': 'system', 'message': text})
     
     def create_chat_screen(self):
         """Создание экрана чата"""
@@ -169,14 +261,55 @@ class MessengerClient:
                 font=("Arial", 12, "bold"),
                 bg='#2b2b2b', fg='#4CAF50').pack(pady=(0, 10))
         
+        # Поиск по списку пользователей
+        self.filter_var = tk.StringVar()
+        self.filter_var.trace_add('write', lambda *args: self.on_filter_change())
+        tk.Entry(left_panel, textvariable=self.filter_var,
+                 font=("Arial", 10),
+                 bg='#3a3a3a', fg='white', insertbackground='white').pack(fill=tk.X, pady=(0, 5))
+        
         # Список пользователей
         self.users_listbox = tk.Listbox(left_panel, 
                                         bg='#3a3a3a', fg='white',
                                         font=("Arial", 11),
                                         selectbackground='#4CAF50',
-                                        height=20)
+                                        height=12)
         self.users_listbox.pack(fill=tk.BOTH, expand=True)
         
+        # Переключатель комнат
+        tk.Label(left_panel, text="Комнаты",
+                font=("Arial", 12, "bold"),
+                bg='#2b2b2b', fg='#4CAF50').pack(pady=(10, 10))
+        
+        self.rooms_listbox = tk.Listbox(left_panel,
+                                        bg='#3a3a3a', fg='white',
+                                        font=("Arial", 11),
+                                        selectbackground='#4CAF50',
+                                        height=6,
+                                        exportselection=False)
+        self.rooms_listbox.pack(fill=tk.X)
+        self.rooms_listbox.bind('<<ListboxSelect>>', self.on_room_select)
+        
+        room_frame = tk.Frame(left_panel, bg='#2b2b2b')
+        room_frame.pack(fill=tk.X, pady=(5, 0))
+        
+        self.room_entry = tk.Entry(room_frame, font=("Arial", 11), width=12,
+                                   bg='#3a3a3a', fg='white', insertbackground='white')
+        self.room_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.room_entry.bind('<Return>', lambda e: self.join_room())
+        
+        tk.Button(room_frame, text="Войти",
+                  font=("Arial", 10),
+                  bg='#4a4a4a', fg='white',
+                  command=self.join_room,
+                  cursor="hand2").pack(side=tk.LEFT, padx=(5, 0))
+        
+        tk.Button(left_panel, text="Выйти из комнаты",
+                  font=("Arial", 10),
+                  bg='#4a4a4a', fg='white',
+                  command=self.leave_room,
+                  cursor="hand2").pack(fill=tk.X, pady=(5, 0))
+        
         # Правая панель (чат)
         right_panel = tk.Frame(main_frame, bg='#2b2b2b')
         right_panel.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
@@ -232,25 +365,99 @@ class MessengerClient:
                                cursor="hand2")
         private_btn.pack(side=tk.RIGHT, padx=(10, 0))
         
+        # Кнопка отправки файла выбранному пользователю
+        file_btn = tk.Button(input_frame, text="Файл",
+                             font=("Arial", 11),
+                             bg='#4a4a4a', fg='white',
+                             command=self.send_file,
+                             cursor="hand2")
+        file_btn.pack(side=tk.RIGHT, padx=(10, 0))
+        
+        # Ход передачи файлов; панель видна, только пока что-то передается
+        self.transfer_frame = tk.Frame(right_panel, bg='#2b2b2b')
+        self.transfer_label = tk.Label(self.transfer_frame, text="",
+                                       font=("Arial", 9),
+                                       bg='#2b2b2b', fg='#888888', anchor='w')
+        self.transfer_label.pack(fill=tk.X)
+        self.transfer_bar = ttk.Progressbar(self.transfer_frame, mode='determinate', maximum=100)
+        self.transfer_bar.pack(fill=tk.X)
+        
         # Bind Enter для отправки
         self.message_entry.bind('<Return>', lambda e: self.send_message())
         
         # Bind для закрытия окна
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
+        self.update_room_list()
+        
         # Фокус на поле ввода
         self.message_entry.focus()
+        
+        # Разбор входящих событий в потоке интерфейса
+        self.root.after(UI_INTERVAL, self.process_events)
+    
+    def join_room(self):
+        """Вход в комнату по названию из поля ввода"""
+        room = self.room_entry.get().strip()
+        if room and room != GENERAL_CHAT and self.connected:
+            try:
+                self.submit(self.core.join_room(room))
+                self.room_entry.delete(0, tk.END)
+            except:
+                self.add_message("Ошибка отправки сообщения", msg_type='system')
+    
+    def leave_room(self):
+        """Выход из текущей комнаты"""
+        if self.current_room != GENERAL_CHAT and self.connected:
+            try:
+                self.submit(self.core.leave_room(self.current_room))
+            except:
+                self.add_message("Ошибка отправки сообщения", msg_type='system')
+    
+    def on_room_select(self, event):
+        """Переключение комнаты кликом по списку"""
+        selection = self.rooms_listbox.curselection()
+        if selection:
+            rooms = list(self.room_messages)
+            self.switch_room(rooms[selection[0]])
+    
+    def switch_room(self, room):
+        """Показ сообщений выбранной комнаты"""
+        self.current_room = room
+        self.unread.pop(room, None)
+        self.chat_title.config(text=room)
+        # Невыведенные строки прошлой комнаты уже лежат в ее буфере
+        self.pending_lines = []
+        chunks = []
+        for text, msg_type in self.room_messages[room]:
+            chunks.extend((text + '\n', msg_type))
+        self.chat_area.config(state=tk.NORMAL)
+        self.chat_area.delete('1.0', tk.END)
+        if chunks:
+            self.chat_area.insert(tk.END, *chunks)
+        self.chat_area.config(state=tk.DISABLED)
+        self.chat_area.see(tk.END)
+        self.update_room_list()
+    
+    def update_room_list(self):
+        """Обновление списка комнат с числом непрочитанных"""
+        self.rooms_dirty = False
+        self.rooms_listbox.delete(0, tk.END)
+        for index, room in enumerate(self.room_messages):
+            unread = self.unread.get(room)
+            self.rooms_listbox.insert(tk.END, f"{room} ({unread})" if unread else room)
+            if room == self.current_room:
+                self.rooms_listbox.selection_set(index)
     
     def send_message(self):
         """Отправка сообщения"""
         text = self.message_entry.get().strip()
         if text and self.connected:
-            message = {
-                'type': 'message',
-                'text': text
-            }
             try:
-                self.client.send(json.dumps(message).encode('utf-8'))
+                if self.current_room != GENERAL_CHAT:
+                    self.submit(self.core.send_room(self.current_room, text))
+                else:
+                    self.submit(self.core.send_text(text))
                 self.message_entry.delete(0, tk.END)
             except:
                 self.add_message("Ошибка отправки сообщения", msg_type='system')
@@ -266,98 +473,393 @@ class MessengerClient:
         text = self.message_entry.get().strip()
         
         if text and self.connected:
-            message = {
-                'type': 'private',
-                'text': text,
-                'target': target
-            }
             try:
-                self.client.send(json.dumps(message).encode('utf-8'))
+                self.submit(self.core.send_private(target, text))
                 self.message_entry.delete(0, tk.END)
             except:
                 self.add_message("Ошибка отправки сообщения", msg_type='system')
     
-    def receive_messages(self):
-        """Получение сообщений от сервера"""
+    def send_file(self):
+        """Предложение файла выбранному пользователю"""
+        selection = self.users_listbox.curselection()
+        if not selection:
+            messagebox.showwarning("Внимание", "Выберите пользователя из списка")
+            return
+        target = self.users_listbox.get(selection[0])
+        path = filedialog.askopenfilename(title=f"Файл для {target}")
+        if not path or not self.connected:
+            return
+        # Сервер вернет копию предложения с тем же ref и id передачи
+        ref = str(next(self.file_refs))
+        self.offered[ref] = path
+        self.submit(self.core.offer_file(target, path, ref))
+    
+    def ask_file(self, offer):
+        """Вопрос получателю: принять файл и куда сохранить"""
+        name = offer['name']
+        path = None
+        if messagebox.askyesno("Файл", f"{offer['username']} отправляет файл {name} "
+                                       f"({format_size(offer['size'])}). Принять?"):
+            path = filedialog.asksaveasfilename(title="Сохранить файл", initialfile=name)
+        if not self.connected:
+            return
+        if not path:
+            self.submit(self.core.decline_file(offer['id']))
+            return
+        self.submit(self.core.accept_file(offer['id']))
+        # Скачивание идет, пока отправитель загружает: сервер отдает то, что уже пришло
+        self.submit(self.transfer_file(offer['id'], f"Получение {name}",
+                                       lambda progress: self.core.download(offer['id'], path,
+                                                                           progress),
+                                       f"Файл {name} сохранен: {path}"))
+    
+    async def transfer_file(self, file_id, label, start, done_text):
+        """Передача файла в потоке сети с выводом хода через очередь событий"""
+        last = [-1]
+        
+        def progress(sent, size):
+            # Событие - только при смене процента, а не на каждый кусок
+            percent = sent * 100 // size if size else 100
+            if percent != last[0]:
+                last[0] = percent
+                self.events.put({'type': 'file_progress', 'id': file_id, 'label': label,
+                                 'sent': sent, 'size': size})
+        
+        try:
+            await start(progress)
+            self.post_system(done_text)
+        except Exception as e:
+            self.post_system(f"{label}: ошибка - {e}")
+        self.events.put({'type': 'file_progress', 'id': file_id, 'label': label, 'sent': None})
+    
+    async def receive_messages(self):
+        """Получение сообщений от сервера; после обрыва - переподключение"""
         while self.connected:
             try:
-                data = self.client.recv(1024).decode('utf-8')
-                if not data:
-                    break
-                
-                message = json.loads(data)
-                
-                if message['type'] == 'message':
-                    # Обычное сообщение
-                    sender = message['username']
-                    text = message['text']
-                    timestamp = message.get('timestamp', '')
-                    
-                    if sender == self.username:
-                        self.add_message(f"[{timestamp}] Вы: {text}", msg_type='own')
-                    else:
-                        self.add_message(f"[{timestamp}] {sender}: {text}", msg_type='other')
-                
-                elif message['type'] == 'private':
-                    # Приватное сообщение
-                    sender = message['username']
-                    text = message['text']
-                    timestamp = message.get('timestamp', '')
-                    target = message.get('target', '')
-                    
-                    if sender == self.username:
-                        self.add_message(f"[{timestamp}] [Приватно для {target}] Вы: {text}", msg_type='private')
-                    else:
-                        self.add_message(f"[{timestamp}] [Приватно] {sender}: {text}", msg_type='private')
-                
-                elif message['type'] == 'system':
-                    # Системное сообщение
-                    self.add_message(message['message'], msg_type='system')
-                
-                elif message['type'] == 'user_joined':
-                    # Пользователь присоединился
-                    self.add_message(f"✓ {message['message']}", msg_type='system')
-                
-                elif message['type'] == 'user_left':
-                    # Пользователь покинул чат
-                    self.add_message(f"✗ {message['message']}", msg_type='system')
-                
-                elif message['type'] == 'user_list':
-                    # Обновление списка пользователей
-                    self.update_user_list(message['users'])
+                async for message in self.core:
+                    # Tk можно трогать только из его потока
+                    self.events.put(message)
             
             except Exception as e:
                 if self.connected:
-                    self.add_message(f"Ошибка: {str(e)}", msg_type='system')
+                    self.post_system(f"Ошибка: {str(e)}")
+            
+            if not self.connected:
+                break   # окно закрывается
+            if self.core.timed_out:
+                self.post_system(f"Сервер не отвечает {self.idle_timeout:.0f} с")
+                self.core.timed_out = False
+            self.post_system("Связь потеряна, переподключение...")
+            try:
+                await self.core.reconnect(timeout=self.connect_timeout)
+            except JoinRejected as e:
+                self.post_system(f"Не удалось войти снова: {e}")
                 break
+            if self.core.resumed:
+                self.post_system("Связь восстановлена")
+            else:
+                # Сессия не сохранилась: сервер пришлет список и историю заново,
+                # в комнаты ChatClient входит сам
+                self.post_system("Переподключено; часть сообщений могла потеряться")
+            if self.core.unsent:
+                self.post_system(f"Отправляются сообщения, набранные без связи: "
+                                 f"{len(self.core.unsent)}")
         
         # Отключение
         if self.connected:
             self.connected = False
-            self.add_message("Отключено от сервера", msg_type='system')
+            self.post_system("Отключено от сервера")
     
-    def add_message(self, text, msg_type='other'):
-        """Добавление сообщения в чат"""
-        self.chat_area.config(state=tk.NORMAL)
-        self.chat_area.insert(tk.END, text + '\n', msg_type)
-        self.chat_area.config(state=tk.DISABLED)
-        self.chat_area.see(tk.END)
+    def process_events(self):
+        """Разбор накопившихся событий пачкой и вывод их одной операцией"""
+        try:
+            for _ in range(UI_BATCH):
+                self.handle_message(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        self.flush_view()
+        self.root.after(UI_INTERVAL, self.process_events)
     
-    def update_user_list(self, users):
-        """Обновление списка пользователей"""
+    def flush_view(self):
+        """Вывод накопленных изменений в виджеты"""
+        if self.pending_lines:
+            # Одна вставка на всю пачку: текст1, тег1, текст2, тег2, ...
+            chunks = []
+            for text, msg_type in self.pending_lines:
+                chunks.extend((text + '\n', msg_type))
+            self.pending_lines = []
+            self.chat_area.config(state=tk.NORMAL)
+            self.chat_area.insert(tk.END, *chunks)
+            self.trim_chat_area()
+            self.chat_area.config(state=tk.DISABLED)
+            self.chat_area.see(tk.END)
+        if self.users_rebuild:
+            self.refresh_user_list()
+        elif self.users_ops:
+            self.apply_user_ops()
+        if self.rooms_dirty:
+            self.update_room_list()
+        if self.transfers_dirty:
+            self.update_transfers()
+    
+    def update_transfers(self):
+        """Панель хода передачи: первая из идущих и сколько еще в очереди"""
+        self.transfers_dirty = False
+        if not self.transfers:
+            self.transfer_frame.pack_forget()
+            return
+        label, sent, size = next(iter(self.transfers.values()))
+        text = f"{label}: {format_size(sent)} из {format_size(size)}"
+        if len(self.transfers) > 1:
+            text += f" (еще передач: {len(self.transfers) - 1})"
+        self.transfer_label.config(text=text)
+        self.transfer_bar['value'] = sent * 100 / size if size else 100
+        if not self.transfer_frame.winfo_ismapped():
+            self.transfer_frame.pack(fill=tk.X, pady=(5, 0))
+    
+    def trim_chat_area(self):
+        """Удаление старых строк окна чата сверх лимита прокрутки"""
+        lines = int(self.chat_area.index('end-1c').split('.')[0]) - 1
+        if lines > self.scrollback:
+            self.chat_area.delete('1.0', f'{lines - self.scrollback + 1}.0')
+    
+    def handle_message(self, message):
+        """Отображение одного сообщения от сервера"""
+        if message['type'] == 'message':
+            # Обычное сообщение
+            sender = message['username']
+            text = message['text']
+            timestamp = message.get('timestamp', '')
+            
+            if sender == self.username:
+                self.add_message(f"[{timestamp}] Вы: {text}", msg_type='own', room=GENERAL_CHAT)
+            else:
+                self.add_message(f"[{timestamp}] {sender}: {text}", msg_type='other', room=GENERAL_CHAT)
+        
+        elif message['type'] == 'private':
+            # Приватное сообщение
+            sender = message['username']
+            text = message['text']
+            timestamp = message.get('timestamp', '')
+            target = message.get('target', '')
+            
+            if sender == self.username:
+                self.add_message(f"[{timestamp}] [Приватно для {target}] Вы: {text}", msg_type='private')
+            else:
+                self.add_message(f"[{timestamp}] [Приватно] {sender}: {text}", msg_type='private')
+        
+        elif message['type'] == 'system':
+            # Системное сообщение
+            self.add_message(message['message'], msg_type='system')
+        
+        elif message['type'] == 'user_joined':
+            # Пользователь присоединился
+            self.add_message(f"✓ {message['message']}", msg_type='system', room=GENERAL_CHAT)
+        
+        elif message['type'] == 'user_left':
+            # Пользователь покинул чат
+            self.add_message(f"✗ {message['message']}", msg_type='system', room=GENERAL_CHAT)
+        
+        elif message['type'] == 'user_list':
+            # Полный список: при входе или по запросу после пропуска дельты
+            self.update_user_list(message['users'], message.get('seq'))
+        
+        elif message['type'] == 'presence':
+            # Дельта присутствия: кто вошел и кто вышел
+            self.apply_presence(message)
+        
+        elif message['type'] == 'room_message':
+            # Сообщение в комнате
+            sender = message['username']
+            text = message['text']
+            timestamp = message.get('timestamp', '')
+            
+            if sender == self.username:
+                self.add_message(f"[{timestamp}] Вы: {text}", msg_type='own', room=message['room'])
+            else:
+                self.add_message(f"[{timestamp}] {sender}: {text}", msg_type='other', room=message['room'])
+        
+        elif message['type'] == 'file_offer':
+            # Предложение файла: свое (копия с id передачи) или входящее
+            name = f"{message['name']} ({format_size(message['size'])})"
+            if message['username'] == self.username:
+                path = self.offered.pop(message.get('ref'), None)
+                if path is not None:
+                    self.outgoing[message['id']] = path
+                self.add_message(f"[Файл для {message['target']}] {name} - ждем согласия",
+                                 msg_type='private')
+            else:
+                self.add_message(f"[Файл] {message['username']}: {name}", msg_type='private')
+                # Диалог после вывода пачки, а не посреди разбора событий
+                self.root.after_idle(self.ask_file, message)
+        
+        elif message['type'] == 'file_accept':
+            # Получатель согласился: загружаем файл на сервер
+            path = self.outgoing.pop(message['id'], None)
+            if path is not None and message['username'] != self.username:
+                name = message['name']
+                self.add_message(f"{message['username']} принимает файл {name}", msg_type='system')
+                self.submit(self.transfer_file(message['id'], f"Отправка {name}",
+                                               lambda progress: self.core.upload(
+                                                   message['id'], path, progress),
+                                               f"Файл {name} отправлен"))
+        
+        elif message['type'] == 'file_decline':
+            if message['username'] != self.username:
+                self.outgoing.pop(message['id'], None)
+                self.add_message(f"{message['username']} отказался от файла {message['name']}",
+                                 msg_type='system')
+        
+        elif message['type'] == 'file_progress':
+            # Ход передачи из потока сети; sent=None - передача закончилась
+            if message['sent'] is None:
+                self.transfers.pop(message['id'], None)
+            else:
+                self.transfers[message['id']] = (message['label'], message['sent'], message['size'])
+            self.transfers_dirty = True
+        
+        elif message['type'] == 'room_joined':
+            # Вход в комнату: свой - открываем комнату, чужой - уведомление
+            room = message['room']
+            if message['username'] == self.username:
+                # Повторный вход после переподключения не переключает комнату
+                rejoined = room in self.room_messages
+                self.room_messages.setdefault(room, deque(maxlen=self.scrollback))
+                self.add_message(f"✓ {message['message']}", msg_type='system', room=room)
+                if not rejoined:
+                    self.switch_room(room)
+            else:
+                self.add_message(f"✓ {message['message']}", msg_type='system', room=room)
+        
+        elif message['type'] == 'room_left':
+            # Выход из комнаты
+            room = message['room']
+            if message['username'] == self.username:
+                self.room_messages.pop(room, None)
+                self.unread.pop(room, None)
+                if self.current_room == room:
+                    self.switch_room(GENERAL_CHAT)
+                else:
+                    self.update_room_list()
+            else:
+                self.add_message(f"✗ {message['message']}", msg_type='system', room=room)
+    
+    def add_message(self, text, msg_type='other', room=None):
+        """Добавление сообщения в чат комнаты (по умолчанию - текущей)
+
+        Окно обновляется в flush_view, один раз на пачку событий.
+        """
+        if room is None:
+            room = self.current_room
+        if room not in self.room_messages:
+            return
+        self.room_messages[room].append((text, msg_type))
+        if room != self.current_room:
+            self.unread[room] = self.unread.get(room, 0) + 1
+            self.rooms_dirty = True
+            return
+        self.pending_lines.append((text, msg_type))
+    
+    def update_user_list(self, users, seq=None):
+        """Замена всего списка пользователей; окно перерисуется в flush_view"""
+        self.user_set = set(users)
+        self.users = sorted(self.user_set)
+        self.presence_seq = seq
+        self.users_ops = []
+        self.users_rebuild = True
+    
+    def apply_presence(self, delta):
+        """Применение дельты присутствия к списку пользователей"""
+        seq = delta['seq']
+        if self.presence_seq is None or seq <= self.presence_seq:
+            # Дельта старше полного списка - в нем она уже учтена
+            return
+        if seq > self.presence_seq + 1 and self.connected:
+            # Пропущена дельта: просим полный список, а эту применяем как есть
+            self.submit(self.core.request_user_list())
+        self.presence_seq = seq
+        
+        joined = []
+        for name in delta['added']:
+            if name not in self.user_set:
+                self.user_set.add(name)
+                bisect.insort(self.users, name)
+                self.users_ops.append(('add', name))
+                joined.append(name)
+        left = []
+        for name in delta['removed']:
+            if name in self.user_set:
+                self.user_set.discard(name)
+                del self.users[bisect.bisect_left(self.users, name)]
+                self.users_ops.append(('remove', name))
+                left.append(name)
+        if len(self.users_ops) > USERS_REBUILD:
+            self.users_ops = []
+            self.users_rebuild = True
+        
+        self.presence_notices(joined, '✓', 'присоединился к чату', 'Присоединились')
+        self.presence_notices(left, '✗', 'покинул чат', 'Покинули чат')
+    
+    def presence_notices(self, names, mark, action, summary):
+        """Уведомления в общем чате: поименно или одной строкой для большой пачки"""
+        names = [name for name in names if name != self.username]
+        if len(names) > PRESENCE_NOTICES:
+            self.add_message(f"{mark} {summary} пользователей: {len(names)}",
+                             msg_type='system', room=GENERAL_CHAT)
+            return
+        for name in names:
+            self.add_message(f"{mark} {name} {action}", msg_type='system', room=GENERAL_CHAT)
+    
+    def user_visible(self, name):
+        """Показывать ли пользователя в списке при текущем фильтре"""
+        return name != self.username and self.user_filter in name.lower()
+    
+    def refresh_user_list(self):
+        """Перерисовка списка пользователей одной вставкой"""
+        self.users_rebuild = False
+        self.users_ops = []
+        self.visible_users = [name for name in self.users if self.user_visible(name)]
         self.users_listbox.delete(0, tk.END)
-        for user in users:
-            if user != self.username:
-                self.users_listbox.insert(tk.END, user)
+        if self.visible_users:
+            self.users_listbox.insert(tk.END, *self.visible_users)
+    
+    def apply_user_ops(self):
+        """Точечные вставки и удаления в списке пользователей"""
+        for op, name in self.users_ops:
+            if not self.user_visible(name):
+                continue
+            index = bisect.bisect_left(self.visible_users, name)
+            present = index < len(self.visible_users) and self.visible_users[index] == name
+            if op == 'add' and not present:
+                self.visible_users.insert(index, name)
+                self.users_listbox.insert(index, name)
+            elif op == 'remove' and present:
+                del self.visible_users[index]
+                self.users_listbox.delete(index)
+        self.users_ops = []
+    
+    def on_filter_change(self):
+        """Фильтр применяется после паузы во вводе, а не на каждую букву"""
+        if self.filter_job is not None:
+            self.root.after_cancel(self.filter_job)
+        self.filter_job = self.root.after(FILTER_DELAY, self.apply_filter)
+    
+    def apply_filter(self):
+        """Показ только пользователей, в имени которых есть строка фильтра"""
+        self.filter_job = None
+        self.user_filter = self.filter_var.get().strip().lower()
+        self.refresh_user_list()
     
     def on_closing(self):
         """Обработка закрытия окна"""
-        if self.connected and self.client:
+        if self.connected and self.core:
             self.connected = False
             try:
-                self.client.close()
+                asyncio.run_coroutine_threadsafe(self.core.close(), self.loop).result(timeout=1.0)
             except:
                 pass
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
         self.root.destroy()
     
     def run(self):
@@ -365,5 +867,17 @@ class MessengerClient:
         self.root.mainloop()
 
 if __name__ == "__main__":
-    app = MessengerClient()
+    parser = argparse.ArgumentParser(description='Клиент мессенджера')
+    parser.add_argument('--scrollback', type=int, default=SCROLLBACK,
+                        help='сколько строк хранить в каждой комнате')
+    parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL,
+                        help='через сколько секунд молчания сервера отправлять ping')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='считать связь потерянной после стольких секунд молчания (0 - не проверять)')
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT,
+                        help='сколько ждать ответа сервера при подключении, сек')
+    args = parser.parse_args()
+    
+    app = MessengerClient(scrollback=args.scrollback, ping_interval=args.ping_interval,
+                          idle_timeout=args.idle_timeout, connect_timeout=args.connect_timeout)
     app.run()
\ No newline at end of file
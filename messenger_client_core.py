@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+"""
+Клиентская библиотека мессенджера без графического интерфейса
+Все соединения обслуживает один цикл событий asyncio, поэтому в одном
+процессе можно держать сотни ботов без потока на каждое подключение.
+
+Пример бота:
+    async def main():
+        async with ChatClient('bot') as client:
+            await client.connect('127.0.0.1', 5555)
+            async for event in client:
+                if event['type'] == 'message' and event['username'] != client.username:
+                    await client.send_private(event['username'], 'Привет!')
+
+    asyncio.run(main())
+
+После обрыва reconnect() подключается заново с растущей паузой. Сервер
+продолжает сессию по токену из подтверждения входа и досылает все, что
+клиент не успел получить; для этого клиент считает принятые кадры.
+
+Сообщения в чат и комнаты (send_text, send_private, send_room, join_room,
+leave_room), отправленные без связи, ждут в очереди и уходят по порядку после
+переподключения; в комнаты новой сессии клиент входит заново сам.
+
+Файлы: offer_file() предлагает файл, получатель отвечает accept_file(), после
+чего отправитель вызывает upload(), а получатель - download(). Обе передачи
+идут по своим соединениям и продолжаются с места обрыва.
+"""
+
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+from messenger_files import CHUNK_SIZE, FOLLOW_TIMEOUT
+from messenger_protocol import (ENCODING_JSON, ENCODINGS, HEADER, MAX_FRAME_SIZE,
+                                PROTOCOL_VERSION, FrameDecoder, ProtocolError, RECV_SIZE,
+                                WireFormat, decode_message, encode_message)
+
+CONNECT_TIMEOUT = 10.0
+# Через сколько секунд молчания сервера отправлять ping и когда считать связь потерянной
+PING_INTERVAL = 20.0
+IDLE_TIMEOUT = 60.0
+# Повторы оборвавшейся передачи файла: попыток и первая пауза (дальше вдвое больше)
+TRANSFER_RETRIES = 5
+TRANSFER_RETRY_DELAY = 0.5
+# Переподключение: первая пауза, потолок паузы и сколько раз ждать, пока
+# сервер отпустит имя прежней сессии
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+RECONNECT_NAME_RETRIES = 5
+# Сообщений, ожидающих связи; сверх этого отправка без связи - ошибка
+OFFLINE_QUEUE = 1000
+# Накопленное без связи отправляется сразу до FLUSH_BURST сообщений, дальше -
+# не чаще FLUSH_RATE в секунду, чтобы не упереться в лимиты частоты сервера
+FLUSH_BURST = 20
+FLUSH_RATE = 10.0
+
+
+class JoinRejected(ConnectionError):
+    """Сервер отказал во входе (например, имя занято); code - код ошибки сервера"""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class ChatClient:
+    """Асинхронный клиент: подключение, отправка и поток входящих событий
+
+    События - словари протокола ('message', 'private', 'system', 'user_list', 'presence', ...);
+    перебор клиента (async for) заканчивается, когда сервер закрывает соединение.
+    """
+
+    def __init__(self, username, encodings=ENCODINGS, compress=True,
+                 ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT, resume=True):
+        self.username = username
+        # Кодировки, которые клиент предложит серверу при входе
+        self.encodings = list(encodings)
+        self.compress = compress
+        self.host = None
+        self.port = None
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.wire = WireFormat()
+        # Полученные, но еще не отданные нагрузки кадров
+        self.pending = deque()
+        self.connected = False
+        self.ack = None
+        # Проверка связи; idle_timeout=0 - не проверять
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.last_received = time.monotonic()
+        self.heartbeat_task = None
+        self.timed_out = False
+        # Продолжение сессии после обрыва: токен от сервера и число принятых кадров
+        self.resume = resume
+        self.token = None
+        self.received = 0
+        self.resumed = False
+        # Сообщения, отправленные без связи, и комнаты, в которые клиент вошел
+        self.unsent = deque()
+        self.flush_task = None
+        self.rooms = set()
+
+    async def connect(self, host, port, timeout=CONNECT_TIMEOUT):
+        """Подключение и вход в чат; возвращает подтверждение сервера"""
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+        # Соединения данных для файлов идут на тот же сервер
+        self.host, self.port = host, port
+        self.decoder = FrameDecoder()
+        join = {
+            'type': 'join',
+            'username': self.username,
+            'encodings': self.encodings,
+            'compress': self.compress,
+            # Список пользователей - полный при входе, дальше дельты 'presence'
+            'presence': True,
+            # Клиент отвечает на ping сервера
+            'heartbeat': True
+        }
+        if self.resume:
+            join['resume'] = True
+            if self.token:
+                # Номер последнего принятого кадра: сервер дошлет все, что после него
+                join['token'] = self.token
+                join['last_seq'] = self.received
+        last_seq = self.received
+        # Непрочитанное с прошлого соединения отдаем после подтверждения
+        missed, self.pending = self.pending, deque()
+        try:
+            self.write(join)
+            ack = await asyncio.wait_for(self.receive(), timeout)
+            if ack is None:
+                raise ConnectionError('Сервер закрыл соединение')
+            if ack['type'] != 'system':
+                raise ProtocolError(f"Ожидалось подтверждение входа, получено {ack['type']}")
+            if ack.get('error'):
+                # Например, имя уже занято: сервер закроет соединение сам
+                raise JoinRejected(ack['message'], ack['error'])
+        except BaseException:
+            self.received = last_seq
+            self.pending = missed
+            self.writer.transport.abort()
+            raise
+        self.pending = missed + self.pending
+        self.resumed = bool(ack.get('resumed'))
+        if not self.resumed:
+            # Новая сессия: номера кадров начинаются заново с подтверждения
+            self.received -= last_seq
+        self.token = ack.get('token')
+        # Дальше сервер пишет в выбранной им кодировке
+        self.wire = WireFormat(ack.get('encoding', ENCODING_JSON), ack.get('compress', False),
+                               self.wire.names)
+        self.connected = True
+        self.ack = ack
+        if not self.resumed:
+            # Новая сессия на сервере ничего не знает о комнатах прежней
+            for room in sorted(self.rooms):
+                self.write({'type': 'room_join', 'room': room})
+        if self.idle_timeout:
+            self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+        if self.unsent:
+            self.flush_task = asyncio.ensure_future(self.flush_unsent())
+        return ack
+
+    async def receive(self):
+        """Следующее сообщение от сервера; None, если соединение закрыто"""
+        while True:
+            while not self.pending:
+                try:
+                    data = await self.reader.read(RECV_SIZE)
+                except (ConnectionError, OSError):
+                    data = b''
+                if not data:
+                    self.connected = False
+                    return None
+                self.last_received = time.monotonic()
+                frames = self.decoder.feed(data)
+                self.received += len(frames)
+                self.pending.extend(frames)
+            # Разбираем по одному: сообщение 'names' должно попасть в таблицу
+            # раньше сообщений, которые на него ссылаются
+            message = self.wire.decode(self.pending.popleft())
+            if message['type'] == 'ping':
+                # Проверка связи от сервера: отвечаем сами, приложению она не нужна
+                try:
+                    self.write({'type': 'pong'})
+                except ConnectionError:
+                    pass
+            elif message['type'] != 'pong':
+                return message
+
+    async def heartbeat(self):
+        """ping молчащему серверу; разрыв, если он молчит дольше idle_timeout"""
+        interval = self.ping_interval or self.idle_timeout
+        delay = interval
+        while self.connected:
+            await asyncio.sleep(delay)
+            idle = time.monotonic() - self.last_received
+            if idle >= self.idle_timeout:
+                # receive() получит конец потока и вернет None
+                self.timed_out = True
+                self.connected = False
+                self.writer.transport.abort()
+                return
+            if idle >= interval:
+                try:
+                    self.write({'type': 'ping'})
+                except ConnectionError:
+                    return
+                delay = min(interval, self.idle_timeout - idle)
+            else:
+                delay = interval - idle
+
+    async def reconnect(self, retries=None, timeout=CONNECT_TIMEOUT):
+        """Повторное подключение после обрыва с растущей паузой; retries=None - без предела
+
+        Возвращает подтверждение сервера. ack['resumed'] - сессия продолжена
+        и пропущенное придет следом; иначе это новый вход с полным списком.
+        """
+        self.connected = False
+        self.stop_tasks()
+        if self.writer is not None:
+            self.writer.transport.abort()
+        delay = RECONNECT_DELAY
+        attempt = 0
+        name_retries = 0
+        while True:
+            try:
+                return await self.connect(self.host, self.port, timeout)
+            except JoinRejected as e:
+                # Имя может еще держать прежняя сессия (например, в другом процессе сервера)
+                if e.code != 'username_taken' or not self.token or \
+                        name_retries >= RECONNECT_NAME_RETRIES:
+                    raise
+                name_retries += 1
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                pass
+            attempt += 1
+            if retries is not None and attempt >= retries:
+                raise ConnectionError('Не удалось переподключиться к серверу')
+            # Случайная доля паузы: клиенты упавшего сервера не вернутся все разом
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def write(self, message):
+        """Постановка сообщения в буфер отправки без ожидания"""
+        if self.writer is None or self.writer.is_closing():
+            raise ConnectionError('Нет подключения к серверу')
+        self.writer.write(self.wire.encode(message))
+
+    async def send(self, message):
+        """Отправка сообщения с ожиданием, пока буфер отправки не разгрузится"""
+        self.write(message)
+        await self.writer.drain()
+
+    async def post(self, message):
+        """Отправка, а без связи - постановка в очередь до переподключения
+
+        Возвращает True, если сообщение ушло сразу, и False, если оно ждет связи.
+        """
+        if self.unsent or not self.connected:
+            # Пока очередь не пуста, новые сообщения встают за ней: порядок сохраняется
+            return self.hold(message)
+        try:
+            self.write(message)
+        except ConnectionError:
+            # Связь пропала, но receive() еще не заметил
+            return self.hold(message)
+        await self.writer.drain()
+        return True
+
+    def hold(self, message):
+        """Сообщение ждет переподключения"""
+        if len(self.unsent) >= OFFLINE_QUEUE:
+            raise ConnectionError('Нет связи с сервером, очередь неотправленных заполнена')
+        self.unsent.append(message)
+        return False
+
+    async def flush_unsent(self):
+        """Отправка накопленного без связи по порядку; при новом обрыве остаток ждет дальше"""
+        sent = 0
+        try:
+            while self.unsent and self.connected:
+                self.write(self.unsent[0])
+                self.unsent.popleft()
+                sent += 1
+                await self.writer.drain()
+                if sent >= FLUSH_BURST:
+                    await asyncio.sleep(1 / FLUSH_RATE)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if self.flush_task is asyncio.current_task():
+                self.flush_task = None
+
+    def stop_tasks(self):
+        """Остановка проверки связи и досылки очереди текущего соединения"""
+        for task in (self.heartbeat_task, self.flush_task):
+            if task is not None:
+                task.cancel()
+        self.heartbeat_task = None
+        self.flush_task = None
+
+    async def send_text(self, text):
+        """Сообщение в общий чат; без связи - после переподключения"""
+        return await self.post({'type': 'message', 'text': text})
+
+    async def send_private(self, target, text):
+        """Приватное сообщение пользователю; без связи - после переподключения"""
+        return await self.post({'type': 'private', 'text': text, 'target': target})
+
+    async def join_room(self, room):
+        """Вход в комнату"""
+        self.rooms.add(room)
+        return await self.post({'type': 'room_join', 'room': room})
+
+    async def leave_room(self, room):
+        """Выход из комнаты"""
+        self.rooms.discard(room)
+        return await self.post({'type': 'room_leave', 'room': room})
+
+    async def send_room(self, room, text):
+        """Сообщение участникам комнаты; без связи - после переподключения"""
+        return await self.post({'type': 'room_message', 'room': room, 'text': text})
+
+    async def request_user_list(self):
+        """Запрос полного списка пользователей (например, после пропуска дельты)"""
+        await self.send({'type': 'user_list'})
+
+    async def search(self, query='', sender=None, since=None, until=None, before=None,
+                     limit=None, ref=None):
+        """Поиск по истории чата; сервер ответит search_results с тем же ref
+
+        since/until - время Unix; before - значение next из прошлого ответа
+        (следующая, более старая страница). 'ссылк*' ищет по началу слова.
+        """
+        request = {'type': 'search', 'query': query, 'ref': ref}
+        for key, value in (('from', sender), ('since', since), ('until', until),
+                           ('before', before), ('limit', limit)):
+            if value is not None:
+                request[key] = value
+        await self.send(request)
+
+    async def offer_file(self, target, path, ref=None):
+        """Предложение файла; сервер ответит копией file_offer с id передачи и тем же ref"""
+        await self.send({'type': 'file_offer', 'target': target, 'name': os.path.basename(path),
+                         'size': os.path.getsize(path), 'ref': ref})
+
+    async def accept_file(self, file_id):
+        """Согласие принять файл: отправитель получит file_accept"""
+        await self.send({'type': 'file_accept', 'id': file_id})
+
+    async def decline_file(self, file_id):
+        """Отказ от файла: сервер удалит его, отправитель получит file_decline"""
+        await self.send({'type': 'file_decline', 'id': file_id})
+
+    async def upload(self, file_id, path, progress=None):
+        """Загрузка файла на сервер; progress(отправлено, размер) после каждого куска"""
+        size = os.path.getsize(path)
+        loop = asyncio.get_running_loop()
+
+        async def attempt():
+            reader, writer, status = await self.open_transfer({'type': 'file_put', 'id': file_id})
+            try:
+                # Сервер говорит, сколько у него уже есть: продолжаем с этого места
+                offset = status['offset']
+                with open(path, 'rb') as f:
+                    while offset < size:
+                        # sendfile кусками - чтобы показывать ход передачи
+                        offset += await loop.sendfile(writer.transport, f, offset,
+                                                      min(CHUNK_SIZE, size - offset))
+                        if progress is not None:
+                            progress(offset, size)
+            finally:
+                writer.close()
+
+        await self.retry_transfer(attempt)
+
+    async def download(self, file_id, path, progress=None):
+        """Скачивание файла в path; недокачанное лежит в path + '.part' до конца передачи"""
+        part = path + '.part'
+
+        async def attempt():
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            reader, writer, status = await self.open_transfer(
+                {'type': 'file_get', 'id': file_id, 'offset': offset})
+            try:
+                offset, size = status['offset'], status['size']
+                with open(part, 'r+b' if os.path.exists(part) else 'wb') as f:
+                    f.truncate(offset)
+                    f.seek(offset)
+                    while offset < size:
+                        # Сервер ждет отставшую загрузку не дольше FOLLOW_TIMEOUT
+                        data = await asyncio.wait_for(reader.read(CHUNK_SIZE),
+                                                      FOLLOW_TIMEOUT + CONNECT_TIMEOUT)
+                        if not data:
+                            raise ConnectionError('Передача файла прервалась')
+                        f.write(data)
+                        offset += len(data)
+                        if progress is not None:
+                            progress(offset, size)
+            finally:
+                writer.close()
+            os.replace(part, path)
+
+        await self.retry_transfer(attempt)
+
+    async def retry_transfer(self, attempt):
+        """Повтор оборвавшейся передачи с растущей паузой; каждый повтор - с места обрыва"""
+        delay = TRANSFER_RETRY_DELAY
+        for retry in range(TRANSFER_RETRIES):
+            try:
+                return await attempt()
+            except (ConnectionError, OSError, EOFError, asyncio.TimeoutError):
+                if retry == TRANSFER_RETRIES - 1:
+                    raise
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def open_transfer(self, request, timeout=CONNECT_TIMEOUT):
+        """Соединение данных: первый кадр и ответ сервера file_status"""
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout)
+        try:
+            writer.write(encode_message(request))
+            # Ровно один кадр: следом за ним идут сырые байты файла
+            version, length = HEADER.unpack(
+                await asyncio.wait_for(reader.readexactly(HEADER.size), timeout))
+            if version != PROTOCOL_VERSION or length > MAX_FRAME_SIZE:
+                raise ProtocolError('Неверный ответ сервера')
+            status = decode_message(await asyncio.wait_for(reader.readexactly(length), timeout))
+        except BaseException:
+            writer.close()
+            raise
+        if status.get('error'):
+            writer.close()
+            # Файла нет или он отклонен: повторять бесполезно
+            raise ProtocolError(status['error'])
+        return reader, writer, status
+
+    async def close(self):
+        """Закрытие соединения"""
+        if self.connected:
+            # Выход по желанию: сервер не будет ждать возвращения
+            try:
+                self.write({'type': 'leave'})
+            except ConnectionError:
+                pass
+        self.connected = False
+        self.stop_tasks()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
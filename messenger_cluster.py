@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Многопроцессный режим сервера мессенджера (только Linux)
+Рабочие процессы слушают один порт через SO_REUSEPORT, а ядро распределяет
+между ними подключения. Рассылки, приватные сообщения и списки пользователей
+процессы передают друг другу через шину - Unix сокет в родительском процессе.
+
+Сообщения шины - те же кадры messenger_protocol с полем 'bus':
+    hello     - процесс подключился к шине
+    broadcast - сообщение для всех клиентов
+    private   - приватное сообщение для пользователя другого процесса
+    room      - сообщение для участников комнаты
+    notice    - user_joined/user_left для клиентов без дельт присутствия
+    presence  - полный список пользователей одного процесса
+    release   - клиент продолжает сессию в другом процессе: старую пора удалить
+"""
+
+import asyncio
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+
+from messenger_log import log
+from messenger_protocol import (FrameDecoder, RECV_SIZE, decode_message, encode_frame,
+                                encode_message)
+from messenger_server import AsyncChatServer
+
+
+class ShardedChatServer(AsyncChatServer):
+    """Рабочий процесс: asyncio сервер, подключенный к общей шине"""
+
+    def __init__(self, *args, worker_id=0, bus_path=None, **kwargs):
+        if kwargs.get('history_dir'):
+            # Каждый процесс ведет свой журнал, включая сообщения с шины
+            kwargs['history_dir'] = os.path.join(kwargs['history_dir'], f'worker-{worker_id}')
+        if kwargs.get('metrics_port'):
+            # У каждого процесса свои метрики на своем порту
+            kwargs['metrics_port'] += worker_id
+        if kwargs.get('capture_path'):
+            # И своя запись трафика; номера соединений в разных файлах независимы
+            root, ext = os.path.splitext(kwargs['capture_path'])
+            kwargs['capture_path'] = f'{root}.{worker_id}{ext}'
+        super().__init__(*args, **kwargs)
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('SO_REUSEPORT не поддерживается этой системой')
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.worker_id = worker_id
+        self.bus_path = bus_path
+        self.bus_writer = None
+        self.remote_users = {}  # {worker_id: {username, ...}}
+        self.published_users = None  # свой список, последний раз отправленный в шину
+
+    async def serve(self, console=False):
+        """Подключение к шине и запуск сервера"""
+        reader, self.bus_writer = await asyncio.open_unix_connection(self.bus_path)
+        self.publish({'bus': 'hello', 'worker': self.worker_id})
+        bus_task = asyncio.ensure_future(self.read_bus(reader))
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.stop)
+        try:
+            await super().serve(console)
+        finally:
+            bus_task.cancel()
+
+    def stop(self):
+        """Остановка по SIGTERM от родительского процесса"""
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+    def publish(self, message):
+        """Отправка сообщения шины остальным процессам"""
+        if self.bus_writer is not None and not self.bus_writer.is_closing():
+            self.bus_writer.write(encode_message(message))
+
+    async def read_bus(self, reader):
+        """Прием сообщений от других процессов"""
+        decoder = FrameDecoder()
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                log.error('ШИНА', 'Процесс %d потерял связь с шиной', self.worker_id)
+                self.stop()
+                return
+            for payload in decoder.feed(data):
+                self.handle_bus_message(decode_message(payload))
+
+    def handle_bus_message(self, message):
+        """Обработка события от другого процесса"""
+        if message['bus'] == 'broadcast':
+            frame = encode_message(message['message'])
+            self.broadcast_frame(frame)
+            if message['message']['type'] == 'message':
+                self.log_event(frame)
+
+        elif message['bus'] == 'private':
+            session = self.sessions.find(message['target'])
+            if session is not None:
+                frame = encode_message(message['message'])
+                try:
+                    self.deliver(session, frame)
+                except ConnectionError:
+                    return
+                if message['message']['type'] == 'private':
+                    self.log_event(frame, private=True)
+
+        elif message['bus'] == 'room':
+            self.room_frame(message['room'], encode_message(message['message']))
+
+        elif message['bus'] == 'notice':
+            self.legacy_frame(encode_message(message['message']))
+
+        elif message['bus'] == 'release':
+            session = self.resumable.get(message['token'])
+            if session is not None and session.username == message['username']:
+                self.forget_session(session)
+
+        elif message['bus'] == 'presence':
+            old = self.remote_users.get(message['worker'], set())
+            if message['users']:
+                self.remote_users[message['worker']] = set(message['users'])
+            else:
+                self.remote_users.pop(message['worker'], None)
+            # Своим клиентам уходит дельта по изменившимся именам
+            for username in old.symmetric_difference(message['users']):
+                self.presence_changed(username)
+
+    def broadcast(self, message, exclude_client=None):
+        """Рассылка своим клиентам и клиентам остальных процессов"""
+        frame = super().broadcast(message, exclude_client)
+        self.publish({'bus': 'broadcast', 'message': message})
+        return frame
+
+    def send_to_room(self, room, message):
+        """Сообщение участникам комнаты во всех процессах"""
+        frame = super().send_to_room(room, message)
+        self.publish({'bus': 'room', 'room': room, 'message': message})
+        return frame
+
+    def broadcast_notice(self, message, exclude_client=None):
+        """user_joined/user_left для старых клиентов во всех процессах"""
+        frame = super().broadcast_notice(message, exclude_client)
+        self.publish({'bus': 'notice', 'message': message})
+        return frame
+
+    def flush_presence(self):
+        """Публикация своих пользователей в шину и дельта своим клиентам"""
+        local = self.sessions.usernames()
+        if local != self.published_users:
+            self.published_users = local
+            self.publish({'bus': 'presence', 'worker': self.worker_id, 'users': local})
+        super().flush_presence()
+
+    def usernames(self):
+        """Имена пользователей всех процессов"""
+        users = super().usernames()
+        for worker_users in self.remote_users.values():
+            users.extend(worker_users)
+        return users
+
+    def add_session(self, session, on_added=None):
+        """Имя должно быть свободно и в остальных процессах"""
+        for worker_users in self.remote_users.values():
+            if session.username in worker_users:
+                return False
+        return super().add_session(session, on_added)
+
+    def resume_session(self, client, username, address, join):
+        """Сессия может ждать клиента в другом процессе: ядро раздает подключения само"""
+        session = super().resume_session(client, username, address, join)
+        if session is None:
+            # Тот процесс освободит имя, а клиент повторит вход и войдет заново
+            self.publish({'bus': 'release', 'username': username, 'token': join['token']})
+        return session
+
+    def send_private_message(self, message, target_username, sender_socket):
+        """Приватное сообщение, в том числе пользователю другого процесса"""
+        if self.sessions.find(target_username) is None:
+            for worker_id, users in self.remote_users.items():
+                if target_username in users:
+                    self.publish({'bus': 'private', 'worker': worker_id,
+                                  'target': target_username, 'message': message})
+                    # Копия отправителю, как и для локального получателя
+                    frame = encode_message(message)
+                    self.send_to(sender_socket, frame)
+                    return frame
+        return super().send_private_message(message, target_username, sender_socket)
+
+    def shutdown(self):
+        """Завершение работы процесса без рассылки в шину"""
+        if self.bus_writer is not None:
+            self.bus_writer.close()
+            self.bus_writer = None
+        super().shutdown()
+
+
+class ClusterHub:
+    """Шина в родительском процессе: пересылает кадры каждого процесса остальным"""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(64)
+        self.workers = {}   # {writer: worker_id}
+        self.presence = {}  # {worker_id: последний кадр presence}
+        self.users = {}     # {worker_id: [username, ...]}
+        self.loop = None
+        self.stop_event = None
+
+    async def serve(self, console=True):
+        """Основная корутина шины"""
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(sig, self.stop_event.set)
+        bus_server = await asyncio.start_unix_server(self.handle_worker, sock=self.sock)
+        if console:
+            console_thread = threading.Thread(target=self.run_console)
+            console_thread.daemon = True
+            console_thread.start()
+        try:
+            await self.stop_event.wait()
+        finally:
+            bus_server.close()
+
+    def run_console(self):
+        """Консольные команды родительского процесса"""
+        try:
+            while True:
+                command = input().strip().lower()
+                if command == 'exit':
+                    break
+                if command == 'users':
+                    self.loop.call_soon_threadsafe(self.show_users)
+        except EOFError:
+            pass
+        self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    def show_users(self):
+        """Пользователи по процессам"""
+        if not any(self.users.values()):
+            print("[АКТИВНЫЕ ПОЛЬЗОВАТЕЛИ] Нет подключенных пользователей")
+            return
+        print("\n[АКТИВНЫЕ ПОЛЬЗОВАТЕЛИ]")
+        for worker_id in sorted(self.users):
+            for username in self.users[worker_id]:
+                print(f"  - {username} (процесс {worker_id})")
+
+    def relay(self, frame, source):
+        """Пересылка кадра всем процессам, кроме источника"""
+        for writer in list(self.workers):
+            if writer is not source and not writer.is_closing():
+                writer.write(frame)
+
+    async def handle_worker(self, reader, writer):
+        """Обслуживание подключения одного рабочего процесса"""
+        decoder = FrameDecoder()
+        worker_id = None
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for payload in decoder.feed(data):
+                    message = decode_message(payload)
+                    if message['bus'] == 'hello':
+                        worker_id = message['worker']
+                        self.workers[writer] = worker_id
+                        # Новый процесс узнает, кто уже в чате
+                        for frame in self.presence.values():
+                            writer.write(frame)
+                        continue
+                    # Пересылаем исходные байты, не сериализуя заново
+                    frame = encode_frame(bytes(payload))
+                    if message['bus'] == 'presence':
+                        self.presence[message['worker']] = frame
+                        self.users[message['worker']] = message['users']
+                    self.relay(frame, writer)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.error('ШИНА', 'Ошибка процесса %s: %s', worker_id, e)
+        finally:
+            self.workers.pop(writer, None)
+            writer.close()
+            if worker_id is not None and self.presence.pop(worker_id, None) is not None:
+                # Пользователи упавшего процесса исчезают из общего списка
+                self.users.pop(worker_id, None)
+                self.relay(encode_message({'bus': 'presence', 'worker': worker_id, 'users': []}),
+                           None)
+
+
+def run_worker(worker_id, bus_path, host, port, backlog, **server_kwargs):
+    """Тело дочернего процесса"""
+    if log.path:
+        # У каждого процесса свой файл журнала: ротацию нельзя делить между писателями
+        root, ext = os.path.splitext(log.path)
+        log.reopen(f'{root}.{worker_id}{ext}')
+    server = ShardedChatServer(host, port, backlog, worker_id=worker_id, bus_path=bus_path,
+                               **server_kwargs)
+    server.start(console=False)
+
+
+def run_cluster(workers, host='0.0.0.0', port=5555, backlog=128, console=True, **server_kwargs):
+    """Запуск шины и workers рабочих процессов на общем порту"""
+    if not hasattr(os, 'fork') or not hasattr(socket, 'AF_UNIX'):
+        raise RuntimeError('Режим sharded требует fork и Unix сокетов')
+
+    bus_dir = tempfile.mkdtemp(prefix='messenger-bus-')
+    hub = ClusterHub(os.path.join(bus_dir, 'bus.sock'))
+    print(f"[СЕРВЕР] Запуск {workers} процессов на {host}:{port}")
+
+    pids = []
+    try:
+        for worker_id in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                # Дочерний процесс: шина ему не нужна, только путь к ней
+                hub.sock.close()
+                code = 0
+                try:
+                    run_worker(worker_id, hub.path, host, port, backlog, **server_kwargs)
+                except BaseException as e:
+                    log.error('ОШИБКА', 'Процесс %d: %s', worker_id, e)
+                    code = 1
+                finally:
+                    # os._exit не вызывает atexit: остаток журнала выводим сами
+                    log.close()
+                    os._exit(code)
+            pids.append(pid)
+
+        asyncio.run(hub.serve(console))
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
+        hub.sock.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
+        print("[СЕРВЕР] Все процессы остановлены")
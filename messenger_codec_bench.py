@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк кодировок протокола мессенджера
+Сравнивает текущий путь json.dumps с двоичной кодировкой и сжатием:
+время кодирования и разбора одного кадра и его размер на проводе.
+
+Пример:
+    python messenger_codec_bench.py --users 100 1000
+"""
+
+import argparse
+import json
+import timeit
+
+from messenger_protocol import (ENCODING_BINARY, ENCODING_JSON, FrameDecoder, NameTable,
+                                WireFormat, decode_message, encode_message)
+
+TEXT = 'Привет! Встречаемся сегодня в 19:00 у входа, не опаздывайте.'
+
+
+def sample_messages(sizes):
+    """Типичные сообщения сервера и списки пользователей указанных размеров"""
+    names = [f'user{i}' for i in range(max(sizes))]
+    messages = {
+        'message': {'type': 'message', 'text': TEXT, 'username': 'user7', 'timestamp': '19:04:31'},
+        'private': {'type': 'private', 'target': 'user3', 'text': TEXT, 'username': 'user7',
+                    'timestamp': '19:04:31'},
+        'user_joined': {'type': 'user_joined', 'username': 'user7',
+                        'message': 'user7 присоединился к чату', 'timestamp': '19:04:31'},
+    }
+    for size in sizes:
+        messages[f'user_list_{size}'] = {'type': 'user_list', 'users': names[:size],
+                                         'timestamp': '19:04:31'}
+    return names, messages
+
+
+def variants(names):
+    """Кодировки для сравнения: (название, функция кодирования, функция разбора)"""
+    server_names = NameTable()
+    for name in names:
+        server_names.intern(name)
+        server_names.publish(name)
+    result = [('json', encode_message, decode_message)]
+    for encoding, compress, label in ((ENCODING_JSON, True, 'json+zlib'),
+                                      (ENCODING_BINARY, False, 'binary'),
+                                      (ENCODING_BINARY, True, 'binary+zlib')):
+        server = WireFormat(encoding, compress, server_names)
+        client = WireFormat(encoding, compress)
+        # Клиент знает таблицу имен, как после входа
+        client.decode(FrameDecoder().feed(server.encode(server_names.definition()))[0])
+        result.append((label, server.encode, client.decode))
+    return result
+
+
+def measure(func, arg):
+    """Среднее время одного вызова, мкс"""
+    timer = timeit.Timer(lambda: func(arg))
+    number, _ = timer.autorange()
+    best = min(timer.repeat(3, number))
+    return round(best / number * 1e6, 2)
+
+
+def run(sizes):
+    """Замеры всех сообщений во всех кодировках"""
+    names, messages = sample_messages(sizes)
+    rows = []
+    for kind, message in messages.items():
+        for label, encode, decode in variants(names):
+            frame = encode(message)
+            payload = bytes(FrameDecoder().feed(frame)[0])
+            assert decode(payload) == message, (kind, label)
+            rows.append({
+                'message': kind,
+                'encoding': label,
+                'bytes': len(frame),
+                'encode_us': measure(encode, message),
+                'decode_us': measure(decode, payload),
+            })
+    return rows
+
+
+def print_table(rows):
+    """Вывод результатов таблицей с размером относительно JSON"""
+    columns = ['message', 'encoding', 'bytes', 'size_vs_json', 'encode_us', 'decode_us']
+    print(' | '.join(columns))
+    json_bytes = {row['message']: row['bytes'] for row in rows if row['encoding'] == 'json'}
+    for row in rows:
+        row['size_vs_json'] = round(row['bytes'] / json_bytes[row['message']], 3)
+        print(' | '.join(str(row[c]) for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк кодировок протокола мессенджера')
+    parser.add_argument('--users', nargs='+', type=int, default=[100, 1000],
+                        help='размеры списка пользователей')
+    parser.add_argument('--json', help='файл для сохранения результатов')
+    args = parser.parse_args(argv)
+
+    rows = run(args.users)
+    print_table(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
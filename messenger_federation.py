@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Федерация серверов мессенджера
+Независимые серверы (узлы) связываются постоянными TCP соединениями и пересылают
+друг другу рассылки, приватные сообщения и присутствие: пользователи всех узлов
+видят общий чат и общий список пользователей.
+
+Сообщения связи - те же кадры messenger_protocol с полем 'link':
+    hello     - узел представился соседу (имя и случайная строка для auth)
+    auth      - HMAC общего секрета (--link-secret) от строки соседа
+    broadcast - сообщение для всех клиентов
+    room      - сообщение для участников комнаты
+    notice    - user_joined/user_left для клиентов без дельт присутствия
+    private   - приватное сообщение пользователю другого узла
+    presence  - полный список пользователей одного узла
+    sync      - просьба ко всем узлам заново прислать свой presence
+
+Узлы не обязаны быть связаны каждый с каждым: сообщение уходит по всем связям,
+кроме той, откуда пришло. У каждого сообщения свой id (узел, метка запуска, номер),
+повторно пришедший id отбрасывается, а счетчик hops ограничивает путь, даже если
+id уже забыт. Приватное сообщение идет только по связи, через которую раньше всего
+пришел presence узла получателя.
+
+Связь без аутентификации: по умолчанию узел принимает соседей только на
+127.0.0.1. Чтобы принимать их по сети (--link-host), нужен общий секрет
+--link-secret у всех узлов: без него сосед может выдать себя за любого
+пользователя. Секрет по сети не передается, только подпись случайной строки.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import secrets
+import socket
+import time
+from collections import deque
+
+from messenger_log import log
+from messenger_outbox import set_nodelay
+from messenger_protocol import (FrameDecoder, ProtocolError, RECV_SIZE, decode_message,
+                                encode_message)
+from messenger_server import AsyncChatServer
+
+# Сколько последних id помнить для отбрасывания копий
+SEEN_SIZE = 65536
+# Предел пересылок одного сообщения
+MAX_HOPS = 16
+# Паузы между попытками подключиться к соседу, сек
+LINK_RETRY_DELAY = 0.5
+LINK_RETRY_MAX_DELAY = 10.0
+# Сколько ждать ответов на sync, прежде чем забыть молчащие узлы, сек
+SYNC_GRACE = 2.0
+# Соседа, который не успевает читать, отключаем: после переподключения
+# он получит свежий presence, а очередь не съест память
+LINK_BUFFER_LIMIT = 16 * 1024 * 1024
+# Адрес приема соседей по умолчанию: связь без секрета доступна только с этой машины
+LINK_HOST = '127.0.0.1'
+# Обязательные поля сообщений связи, кроме общих id/origin/hops
+LINK_FIELDS = {
+    'broadcast': ('message',),
+    'room': ('room', 'message'),
+    'notice': ('message',),
+    'private': ('target', 'message'),
+    'presence': ('users',),
+    'sync': (),
+}
+
+
+def parse_peer(text):
+    """Адрес соседа вида host:port"""
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class SeenIds:
+    """Ограниченная память id уже обработанных сообщений"""
+
+    def __init__(self, size=SEEN_SIZE):
+        self.size = size
+        self.ids = set()
+        self.order = deque()
+
+    def add(self, message_id):
+        """Запоминание id; False, если он уже встречался"""
+        if message_id in self.ids:
+            return False
+        self.ids.add(message_id)
+        self.order.append(message_id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+        return True
+
+
+def link_proof(secret, nonce):
+    """Подпись случайной строки соседа общим секретом"""
+    return hmac.new(secret.encode('utf-8'), nonce.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def valid_link_message(message):
+    """Есть ли у сообщения связи все поля нужных типов"""
+    fields = LINK_FIELDS.get(message.get('link'))
+    if fields is None or not isinstance(message.get('id'), str) or \
+            not isinstance(message.get('origin'), str) or not isinstance(message.get('hops'), int):
+        return False
+    if any(field not in message for field in fields):
+        return False
+    if 'message' in fields:
+        inner = message['message']
+        if not isinstance(inner, dict) or not isinstance(inner.get('type'), str):
+            return False
+    if 'users' in fields:
+        users = message['users']
+        if not isinstance(users, list) or not all(isinstance(name, str) for name in users):
+            return False
+    for field in ('target', 'room'):
+        if field in fields and not isinstance(message[field], str):
+            return False
+    return True
+
+
+class FederatedChatServer(AsyncChatServer):
+    """asyncio сервер - узел федерации"""
+
+    def __init__(self, *args, node_id=None, link_port=None, peers=(), link_host=LINK_HOST,
+                 link_secret=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.node_id = node_id or f'{socket.gethostname()}:{self.port}'
+        self.link_port = link_port
+        self.link_host = link_host
+        self.link_secret = link_secret
+        self.peers = [parse_peer(peer) if isinstance(peer, str) else peer for peer in peers]
+        # Метка запуска: после перезапуска узла его новые id не совпадут со старыми,
+        # которые соседи еще помнят
+        self.id_prefix = f'{self.node_id}/{secrets.token_hex(4)}/'
+        self.next_id = 0
+        self.seen = SeenIds()
+        self.links = {}          # {writer: node_id соседа}
+        self.remote_users = {}   # {node_id: {username, ...}}
+        self.routes = {}         # {node_id: writer связи, откуда пришел его presence}
+        self.node_seen = {}      # {node_id: время последнего presence}
+        self.published_users = None  # свой список, последний раз отправленный соседям
+        self.link_server = None
+        self.link_tasks = []
+        registry = self.metrics.registry
+        self.link_in = registry.counter('messenger_link_messages_in_total',
+                                        'Принято сообщений от соседних узлов')
+        self.link_duplicates = registry.counter('messenger_link_duplicates_total',
+                                                'Отброшено копий, пришедших другим путем')
+        self.link_invalid = registry.counter('messenger_link_invalid_total',
+                                             'Отброшено поврежденных сообщений связи')
+        registry.gauge('messenger_links', 'Связей с соседними узлами', lambda: len(self.links))
+        registry.gauge('messenger_remote_users', 'Пользователей на других узлах',
+                       lambda: sum(map(len, self.remote_users.values())))
+
+    async def serve(self, console=True):
+        """Запуск приема соседей, подключение к известным соседям и запуск сервера"""
+        self.loop = asyncio.get_running_loop()
+        if self.link_port:
+            self.link_server = await asyncio.start_server(self.run_link, self.link_host,
+                                                          self.link_port)
+            print(f"[ФЕДЕРАЦИЯ] Узел {self.node_id} принимает соседей на "
+                  f"{self.link_host}:{self.link_port}")
+        self.link_tasks = [asyncio.ensure_future(self.dial(host, port))
+                           for host, port in self.peers]
+        try:
+            await super().serve(console)
+        finally:
+            for task in self.link_tasks:
+                task.cancel()
+
+    async def dial(self, host, port):
+        """Подключение к соседу; после обрыва - повтор с растущей паузой"""
+        delay = LINK_RETRY_DELAY
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LINK_RETRY_MAX_DELAY)
+                continue
+            delay = LINK_RETRY_DELAY
+            await self.run_link(reader, writer)
+            await asyncio.sleep(delay)
+
+    async def run_link(self, reader, writer):
+        """Обслуживание одной связи: знакомство, затем сообщения соседа"""
+        set_nodelay(writer.get_extra_info('socket'))
+        nonce = secrets.token_hex(16)
+        writer.write(encode_message({'link': 'hello', 'node': self.node_id, 'nonce': nonce}))
+        decoder = FrameDecoder()
+        node = None
+        peer = None   # имя соседа из hello, пока он не подтвердил секрет
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for payload in decoder.feed(data):
+                    try:
+                        message = decode_message(payload)
+                    except (ProtocolError, ValueError) as e:
+                        # Кадр цел, испорчено только его содержимое - связь не рвем
+                        self.link_invalid.inc()
+                        log.warning('ФЕДЕРАЦИЯ', 'Поврежденный кадр от узла %s: %s', node, e)
+                        continue
+                    if node is not None:
+                        self.handle_link_message(message, writer)
+                        continue
+                    if peer is None:
+                        peer = self.check_hello(message, writer)
+                        if peer is None:
+                            log.warning('ФЕДЕРАЦИЯ', 'Отклонено подключение %s',
+                                        writer.get_extra_info('peername'))
+                            return
+                        if self.link_secret:
+                            continue
+                    elif not (isinstance(message, dict) and message.get('link') == 'auth' and
+                              hmac.compare_digest(str(message.get('proof')),
+                                                  link_proof(self.link_secret, nonce))):
+                        log.warning('ФЕДЕРАЦИЯ', 'Узел %s не знает секрет связи, подключение %s '
+                                    'отклонено', peer, writer.get_extra_info('peername'))
+                        return
+                    node = peer
+                    self.links[writer] = node
+                    log.info('ФЕДЕРАЦИЯ', 'Связь с узлом %s установлена', node)
+                    # Новый сосед и все узлы за ним узнают друг о друге
+                    self.request_sync()
+        except Exception as e:
+            log.warning('ФЕДЕРАЦИЯ', 'Ошибка связи с узлом %s: %s', node, e)
+        finally:
+            writer.close()
+            if self.links.pop(writer, None) is not None:
+                log.warning('ФЕДЕРАЦИЯ', 'Связь с узлом %s потеряна', node)
+                self.link_lost(writer)
+
+    def check_hello(self, message, writer):
+        """Имя соседа из hello; None, если это не hello или узел - мы сами
+
+        С секретом соседу сразу уходит подпись его случайной строки.
+        """
+        if not isinstance(message, dict) or message.get('link') != 'hello':
+            return None
+        node = message.get('node')
+        if not isinstance(node, str) or not node or node == self.node_id:
+            return None
+        if self.link_secret:
+            nonce = message.get('nonce')
+            if not isinstance(nonce, str):
+                return None
+            writer.write(encode_message({'link': 'auth',
+                                         'proof': link_proof(self.link_secret, nonce)}))
+        return node
+
+    def link_lost(self, writer):
+        """Узлы за потерянной связью могут быть доступны другим путем - переспрашиваем"""
+        for node, route in list(self.routes.items()):
+            if route is writer:
+                del self.routes[node]
+        if self.stop_event is not None and not self.stop_event.is_set():
+            self.request_sync()
+
+    def send_link(self, writer, frame):
+        """Передача кадра соседу"""
+        if writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > LINK_BUFFER_LIMIT:
+            log.warning('ФЕДЕРАЦИЯ', 'Узел %s не успевает читать, связь разорвана',
+                        self.links.get(writer))
+            writer.transport.abort()
+            return
+        writer.write(frame)
+
+    def publish(self, message):
+        """Отправка собственного сообщения всем узлам"""
+        self.next_id += 1
+        message['id'] = f'{self.id_prefix}{self.next_id}'
+        message['origin'] = self.node_id
+        message['hops'] = 0
+        self.seen.add(message['id'])
+        self.forward(message, None)
+
+    def forward(self, message, source):
+        """Пересылка соседям, кроме источника"""
+        if not self.links:
+            return
+        frame = encode_message(message)
+        if message['link'] == 'private':
+            route = self.routes.get(self.node_of(message['target']))
+            # Обратно к источнику нельзя: он уже видел этот id и отбросит копию
+            if route is not None and route is not source:
+                self.send_link(route, frame)
+                return
+        for writer in list(self.links):
+            if writer is not source:
+                self.send_link(writer, frame)
+
+    def handle_link_message(self, message, source):
+        """Сообщение от соседа: обработка у себя и передача дальше"""
+        self.link_in.inc()
+        if not isinstance(message, dict) or not valid_link_message(message):
+            self.link_invalid.inc()
+            log.warning('ФЕДЕРАЦИЯ', 'Неверное сообщение от узла %s отброшено',
+                        self.links.get(source))
+            return
+        if message['origin'] == self.node_id or not self.seen.add(message['id']):
+            # Свое сообщение вернулось по кругу или копия пришла другим путем
+            self.link_duplicates.inc()
+            return
+        if message['link'] == 'private':
+            if self.deliver_private(message):
+                return
+        else:
+            self.apply_link_message(message, source)
+        if message['hops'] < MAX_HOPS:
+            message['hops'] += 1
+            self.forward(message, source)
+
+    def deliver_private(self, message):
+        """Приватное сообщение своему пользователю; False, если он не здесь"""
+        session = self.sessions.find(message['target'])
+        if session is None:
+            return False
+        frame = encode_message(message['message'])
+        try:
+            self.deliver(session, frame)
+        except ConnectionError:
+            return True
+        if message['message']['type'] == 'private':
+            self.log_event(frame, private=True)
+        return True
+
+    def apply_link_message(self, message, source):
+        """Обработка рассылки, присутствия или sync от другого узла"""
+        kind = message['link']
+        if kind == 'broadcast':
+            frame = encode_message(message['message'])
+            self.broadcast_frame(frame)
+            if message['message']['type'] == 'message':
+                self.log_event(frame)
+
+        elif kind == 'room':
+            self.room_frame(message['room'], encode_message(message['message']))
+
+        elif kind == 'notice':
+            self.legacy_frame(encode_message(message['message']))
+
+        elif kind == 'presence':
+            node = message['origin']
+            # Первая копия пришла самым быстрым путем: по нему и пойдут приватные
+            self.routes[node] = source
+            self.node_seen[node] = time.monotonic()
+            old = self.remote_users.get(node, set())
+            self.remote_users[node] = set(message['users'])
+            for username in old.symmetric_difference(message['users']):
+                self.presence_changed(username)
+
+        elif kind == 'sync':
+            self.answer_sync()
+
+    def request_sync(self):
+        """Все узлы заново присылают presence; кто не ответил - недоступен"""
+        self.publish({'link': 'sync'})
+        self.answer_sync()
+
+    def answer_sync(self):
+        """Свой presence всем узлам и забывание узлов, не ответивших за SYNC_GRACE"""
+        self.publish_presence(force=True)
+        self.loop.call_later(SYNC_GRACE, self.expire_nodes, time.monotonic())
+
+    def expire_nodes(self, since):
+        """Пользователи узлов, молчащих с момента since, исчезают из общего списка"""
+        for node, seen in list(self.node_seen.items()):
+            if seen < since:
+                self.forget_node(node)
+
+    def forget_node(self, node):
+        """Узел недоступен"""
+        log.warning('ФЕДЕРАЦИЯ', 'Узел %s недоступен', node)
+        self.node_seen.pop(node, None)
+        self.routes.pop(node, None)
+        for username in self.remote_users.pop(node, ()):
+            self.presence_changed(username)
+
+    def node_of(self, username):
+        """Узел, на котором находится пользователь; None, если такого нет"""
+        for node, users in self.remote_users.items():
+            if username in users:
+                return node
+        return None
+
+    def publish_presence(self, force=False):
+        """Свой список пользователей соседям, если он изменился"""
+        local = self.sessions.usernames()
+        if force or local != self.published_users:
+            self.published_users = local
+            self.publish({'link': 'presence', 'users': local})
+
+    def broadcast(self, message, exclude_client=None):
+        """Рассылка своим клиентам и клиентам остальных узлов"""
+        frame = super().broadcast(message, exclude_client)
+        self.publish({'link': 'broadcast', 'message': message})
+        return frame
+
+    def send_to_room(self, room, message):
+        """Сообщение участникам комнаты на всех узлах"""
+        frame = super().send_to_room(room, message)
+        self.publish({'link': 'room', 'room': room, 'message': message})
+        return frame
+
+    def broadcast_notice(self, message, exclude_client=None):
+        """user_joined/user_left для старых клиентов на всех узлах"""
+        frame = super().broadcast_notice(message, exclude_client)
+        self.publish({'link': 'notice', 'message': message})
+        return frame
+
+    def flush_presence(self):
+        """Публикация своих пользователей соседям и дельта своим клиентам"""
+        self.publish_presence()
+        super().flush_presence()
+
+    def usernames(self):
+        """Имена пользователей всех узлов"""
+        users = super().usernames()
+        for node_users in self.remote_users.values():
+            users.extend(node_users)
+        return users
+
+    def add_session(self, session, on_added=None):
+        """Имя должно быть свободно и на остальных узлах"""
+        if self.node_of(session.username) is not None:
+            return False
+        return super().add_session(session, on_added)
+
+    def send_private_message(self, message, target_username, sender_socket):
+        """Приватное сообщение, в том числе пользователю другого узла"""
+        if self.sessions.find(target_username) is None and self.node_of(target_username) is not None:
+            if message['type'] == 'file_offer':
+                # Файл лежит в хранилище этого узла: с другого узла его не скачать
+                self.send_system(sender_socket, f'Пользователь {target_username} на другом '
+                                 'узле: файлы передаются только в пределах узла',
+                                 error='file_remote')
+                return None
+            self.publish({'link': 'private', 'target': target_username, 'message': message})
+            # Копия отправителю, как и для своего получателя
+            frame = encode_message(message)
+            self.send_to(sender_socket, frame)
+            return frame
+        return super().send_private_message(message, target_username, sender_socket)
+
+    def show_users(self):
+        """Свои пользователи и пользователи остальных узлов"""
+        super().show_users()
+        for node in sorted(self.remote_users):
+            for username in sorted(self.remote_users[node]):
+                print(f"  - {username} (узел {node})")
+
+    def shutdown(self):
+        """Завершение работы узла: соседям уходит пустой список, прощание - только своим"""
+        self.publish({'link': 'presence', 'users': []})
+        if self.link_server is not None:
+            self.link_server.close()
+        links = list(self.links)
+        self.links.clear()
+        for writer in links:
+            writer.close()
+        super().shutdown()
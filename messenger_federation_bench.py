@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк федерации серверов мессенджера
+Запускает цепочку (или полную сеть) узлов на localhost, подключает к каждому
+узлу по получателю и измеряет задержку доставки от отправителя на первом узле
+в зависимости от числа пересылок между узлами.
+
+Пример:
+    python messenger_federation_bench.py --nodes 1 2 4 --messages 500
+    python messenger_federation_bench.py --nodes 4 --topology mesh
+
+Рассылка сравнивает получателей на разном расстоянии от отправителя
+(hops = 0 - тот же узел), приватное сообщение идет на самый дальний узел.
+"""
+
+import argparse
+import asyncio
+import json
+import shlex
+import time
+
+from messenger_loadgen import LoadClient, free_port, percentile, start_server, stop_server
+
+
+def start_nodes(count, topology, server_args=()):
+    """Запуск узлов; возвращает (порты клиентов, процессы, число пересылок до каждого узла)"""
+    ports = [free_port() for _ in range(count)]
+    link_ports = [free_port() for _ in range(count)]
+    procs = []
+    try:
+        for index in range(count):
+            if topology == 'mesh':
+                peers = link_ports[:index]
+            else:
+                peers = link_ports[index - 1:index]
+            args = ['--idle-timeout', '0', '--node-id', f'node{index}',
+                    '--link-port', str(link_ports[index]), *server_args]
+            if peers:
+                args += ['--peers', *(f'127.0.0.1:{port}' for port in peers)]
+            procs.append(start_server('asyncio', ports[index], args))
+    except BaseException:
+        for proc in procs:
+            stop_server(proc)
+        raise
+    if topology == 'mesh':
+        hops = [0] + [1] * (count - 1)
+    else:
+        hops = list(range(count))
+    return ports, procs, hops
+
+
+async def wait_users(client, names, timeout=15):
+    """Ожидание, пока клиент увидит всех пользователей федерации"""
+    users = set()
+    deadline = time.monotonic() + timeout
+    while not names <= users:
+        message = await asyncio.wait_for(client.queue.get(), deadline - time.monotonic())
+        if message['type'] == 'user_list':
+            users = set(message['users'])
+        elif message['type'] == 'presence':
+            users.update(message['added'])
+            users.difference_update(message['removed'])
+
+
+async def send_paced(client, messages, interval, make_message):
+    """Отправка messages сообщений с паузой interval между ними"""
+    for seq in range(messages):
+        client.send(make_message(f'fed {seq} {time.perf_counter()!r}'))
+        await asyncio.sleep(interval)
+
+
+def summarize(latencies):
+    """Число доставок и перцентили задержки, мс"""
+    latencies.sort()
+    return {
+        'delivered': len(latencies),
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+    }
+
+
+async def run_scenario(nodes, topology, messages, interval, grace, server_args=()):
+    """Один прогон: nodes узлов, рассылка и приватные сообщения с первого узла"""
+    ports, procs, hops = start_nodes(nodes, topology, server_args)
+    clients = []
+    try:
+        latencies = [[] for _ in range(nodes)]
+        clients = [LoadClient(f'node{index}', latencies[index]) for index in range(nodes)]
+        for client, port in zip(clients, ports):
+            await client.connect('127.0.0.1', port)
+            await client.join()
+        # Связи между узлами поднимаются уже после запуска процессов
+        for client in clients:
+            await wait_users(client, {c.username for c in clients})
+            client.queue = None
+
+        rows = []
+        base = {'nodes': nodes, 'topology': topology}
+        await send_paced(clients[0], messages, interval,
+                         lambda text: {'type': 'message', 'text': text})
+        await asyncio.sleep(grace)
+        for index in range(nodes):
+            rows.append({**base, 'kind': 'broadcast', 'hops': hops[index],
+                         **summarize(latencies[index])})
+            latencies[index].clear()
+
+        if nodes > 1:
+            target = clients[-1].username
+            await send_paced(clients[0], messages, interval,
+                             lambda text: {'type': 'private', 'target': target, 'text': text})
+            await asyncio.sleep(grace)
+            rows.append({**base, 'kind': 'private', 'hops': hops[-1], **summarize(latencies[-1])})
+        return rows
+    finally:
+        for client in clients:
+            await client.close()
+        for proc in procs:
+            stop_server(proc)
+
+
+def print_table(rows):
+    """Вывод результатов таблицей"""
+    columns = ['nodes', 'topology', 'kind', 'hops', 'delivered', 'latency_p50_ms', 'latency_p99_ms']
+    print(' | '.join(columns))
+    for row in rows:
+        print(' | '.join(str(row[c]) for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк задержки доставки между узлами федерации')
+    parser.add_argument('--nodes', nargs='+', type=int, default=[1, 2, 4], help='число узлов')
+    parser.add_argument('--topology', choices=['chain', 'mesh'], default='chain',
+                        help='chain - каждый узел связан с предыдущим, mesh - каждый с каждым')
+    parser.add_argument('--messages', type=int, default=200, help='сообщений каждого вида')
+    parser.add_argument('--interval', type=float, default=0.005,
+                        help='пауза между сообщениями, сек')
+    parser.add_argument('--grace', type=float, default=1.0,
+                        help='сколько ждать доставки после отправки, сек')
+    parser.add_argument('--server-args', default='',
+                        help='дополнительные аргументы узлов, например "--flush-window 0.002"')
+    parser.add_argument('--json', help='файл для сохранения результатов')
+    args = parser.parse_args(argv)
+
+    rows = []
+    for nodes in args.nodes:
+        print(f"[БЕНЧМАРК] {nodes} узлов, {args.topology}...")
+        rows.extend(asyncio.run(run_scenario(nodes, args.topology, args.messages, args.interval,
+                                             args.grace, shlex.split(args.server_args))))
+
+    print_table(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Передача файлов в мессенджере
+Предложение файла, согласие и отказ идут по обычному соединению чата,
+а сами байты - по отдельному соединению данных на тот же порт сервера,
+поэтому большой файл не задерживает сообщения чата.
+
+Соединение данных начинается кадром протокола вместо join:
+    file_put - {'id', 'size'}: отправитель загружает файл на сервер
+    file_get - {'id', 'offset'}: получатель забирает файл с offset
+Сервер отвечает кадром file_status {'id', 'offset', 'size'} (или 'error'),
+после чего идут сырые байты файла начиная с offset. Оборванную передачу
+продолжают новым соединением: загрузка - с того, что уже есть на сервере,
+скачивание - с размера недокачанного файла у получателя.
+
+Сервер хранит файл на диске, пока получатель его не скачает, и отдает его
+через sendfile (без копирования в память процесса). Скачивание может идти
+одновременно с загрузкой: сервер отдает то, что уже пришло, и ждет остальное.
+"""
+
+import asyncio
+import json
+import os
+import re
+import secrets
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: одновременную загрузку одного файла из разных процессов не проверяем
+    fcntl = None
+
+from messenger_protocol import encode_message
+
+CHUNK_SIZE = 256 * 1024
+# Типы первого кадра соединения данных
+TRANSFER_TYPES = frozenset(('file_put', 'file_get'))
+# Как часто скачивание проверяет, не догрузился ли файл, и сколько ждать догрузки, сек
+FOLLOW_INTERVAL = 0.05
+FOLLOW_TIMEOUT = 60.0
+# Как часто удалять просроченные файлы, сек
+SWEEP_INTERVAL = 60.0
+FILE_ID = re.compile(r'[0-9a-f]{32}')
+DEFAULT_DIR = os.path.join(tempfile.gettempdir(), 'messenger-files')
+
+
+def safe_name(name):
+    """Имя файла без каталогов, чтобы его нельзя было сохранить мимо папки"""
+    name = os.path.basename(str(name).replace('\\', '/')).strip()
+    return name[:255] or 'file'
+
+
+def format_size(size):
+    """Размер файла для людей"""
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024 or unit == 'ГБ':
+            return f'{size:.0f} {unit}' if unit == 'Б' else f'{size:.1f} {unit}'
+        size /= 1024
+
+
+class FileStore:
+    """Файлы, ожидающие получателя: данные в <id>.part, описание в <id>.json
+
+    Каталог общий для всех процессов режима sharded: загрузка может прийти
+    в один процесс, а скачивание - в другой.
+    """
+
+    def __init__(self, directory=None, max_size=100 * 1024 * 1024, ttl=24 * 3600):
+        self.directory = directory or DEFAULT_DIR
+        self.max_size = max_size
+        self.ttl = ttl
+        self.next_sweep = 0.0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, file_id, suffix='.part'):
+        """Путь к данным или описанию файла"""
+        return os.path.join(self.directory, file_id + suffix)
+
+    def create(self, sender, target, name, size):
+        """Регистрация предложенного файла; возвращает его описание"""
+        self.sweep()
+        meta = {
+            'id': secrets.token_hex(16),
+            'name': safe_name(name),
+            'size': size,
+            'sender': sender,
+            'target': target,
+            'created': time.time()
+        }
+        open(self.path(meta['id']), 'wb').close()
+        # Описание пишется целиком или не пишется: его читают другие процессы
+        tmp = self.path(meta['id'], '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, self.path(meta['id'], '.json'))
+        return meta
+
+    def meta(self, file_id):
+        """Описание файла или None"""
+        if not isinstance(file_id, str) or not FILE_ID.fullmatch(file_id):
+            return None
+        try:
+            with open(self.path(file_id, '.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def stored(self, file_id):
+        """Сколько байт файла уже загружено"""
+        try:
+            return os.path.getsize(self.path(file_id))
+        except OSError:
+            return 0
+
+    def remove(self, file_id):
+        """Удаление файла и описания"""
+        for suffix in ('.json', '.part'):
+            try:
+                os.remove(self.path(file_id, suffix))
+            except OSError:
+                pass
+
+    def sweep(self):
+        """Удаление файлов, которые так и не забрали за ttl секунд"""
+        now = time.time()
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + SWEEP_INTERVAL
+        for entry in os.listdir(self.directory):
+            file_id, suffix = os.path.splitext(entry)
+            if suffix == '.json':
+                meta = self.meta(file_id)
+                if meta is None or meta['created'] + self.ttl < now:
+                    self.remove(file_id)
+
+    def check(self, request):
+        """Описание файла из первого кадра соединения данных или текст ошибки"""
+        meta = self.meta(request.get('id'))
+        if meta is None:
+            return None, 'Файл не найден или уже получен'
+        return meta, None
+
+    # Соединение данных в режиме threaded: блокирующий сокет в своем потоке
+
+    def serve(self, sock, request, initial=b'', timeout=None):
+        """Обслуживание соединения данных; возвращает (направление, байт, файл готов)
+
+        timeout - сколько ждать байтов от молчащего клиента, сек (None - без ограничения).
+        """
+        sock.settimeout(timeout)
+        meta, error = self.check(request)
+        if error:
+            sock.sendall(status_frame(request.get('id'), error=error))
+            return request['type'], 0, False
+        if request['type'] == 'file_put':
+            return ('file_put',) + self.receive_upload(sock, meta, initial)
+        return ('file_get',) + self.send_download(sock, meta, request.get('offset', 0))
+
+    def receive_upload(self, sock, meta, initial):
+        """Прием байтов файла в memoryview буфер и запись на диск по кускам"""
+        with open(self.path(meta['id']), 'r+b') as f:
+            if not lock_file(f):
+                sock.sendall(status_frame(meta['id'], error='Файл уже загружается'))
+                return 0, False
+            offset = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            sock.sendall(status_frame(meta['id'], offset, meta['size']))
+            remaining = meta['size'] - offset
+            if initial:
+                f.write(initial[:remaining])
+                remaining -= min(len(initial), remaining)
+            buffer = memoryview(bytearray(CHUNK_SIZE))
+            while remaining > 0:
+                count = sock.recv_into(buffer, min(CHUNK_SIZE, remaining))
+                if not count:
+                    break  # обрыв: продолжат с того, что успело записаться
+                f.write(buffer[:count])
+                remaining -= count
+        return meta['size'] - remaining - offset, remaining == 0
+
+    def send_download(self, sock, meta, offset):
+        """Отдача файла через sendfile, догоняя незаконченную загрузку"""
+        offset, size = self.start_offset(meta, offset)
+        sock.sendall(status_frame(meta['id'], offset, size))
+        start = offset
+        with open(self.path(meta['id']), 'rb') as f:
+            deadline = time.monotonic() + FOLLOW_TIMEOUT
+            while offset < size:
+                available = min(os.fstat(f.fileno()).st_size, size)
+                if available <= offset:
+                    if time.monotonic() > deadline:
+                        break  # загрузка встала: получатель продолжит позже
+                    time.sleep(FOLLOW_INTERVAL)
+                    continue
+                # socket.sendfile - это os.sendfile, а где его нет - чтение кусками
+                offset += sock.sendfile(f, offset, available - offset)
+                deadline = time.monotonic() + FOLLOW_TIMEOUT
+        return offset - start, self.finish(meta, offset)
+
+    # Соединение данных в режиме asyncio: поток событий не блокируется
+
+    async def serve_async(self, reader, writer, request, initial=b'', timeout=None):
+        """Обслуживание соединения данных в цикле событий"""
+        meta, error = self.check(request)
+        if error:
+            writer.write(status_frame(request.get('id'), error=error))
+            await writer.drain()
+            return request['type'], 0, False
+        if request['type'] == 'file_put':
+            return ('file_put',) + await self.receive_upload_async(reader, writer, meta, initial,
+                                                                     timeout)
+        return ('file_get',) + await self.send_download_async(writer, meta,
+                                                                request.get('offset', 0))
+
+    async def receive_upload_async(self, reader, writer, meta, initial, timeout=None):
+        """Прием байтов файла кусками с записью на диск
+
+        Запись идет в пуле потоков цикла: медленный диск не останавливает
+        остальные соединения, а следующий кусок читается, пока пишется предыдущий.
+        """
+        loop = asyncio.get_running_loop()
+        with open(self.path(meta['id']), 'r+b') as f:
+            if not lock_file(f):
+                writer.write(status_frame(meta['id'], error='Файл уже загружается'))
+                await writer.drain()
+                return 0, False
+            offset = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            writer.write(status_frame(meta['id'], offset, meta['size']))
+            await writer.drain()
+            remaining = meta['size'] - offset
+            pending = None
+            try:
+                if initial:
+                    pending = loop.run_in_executor(None, f.write, initial[:remaining])
+                    remaining -= min(len(initial), remaining)
+                while remaining > 0:
+                    data = await asyncio.wait_for(reader.read(min(CHUNK_SIZE, remaining)),
+                                                  timeout)
+                    if not data:
+                        break
+                    if pending is not None:
+                        await pending
+                    pending = loop.run_in_executor(None, f.write, data)
+                    remaining -= len(data)
+            finally:
+                # Файл закрывается только после последней записи
+                if pending is not None:
+                    await pending
+        return meta['size'] - remaining - offset, remaining == 0
+
+    async def send_download_async(self, writer, meta, offset):
+        """Отдача файла через loop.sendfile, догоняя незаконченную загрузку"""
+        offset, size = self.start_offset(meta, offset)
+        writer.write(status_frame(meta['id'], offset, size))
+        await writer.drain()
+        start = offset
+        loop = asyncio.get_running_loop()
+        with open(self.path(meta['id']), 'rb') as f:
+            deadline = time.monotonic() + FOLLOW_TIMEOUT
+            while offset < size:
+                available = min(os.fstat(f.fileno()).st_size, size)
+                if available <= offset:
+                    if time.monotonic() > deadline:
+                        break
+                    await asyncio.sleep(FOLLOW_INTERVAL)
+                    continue
+                offset += await loop.sendfile(writer.transport, f, offset, available - offset)
+                deadline = time.monotonic() + FOLLOW_TIMEOUT
+        return offset - start, self.finish(meta, offset)
+
+    def start_offset(self, meta, offset):
+        """Проверенное место продолжения скачивания и размер файла"""
+        size = meta['size']
+        try:
+            offset = min(max(int(offset), 0), size)
+        except (TypeError, ValueError):
+            offset = 0
+        return offset, size
+
+    def finish(self, meta, offset):
+        """Файл скачан целиком - на сервере он больше не нужен"""
+        if offset < meta['size']:
+            return False
+        self.remove(meta['id'])
+        return True
+
+
+def status_frame(file_id, offset=0, size=0, error=None):
+    """Ответ сервера на первый кадр соединения данных"""
+    message = {'type': 'file_status', 'id': file_id, 'offset': offset, 'size': size}
+    if error:
+        message['error'] = error
+    return encode_message(message)
+
+
+def lock_file(f):
+    """Исключительная блокировка файла на время загрузки (между процессами тоже)"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
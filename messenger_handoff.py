@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Перезапуск сервера без простоя (только Unix)
+Новый процесс, запущенный с тем же --handoff-socket, подключается к работающему
+через Unix сокет и получает от него слушающий сокет (socket.send_fds). Очередь
+входящих подключений в ядре общая, поэтому ни одно подключение не отклоняется:
+новый процесс сразу принимает их сам, а старый перестает принимать, отдает ему
+журнал и отправляет своих клиентов переподключаться волнами.
+
+Пока старый процесс отпускает клиентов, Unix сокет остается открытым и процессы
+пересылают по нему друг другу рассылки, приватные сообщения и списки
+пользователей: чат остается общим, а записи в журнал за старый процесс делает
+новый. Сессии не передаются: клиент входит в новый процесс заново, а
+пропущенное за время переподключения видит в истории из журнала.
+
+Обмен по Unix сокету - кадры messenger_protocol с полем 'handoff':
+    request   - новый процесс просит слушающий сокет
+    socket    - ответ работающего процесса, сокет передан вместе с кадром
+    ready     - новый процесс принимает подключения
+    released  - старый процесс закрыл журнал и освободил путь Unix сокета
+Дальше, до конца передачи клиентов:
+    broadcast - сообщение для всех клиентов
+    room      - сообщение для участников комнаты
+    notice    - user_joined/user_left для клиентов без дельт присутствия
+    private   - приватное сообщение пользователю другого процесса
+    presence  - полный список пользователей процесса
+    log       - запись в журнал (его ведет только новый процесс)
+"""
+
+import os
+import socket
+import stat
+import threading
+from collections import deque
+
+from messenger_log import log
+from messenger_protocol import FrameDecoder, RECV_SIZE, decode_message, encode_message
+
+# Сколько ждать ответа другого процесса, сек
+HANDOFF_TIMEOUT = 10.0
+# Сообщений в очереди пересылки, после которых новые отбрасываются
+RELAY_QUEUE_SIZE = 65536
+
+
+class HandoffLink:
+    """Unix сокет между старым и новым процессом
+
+    Сначала - обмен кадрами передачи (send/receive), затем, после start(),
+    пересылка сообщений чата: relay() только ставит сообщение в очередь,
+    отправляет его поток-писатель, а поток-читатель вызывает on_message()
+    для сообщений другого процесса и on_close(), когда тот закрыл связь.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.received = deque()
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.on_message = None
+        self.on_close = None
+        self.writer = None
+
+    def send(self, message, fds=()):
+        """Кадр передачи, при необходимости вместе с дескрипторами"""
+        socket.send_fds(self.sock, [encode_message(message)], list(fds))
+
+    def receive(self):
+        """Следующее сообщение и дескрипторы, пришедшие вместе с ним"""
+        fds = []
+        while not self.received:
+            data, received, _, _ = socket.recv_fds(self.sock, RECV_SIZE, 1)
+            fds.extend(received)
+            if not data:
+                raise ConnectionError('Другой процесс закрыл соединение')
+            # Кадры разбираются сразу: буфер разборщика переиспользуется
+            self.received.extend(decode_message(payload) for payload in self.decoder.feed(data))
+        return self.received.popleft(), fds
+
+    def attach(self, on_message, on_close):
+        """Обработчики пересылки; до start() сообщения копятся в очереди"""
+        self.on_message = on_message
+        self.on_close = on_close
+
+    def start(self):
+        """Запуск потоков пересылки после завершения обмена кадрами передачи"""
+        self.sock.settimeout(None)
+        self.writer = threading.Thread(target=self.run_writer)
+        self.writer.daemon = True
+        self.writer.start()
+        reader = threading.Thread(target=self.run_reader)
+        reader.daemon = True
+        reader.start()
+
+    def relay(self, message):
+        """Сообщение другому процессу; при отставании связи - пропуск, а не ожидание"""
+        with self.cond:
+            if self.closed:
+                return
+            if len(self.pending) >= RELAY_QUEUE_SIZE:
+                self.dropped += 1
+                return
+            self.pending.append(message)
+            self.cond.notify()
+
+    def run_writer(self):
+        """Поток-писатель: накопившиеся сообщения одной записью"""
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                batch = list(self.pending)
+                self.pending.clear()
+                if not batch:
+                    break
+            try:
+                self.sock.sendall(b''.join(encode_message(message) for message in batch))
+            except OSError:
+                break
+        if self.dropped:
+            log.warning('ПЕРЕЗАПУСК', 'Не переслано другому процессу: %d', self.dropped)
+        try:
+            # Другой процесс дочитает все отправленное и увидит конец связи
+            self.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def run_reader(self):
+        """Поток-читатель: сообщения другого процесса до конца связи
+
+        on_close() вызывается, только если связь закрыл другой процесс.
+        """
+        try:
+            while True:
+                message, _ = self.receive()
+                self.on_message(message)
+        except (OSError, ConnectionError):
+            pass
+        except Exception as e:
+            log.error('ПЕРЕЗАПУСК', 'Ошибка пересылки между процессами: %s', e)
+        with self.cond:
+            closed_here = self.closed
+        self.close()
+        self.writer.join()
+        self.sock.close()
+        if not closed_here:
+            self.on_close()
+
+    def close(self):
+        """Конец пересылки: очередь дописывается, после чего связь закрывается"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+
+def take_over(path, timeout=HANDOFF_TIMEOUT):
+    """Слушающий сокет работающего процесса и связь с ним
+
+    Возвращает (None, None), если по пути никто не отвечает.
+    """
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    control.settimeout(timeout)
+    try:
+        control.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # Процесса нет или он упал, оставив файл сокета
+        control.close()
+        return None, None
+    link = HandoffLink(control)
+    try:
+        link.send({'handoff': 'request', 'pid': os.getpid()})
+        message, fds = link.receive()
+        if message.get('handoff') != 'socket' or not fds:
+            for fd in fds:
+                os.close(fd)
+            raise ConnectionError('Работающий процесс не передал слушающий сокет')
+        listener = socket.socket(fileno=fds[0])
+        link.send({'handoff': 'ready'})
+        # Журнал можно открывать только после того, как старый процесс его закрыл
+        message, _ = link.receive()
+        if message.get('handoff') != 'released':
+            raise ConnectionError('Работающий процесс не освободил журнал')
+    except BaseException:
+        control.close()
+        raise
+    return listener, link
+
+
+class HandoffListener:
+    """Unix сокет, через который следующий процесс заберет слушающий сокет
+
+    on_handoff(link) вызывается в потоке передачи, когда новый процесс уже
+    принимает подключения, и должен закрыть журнал до возврата; связь link
+    после этого запускается и остается у сервера до конца передачи клиентов.
+    """
+
+    def __init__(self, path, listener, on_handoff):
+        self.path = path
+        self.listener = listener
+        self.on_handoff = on_handoff
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                # Файл остался от упавшего процесса: take_over уже убедился, что он мертв
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(1)
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Ожидание нового процесса; после успешной передачи поток завершается"""
+        while True:
+            try:
+                control, _ = self.sock.accept()
+            except OSError:
+                return
+            control.settimeout(HANDOFF_TIMEOUT)
+            try:
+                if self.hand_off(HandoffLink(control)):
+                    return
+            except Exception as e:
+                log.error('ПЕРЕЗАПУСК', 'Передача сокета не удалась: %s', e)
+            control.close()
+
+    def hand_off(self, link):
+        """Передача слушающего сокета одному новому процессу"""
+        message, _ = link.receive()
+        if message.get('handoff') != 'request':
+            return False
+        log.info('ПЕРЕЗАПУСК', 'Процесс %s забирает слушающий сокет', message.get('pid'))
+        link.send({'handoff': 'socket'}, [self.listener.fileno()])
+        message, _ = link.receive()
+        if message.get('handoff') != 'ready':
+            return False
+        self.close()
+        self.on_handoff(link)
+        # Пересылка, накопленная после закрытия журнала, уходит вслед за released
+        link.send({'handoff': 'released'})
+        link.start()
+        return True
+
+    def close(self):
+        """Освобождение пути для следующего процесса"""
+        # После передачи путь уже занят новым процессом: второй раз не удаляем
+        if self.closed:
+            return
+        self.closed = True
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Ограничение частоты сообщений для сервера мессенджера
+Каждое сообщение в общий чат превращается в N отправок, поэтому один
+флудящий клиент может занять всю исходящую полосу сервера. Ведра токенов
+ограничивают число сообщений и байт от пользователя и от IP адреса, а общее
+ведро - число доставок (получателей) в секунду на весь процесс.
+
+Ведро, которое успело наполниться, ничем не отличается от отсутствующего,
+поэтому такие ведра периодически удаляются и состояние не растет без конца.
+"""
+
+import threading
+import time
+
+# Кто исчерпал лимит: сам отправитель или сервер в целом
+LIMIT_SENDER = 'sender'
+LIMIT_SERVER = 'server'
+# Как часто удалять наполнившиеся ведра, сек
+SWEEP_INTERVAL = 10.0
+
+
+class Bucket:
+    """Остаток токенов и момент, на который он посчитан"""
+
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp
+
+
+class TokenBuckets:
+    """Ведра одного вида по ключам: rate токенов в секунду, запас burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def level(self, key, now):
+        """Токенов в ведре на момент now"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return min(self.burst, bucket.tokens + (now - bucket.stamp) * self.rate)
+
+    def wait(self, key, amount, now):
+        """Сколько секунд ждать, пока в ведре хватит на amount; 0 - хватает сейчас"""
+        # Порция больше запаса проходит, когда ведро полное, и опустошает его
+        missing = min(amount, self.burst) - self.level(key, now)
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, key, amount, now):
+        """Списание amount токенов (после проверки wait)"""
+        tokens = self.level(key, now) - min(amount, self.burst)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = Bucket(tokens, now)
+        else:
+            bucket.tokens = tokens
+            bucket.stamp = now
+
+    def sweep(self, now):
+        """Удаление наполнившихся ведер"""
+        full = [key for key, bucket in self.buckets.items()
+                if bucket.tokens + (now - bucket.stamp) * self.rate >= self.burst]
+        for key in full:
+            del self.buckets[key]
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class RateLimiter:
+    """Лимиты пользователя, IP адреса и общий бюджет рассылки
+
+    Скорости - в сообщениях, байтах и доставках в секунду; 0 - без лимита.
+    Запас каждого ведра - burst секунд его скорости.
+    """
+
+    def __init__(self, user_rate=20.0, user_bytes=64 * 1024, ip_rate=100.0, ip_bytes=256 * 1024,
+                 fanout_rate=0, burst=2.0, clock=time.monotonic):
+        def buckets(rate):
+            return TokenBuckets(rate, rate * burst) if rate else None
+
+        self.user_messages = buckets(user_rate)
+        self.user_bytes = buckets(user_bytes)
+        self.ip_messages = buckets(ip_rate)
+        self.ip_bytes = buckets(ip_bytes)
+        self.fanout = buckets(fanout_rate)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.next_sweep = clock() + SWEEP_INTERVAL
+
+    def enabled(self):
+        """Задан ли хоть один лимит"""
+        return any(buckets is not None for buckets in self.all_buckets())
+
+    def all_buckets(self):
+        """Все виды ведер; None - лимит не задан"""
+        return (self.user_messages, self.user_bytes, self.ip_messages, self.ip_bytes, self.fanout)
+
+    def admit(self, user, ip, size, fanout=1):
+        """Проверка сообщения; (0.0, None) - пропустить, иначе (сколько ждать, чей лимит)"""
+        now = self.clock()
+        sender = ((self.user_messages, user, 1), (self.user_bytes, user, size),
+                  (self.ip_messages, ip, 1), (self.ip_bytes, ip, size))
+        with self.lock:
+            if now >= self.next_sweep:
+                self.sweep(now)
+            # Сначала проверяем все ведра, списываем - только если хватает во всех
+            wait = max((buckets.wait(key, amount, now)
+                        for buckets, key, amount in sender if buckets is not None), default=0.0)
+            if wait:
+                return wait, LIMIT_SENDER
+            if self.fanout is not None:
+                wait = self.fanout.wait(None, fanout, now)
+                if wait:
+                    return wait, LIMIT_SERVER
+                self.fanout.take(None, fanout, now)
+            for buckets, key, amount in sender:
+                if buckets is not None:
+                    buckets.take(key, amount, now)
+        return 0.0, None
+
+    def sweep(self, now):
+        """Удаление состояния пользователей и адресов, которые давно молчат"""
+        for buckets in self.all_buckets():
+            if buckets is not None:
+                buckets.sweep(now)
+        self.next_sweep = now + SWEEP_INTERVAL
+
+    def size(self):
+        """Число хранимых ведер"""
+        return sum(len(buckets) for buckets in self.all_buckets() if buckets is not None)
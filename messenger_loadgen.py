@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+Генератор нагрузки для сервера мессенджера
+Без графического интерфейса открывает тысячи пользователей в одном процессе
+и гоняет заданную смесь общих сообщений, приватных сообщений и переподключений.
+Задержка доставки считается по отметке времени, вложенной в текст сообщения.
+
+Пример:
+    python messenger_loadgen.py --spawn asyncio --users 1000 --rate 200 --duration 30 \\
+        --mix broadcast=0.8,private=0.15,churn=0.05 --json result.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from messenger_protocol import (ENCODING_JSON, ENCODINGS, FrameDecoder, MARK_BINARY, RECV_SIZE,
+                                TYPES, WireFormat)
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'messenger_server.py')
+
+# Начало JSON кадра: сервер всегда ставит 'type' первым ключом
+TYPE_PREFIX = b'{"type": "'
+
+# Повторный вход при переподключении: сервер может еще держать прошлую сессию с тем же именем
+CHURN_RETRIES = 10
+CHURN_RETRY_DELAY = 0.05
+
+
+def free_port():
+    """Поиск свободного TCP порта"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def raise_fd_limit():
+    """Поднимаем лимит открытых файлов до максимума"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def child_pids(pid):
+    """Дочерние процессы (для режима sharded)"""
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def process_stats(pid):
+    """Память (КБ) и число потоков процесса вместе с дочерними, из /proc"""
+    stats = {'rss_kb': None, 'threads': None}
+    for p in [pid] + child_pids(pid):
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        stats['rss_kb'] = (stats['rss_kb'] or 0) + int(line.split()[1])
+                    elif line.startswith('Threads:'):
+                        stats['threads'] = (stats['threads'] or 0) + int(line.split()[1])
+        except OSError:
+            pass
+    return stats
+
+
+def percentile(values, p):
+    """Перцентиль по отсортированному списку"""
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def start_server(mode, port, extra_args=(), stdout=subprocess.DEVNULL):
+    """Запуск сервера в отдельном процессе и ожидание готовности порта"""
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, '--mode', mode, '--host', '127.0.0.1',
+         '--port', str(port), '--backlog', '1024', '--no-console',
+         # Нагрузка идет с одного адреса и заведомо быстрее живых людей
+         '--rate-limits', 'off', *extra_args],
+        stdin=subprocess.DEVNULL, stdout=stdout, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f'Сервер {mode} не запустился на порту {port}')
+
+
+def stop_server(proc):
+    """Остановка процесса сервера"""
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def peek_type(payload):
+    """Тип сообщения без полного разбора нагрузки; None, если не удалось"""
+    if len(payload) > 1 and payload[0] == MARK_BINARY:
+        tag = payload[1]
+        return TYPES[tag - 1] if 0 < tag <= len(TYPES) else None
+    head = bytes(payload[:48])
+    if head.startswith(TYPE_PREFIX):
+        end = head.find(b'"', len(TYPE_PREFIX))
+        if end != -1:
+            return head[len(TYPE_PREFIX):end].decode('ascii', 'replace')
+    return None
+
+
+def sent_at(text):
+    """Отметка времени отправки - последнее слово текста"""
+    return float(text.rsplit(' ', 1)[1])
+
+
+class LoadClient:
+    """Безголовый клиент протокола мессенджера
+
+    latencies - общий список, куда пишутся задержки доставки сообщений;
+    wanted - типы сообщений, которые нужно разбирать (None - все);
+    keep_queue - складывать ли разобранные сообщения в self.queue;
+    encoding, compress - кодировка, которую клиент предложит при входе.
+    """
+
+    def __init__(self, username, latencies=None, wanted=None, keep_queue=True,
+                 encoding=ENCODING_JSON, compress=False):
+        self.username = username
+        self.encoding = encoding
+        self.compress = compress
+        self.wire = WireFormat()
+        self.latencies = latencies
+        self.wanted = wanted
+        self.queue = asyncio.Queue() if keep_queue else None
+        self.reader = None
+        self.writer = None
+        self.decoder = None
+        self.reader_task = None
+        self.joined = None
+        self.rejected = None
+        self.received = 0
+        self.bytes_received = 0
+
+    async def connect(self, host, port):
+        """Открытие TCP соединения"""
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.decoder = FrameDecoder()
+
+    async def join(self, timeout=30):
+        """Вход в чат и ожидание подтверждения"""
+        self.joined = asyncio.Event()
+        self.send({'type': 'join', 'username': self.username,
+                   'encodings': [self.encoding], 'compress': self.compress,
+                   'presence': True, 'heartbeat': True})
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+        await asyncio.wait_for(self.joined.wait(), timeout)
+        if self.rejected:
+            raise ConnectionRefusedError(self.rejected)
+
+    def send(self, message):
+        """Отправка сообщения серверу"""
+        self.writer.write(self.wire.encode(message))
+
+    async def read_loop(self):
+        """Чтение кадров от сервера"""
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                # Задержку считаем в момент получения, а не разбора очереди
+                received_at = time.perf_counter()
+                self.bytes_received += len(data)
+                for payload in self.decoder.feed(data):
+                    message_type = peek_type(payload)
+                    if message_type == 'ping':
+                        # Иначе сервер отключит молчащего клиента по простою
+                        self.send({'type': 'pong'})
+                        continue
+                    # Таблицу имен разбираем всегда: на нее ссылаются другие сообщения
+                    if self.wanted is not None and message_type is not None \
+                            and message_type not in self.wanted and message_type != 'names':
+                        continue
+                    self.handle(self.wire.decode(payload), received_at)
+        except (ConnectionError, OSError):
+            pass
+
+    def handle(self, message, received_at):
+        """Учет полученного сообщения"""
+        if message['type'] == 'system':
+            if message.get('error') and not self.joined.is_set():
+                # Отказ во входе, например имя еще занято прошлым подключением
+                self.rejected = message['message']
+            elif 'encoding' in message and not self.joined.is_set():
+                # Подтверждение входа: дальше сервер пишет в выбранной кодировке
+                self.wire = WireFormat(message['encoding'], message['compress'], self.wire.names)
+            self.joined.set()
+        elif message['type'] in ('message', 'private', 'room_message'):
+            self.received += 1
+            if self.latencies is not None:
+                try:
+                    self.latencies.append(received_at - sent_at(message['text']))
+                except (ValueError, IndexError):
+                    pass
+        if self.queue is not None:
+            self.queue.put_nowait(message)
+
+    async def close(self):
+        """Закрытие соединения"""
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, asyncio.CancelledError):
+                pass
+
+
+def parse_mix(text):
+    """Разбор смеси действий вида broadcast=0.8,private=0.15,churn=0.05"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ('broadcast', 'private', 'churn'):
+            raise ValueError(f'Неизвестное действие: {name}')
+        mix[name] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise ValueError('Смесь действий пуста')
+    return mix
+
+
+class LoadGenerator:
+    """Открытая нагрузка: действия идут с заданной частотой, не дожидаясь доставки"""
+
+    def __init__(self, host, port, users, rate, duration, mix, connect_concurrency=200,
+                 grace=2.0, seed=None, encoding=ENCODING_JSON, compress=False):
+        self.host = host
+        self.port = port
+        self.users = users
+        self.rate = rate
+        self.duration = duration
+        self.mix = mix
+        self.connect_concurrency = connect_concurrency
+        self.grace = grace
+        self.encoding = encoding
+        self.compress = compress
+        self.random = random.Random(seed)
+        self.latencies = []
+        self.clients = []
+        self.churning = set()
+        self.counts = {'broadcast': 0, 'private': 0, 'churn': 0}
+        self.expected = 0
+        self.errors = 0
+        self.seq = 0
+        self.bytes_received = 0  # байты отключившихся при переподключении клиентов
+
+    def new_client(self, index):
+        """Клиент нагрузки: разбираем только то, что нужно для подсчета"""
+        return LoadClient(f'lg{index}', self.latencies,
+                          wanted={'system', 'message', 'private'}, keep_queue=False,
+                          encoding=self.encoding, compress=self.compress)
+
+    async def connect_all(self):
+        """Подключение и вход всех пользователей"""
+        semaphore = asyncio.Semaphore(self.connect_concurrency)
+
+        async def one(index):
+            client = self.new_client(index)
+            async with semaphore:
+                try:
+                    await client.connect(self.host, self.port)
+                    await client.join()
+                    return client
+                except (OSError, asyncio.TimeoutError):
+                    self.errors += 1
+                    await client.close()
+                    return None
+
+        results = await asyncio.gather(*(one(i) for i in range(self.users)))
+        self.clients = [c for c in results if c is not None]
+
+    def text(self):
+        """Текст сообщения с номером и отметкой времени"""
+        self.seq += 1
+        return f'lg {self.seq} {time.perf_counter()!r}'
+
+    def live_clients(self):
+        """Подключенные пользователи, не находящиеся в переподключении"""
+        return [i for i in range(len(self.clients)) if i not in self.churning]
+
+    async def churn(self, index):
+        """Выход и повторный вход пользователя (индекс уже отмечен в churning)"""
+        try:
+            await self.clients[index].close()
+            self.bytes_received += self.clients[index].bytes_received
+            for attempt in range(CHURN_RETRIES):
+                client = self.new_client(index)
+                await client.connect(self.host, self.port)
+                try:
+                    await client.join()
+                    break
+                except ConnectionRefusedError:
+                    # Сервер еще не заметил закрытие прошлого соединения с этим именем
+                    await client.close()
+                    await asyncio.sleep(CHURN_RETRY_DELAY)
+            else:
+                raise ConnectionRefusedError(f'{client.username}: имя занято')
+            self.clients[index] = client
+        except (OSError, asyncio.TimeoutError):
+            self.errors += 1
+        finally:
+            self.churning.discard(index)
+
+    def act(self, live):
+        """Одно случайное действие по весам смеси"""
+        action = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        sender = self.random.choice(live)
+        self.counts[action] += 1
+        try:
+            if action == 'broadcast':
+                self.clients[sender].send({'type': 'message', 'text': self.text()})
+                self.expected += len(live)
+            elif action == 'private':
+                target = self.random.choice(live)
+                self.clients[sender].send({'type': 'private', 'target': f'lg{target}',
+                                           'text': self.text()})
+                # Получатель и копия отправителю
+                self.expected += 2
+            elif sender not in self.churning:
+                # Отмечаем сразу: иначе тот же клиент может попасть в churn дважды
+                # до запуска задачи и войти с одним именем из двух соединений
+                self.churning.add(sender)
+                asyncio.ensure_future(self.churn(sender))
+        except (ConnectionError, OSError, AttributeError):
+            self.errors += 1
+
+    async def run(self):
+        """Прогон нагрузки; возвращает словарь результатов"""
+        connect_started = time.perf_counter()
+        await self.connect_all()
+        connect_seconds = time.perf_counter() - connect_started
+        # Сообщения, пришедшие во время входа, не считаем
+        self.latencies.clear()
+
+        started = time.perf_counter()
+        done = 0
+        while True:
+            elapsed = time.perf_counter() - started
+            if elapsed >= self.duration:
+                break
+            due = int(elapsed * self.rate)
+            live = self.live_clients()
+            while done < due and live:
+                self.act(live)
+                done += 1
+            await asyncio.sleep(0.002)
+        send_seconds = time.perf_counter() - started
+
+        await asyncio.sleep(self.grace)
+        latencies = sorted(self.latencies)
+        for client in self.clients:
+            await client.close()
+            self.bytes_received += client.bytes_received
+
+        def ms(value):
+            return round(value * 1000, 3) if value is not None else None
+
+        return {
+            'users': self.users,
+            'connected': len(self.clients),
+            'connect_seconds': round(connect_seconds, 3),
+            'duration_seconds': round(send_seconds, 3),
+            'actions': dict(self.counts),
+            'sent_per_second': round(sum(self.counts.values()) / send_seconds, 1),
+            'delivered': len(latencies),
+            'expected_deliveries': self.expected,
+            'delivery_ratio': round(len(latencies) / self.expected, 4) if self.expected else None,
+            'delivered_per_second': round(len(latencies) / send_seconds, 1),
+            'latency_p50_ms': ms(percentile(latencies, 50)),
+            'latency_p99_ms': ms(percentile(latencies, 99)),
+            'latency_p999_ms': ms(percentile(latencies, 99.9)),
+            'latency_max_ms': ms(latencies[-1] if latencies else None),
+            'bytes_received': self.bytes_received,
+            'errors': self.errors,
+        }
+
+
+def git_revision():
+    """Версия кода сервера для сравнения прогонов"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(SERVER_SCRIPT), capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Генератор нагрузки для сервера мессенджера')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--spawn', metavar='MODE',
+                        help='запустить локальный сервер в режиме MODE на свободном порту')
+    parser.add_argument('--server-args', default='', help='дополнительные аргументы для --spawn')
+    parser.add_argument('--users', type=int, default=200, help='число пользователей')
+    parser.add_argument('--rate', type=float, default=100.0, help='действий в секунду')
+    parser.add_argument('--duration', type=float, default=10.0, help='длительность, сек')
+    parser.add_argument('--mix', default='broadcast=0.8,private=0.15,churn=0.05',
+                        help='веса действий broadcast, private, churn')
+    parser.add_argument('--grace', type=float, default=2.0,
+                        help='сколько ждать доставки после окончания отправки, сек')
+    parser.add_argument('--seed', type=int, help='зерно генератора случайных чисел')
+    parser.add_argument('--encoding', choices=ENCODINGS, default=ENCODING_JSON,
+                        help='кодировка, которую клиенты предлагают при входе')
+    parser.add_argument('--compress', action='store_true', help='сжимать большие кадры')
+    parser.add_argument('--label', help='метка прогона, например версия сервера')
+    parser.add_argument('--json', help='файл для сохранения результатов')
+    args = parser.parse_args(argv)
+
+    raise_fd_limit()
+    proc = None
+    host, port = args.host, args.port
+    if args.spawn:
+        host, port = '127.0.0.1', free_port()
+        proc = start_server(args.spawn, port, shlex.split(args.server_args))
+    try:
+        generator = LoadGenerator(host, port, args.users, args.rate, args.duration,
+                                  parse_mix(args.mix), grace=args.grace, seed=args.seed,
+                                  encoding=args.encoding, compress=args.compress)
+        results = asyncio.run(generator.run())
+        if proc is not None:
+            results['server'] = process_stats(proc.pid)
+    finally:
+        if proc is not None:
+            stop_server(proc)
+
+    report = {
+        'label': args.label,
+        'revision': git_revision(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'spawn': args.spawn,
+            'server_args': args.server_args,
+            'users': args.users,
+            'rate': args.rate,
+            'duration': args.duration,
+            'mix': args.mix,
+            'encoding': args.encoding,
+            'compress': args.compress,
+        },
+        'results': results,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Журнал событий сервера мессенджера
+Обработчики клиентов не пишут в консоль сами: запись (время, уровень, тег,
+шаблон и аргументы) кладется в буфер, а фоновый поток раз в FLUSH_INTERVAL
+форматирует все накопившееся и выводит одной записью. Медленный терминал,
+канал или диск тормозит только этот поток, а не рассылку.
+
+Пример:
+    from messenger_log import log
+    log.info('СООБЩЕНИЕ', '%s: %s', username, text)
+
+Если поток не успевает, буфер растет до BUFFER_SIZE записей: после половины
+записи ниже WARNING сохраняются выборочно (одна из SAMPLE_EVERY), в полном
+буфере новые записи отбрасываются. Сколько пропущено, пишется в сам журнал.
+
+В консоль записи выводятся как прежде ('[ТЕГ] текст'), в файл - с датой,
+временем и уровнем; файл переименовывается в .1, .2, ... по достижении max_bytes.
+"""
+
+import atexit
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
+# Записей в буфере, после которых новые отбрасываются
+BUFFER_SIZE = 65536
+# Как часто фоновый поток выводит накопившееся, сек
+FLUSH_INTERVAL = 0.05
+# При заполнении буфера наполовину - одна запись ниже WARNING из стольких
+SAMPLE_EVERY = 10
+
+
+class EventLog:
+    """Буфер записей и поток, который их выводит"""
+
+    def __init__(self):
+        self.level = INFO
+        self.path = None            # None - вывод в консоль
+        self.max_bytes = 10 * 1024 * 1024
+        self.backups = 5
+        # sync - писать сразу в вызывающем потоке, как print (ничего не теряется)
+        self.sync = False
+        self.capacity = BUFFER_SIZE
+        self.records = deque()      # append и popleft безопасны без замка
+        self.dropped = 0            # счетчики без замка: при гонке возможна малая неточность
+        self.reported = 0
+        self.sampled = 0
+        self.file = None
+        self.size = 0
+        self.lock = threading.Lock()    # вывод и открытие файла
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def configure(self, level='info', path=None, max_bytes=10 * 1024 * 1024, backups=5,
+                  sync=False, capacity=BUFFER_SIZE):
+        """Настройка до начала работы сервера"""
+        if level not in LEVELS:
+            raise ValueError(f'Неизвестный уровень журнала: {level}')
+        self.flush()
+        with self.lock:
+            self.level = LEVELS[level]
+            self.max_bytes = max_bytes
+            self.backups = backups
+            self.sync = sync
+            self.capacity = capacity
+            self.set_path(path)
+
+    def reopen(self, path):
+        """Вывод в другой файл (например, свой у каждого процесса sharded)"""
+        self.flush()
+        with self.lock:
+            self.set_path(path)
+
+    def set_path(self, path):
+        """Смена файла; вызывается под self.lock"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.path = path
+
+    def enabled(self, level):
+        """Будет ли записано сообщение уровня level"""
+        return level >= self.level
+
+    def debug(self, tag, text, *args):
+        self.emit(DEBUG, tag, text, args)
+
+    def info(self, tag, text, *args):
+        self.emit(INFO, tag, text, args)
+
+    def warning(self, tag, text, *args):
+        self.emit(WARNING, tag, text, args)
+
+    def error(self, tag, text, *args):
+        self.emit(ERROR, tag, text, args)
+
+    def emit(self, level, tag, text, args):
+        """Запись в буфер; текст собирается из шаблона уже в фоновом потоке"""
+        if level < self.level:
+            return
+        record = (time.time(), level, tag, text, args)
+        if self.sync:
+            self.flush(record)
+            return
+        pending = len(self.records)
+        if pending >= self.capacity // 2 and level < WARNING:
+            self.sampled += 1
+            if self.sampled % SAMPLE_EVERY:
+                self.dropped += 1
+                return
+        if pending >= self.capacity:
+            self.dropped += 1
+            return
+        self.records.append(record)
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        """Запуск фонового потока при первой записи"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        """Фоновый поток: вывод накопившегося раз в FLUSH_INTERVAL"""
+        while not self.stopping.wait(FLUSH_INTERVAL):
+            self.flush()
+        self.flush()
+
+    def flush(self, record=None):
+        """Вывод всех накопившихся записей (и record после них) одной операцией
+
+        Пачка забирается и выводится под одним замком: flush зовут фоновый
+        поток, configure/reopen/close и запись в режиме sync, и пачки не
+        должны перемешаться.
+        """
+        with self.lock:
+            batch = []
+            records = self.records
+            while records:
+                batch.append(records.popleft())
+            dropped = self.dropped - self.reported
+            if dropped:
+                self.reported += dropped
+                batch.append((time.time(), WARNING, 'ЖУРНАЛ',
+                              'Пропущено записей при перегрузке: %d', (dropped,)))
+            if record is not None:
+                batch.append(record)
+            if batch:
+                self.write(batch)
+
+    def write(self, batch):
+        """Форматирование и вывод пачки; вызывается под self.lock"""
+        try:
+            if self.path is None:
+                sys.stdout.write(''.join(self.format_console(r) for r in batch))
+                sys.stdout.flush()
+                return
+            lines = [self.format_file(r).encode('utf-8') for r in batch]
+            if self.file is None:
+                self.file = open(self.path, 'ab')
+                self.size = self.file.tell()
+            # Пачка пишется кусками, чтобы ни один файл не превысил max_bytes
+            start = 0
+            pending = 0
+            for end, line in enumerate(lines):
+                filled = self.size + pending
+                if self.max_bytes and filled and filled + len(line) > self.max_bytes:
+                    self.file.write(b''.join(lines[start:end]))
+                    self.rotate()
+                    start = end
+                    pending = 0
+                pending += len(line)
+            self.file.write(b''.join(lines[start:]))
+            self.file.flush()
+            self.size += pending
+        except (OSError, ValueError):
+            # Консоль закрыта или диск заполнен: сервер продолжает работать без журнала
+            pass
+
+    def rotate(self):
+        """Переименование файла в .1 (старые сдвигаются) и новый файл"""
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            older = f'{self.path}.{index}'
+            if os.path.exists(older):
+                os.replace(older, f'{self.path}.{index + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def format_console(self, record):
+        """Строка для консоли в прежнем виде"""
+        _, _, tag, text, args = record
+        return f'[{tag}] {render(text, args)}\n'
+
+    def format_file(self, record):
+        """Строка файла: дата, время, уровень, тег и текст"""
+        when, level, tag, text, args = record
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+        millis = int(when % 1 * 1000)
+        return f'{stamp}.{millis:03d} {LEVEL_NAMES[level]:<7} [{tag}] {render(text, args)}\n'
+
+    def close(self):
+        """Остановка потока с выводом остатка; дальше записи выводятся сразу"""
+        self.sync = True
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            self.stopping.set()
+            thread.join(timeout=1.0)
+        self.flush()
+        with self.lock:
+            self.set_path(self.path)
+
+    def after_fork(self):
+        """В дочернем процессе потока-писателя нет: он запустится заново"""
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        # Эти записи выведет родительский процесс
+        self.records.clear()
+
+
+def render(text, args):
+    """Подстановка аргументов; ошибка шаблона не должна терять запись"""
+    if not args:
+        return text
+    try:
+        return text % args
+    except (TypeError, ValueError):
+        return f'{text} {args!r}'
+
+
+# Общий журнал процесса
+log = EventLog()
+atexit.register(log.close)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=log.after_fork)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк журнала событий сервера
+Сравнивает пропускную способность сервера без журнала, с прежней синхронной
+записью в консоль (--log-sync), с фоновой записью в консоль и в файл.
+Консоль - канал, который читается не быстрее --console-rate байт в секунду,
+как медленный терминал или перегруженный сборщик логов.
+
+Пример:
+    python messenger_log_bench.py --modes asyncio threaded --rate 1000 --console-rate 16384
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from messenger_loadgen import (LoadGenerator, free_port, parse_mix, raise_fd_limit,
+                               start_server, stop_server)
+
+# Размер одного чтения из канала консоли, байт
+READ_SIZE = 4096
+
+
+def scenarios(log_dir):
+    """Варианты журнала: (название, аргументы сервера, вывод в медленную консоль)"""
+    return [
+        ('off', ['--log-level', 'warning'], True),
+        ('sync-console', ['--log-sync'], True),
+        ('async-console', [], True),
+        ('async-file', ['--log-file', os.path.join(log_dir, 'server.log')], False),
+    ]
+
+
+def drain_slowly(pipe, rate, counter, done):
+    """Чтение канала консоли не быстрее rate байт в секунду; после done - сразу до конца"""
+    while True:
+        data = os.read(pipe.fileno(), READ_SIZE)
+        if not data:
+            return
+        counter[0] += len(data)
+        if not done.is_set():
+            time.sleep(len(data) / rate)
+
+
+def run_scenario(mode, name, server_args, slow_console, args):
+    """Один прогон нагрузки; возвращает строку результатов"""
+    port = free_port()
+    stdout = subprocess.PIPE if slow_console else subprocess.DEVNULL
+    proc = start_server(mode, port, ['--idle-timeout', '0', *server_args], stdout=stdout)
+    console_bytes = [0]
+    done = threading.Event()
+    reader = None
+    if slow_console:
+        reader = threading.Thread(target=drain_slowly,
+                                  args=(proc.stdout, args.console_rate, console_bytes, done))
+        reader.daemon = True
+        reader.start()
+    try:
+        generator = LoadGenerator('127.0.0.1', port, args.users, args.rate, args.duration,
+                                  parse_mix(args.mix), grace=args.grace)
+        results = asyncio.run(generator.run())
+    finally:
+        # Остаток консоли дочитываем без задержек, иначе сервер не сможет завершиться
+        done.set()
+        stop_server(proc)
+        if reader is not None:
+            reader.join()
+            proc.stdout.close()
+    return {
+        'mode': mode,
+        'log': name,
+        'sent_per_second': results['sent_per_second'],
+        'delivered_per_second': results['delivered_per_second'],
+        'delivery_ratio': results['delivery_ratio'],
+        'latency_p50_ms': results['latency_p50_ms'],
+        'latency_p99_ms': results['latency_p99_ms'],
+        'console_kb': round(console_bytes[0] / 1024, 1),
+    }
+
+
+def print_table(rows):
+    """Вывод результатов таблицей"""
+    columns = ['mode', 'log', 'sent_per_second', 'delivered_per_second', 'delivery_ratio',
+               'latency_p50_ms', 'latency_p99_ms', 'console_kb']
+    print(' | '.join(columns))
+    for row in rows:
+        print(' | '.join(str(row[c]) for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк журнала событий сервера')
+    parser.add_argument('--modes', nargs='+', default=['asyncio', 'threaded'])
+    parser.add_argument('--users', type=int, default=50, help='число пользователей')
+    parser.add_argument('--rate', type=float, default=1000.0, help='сообщений в секунду')
+    parser.add_argument('--duration', type=float, default=10.0, help='длительность, сек')
+    parser.add_argument('--mix', default='broadcast=0.9,private=0.1',
+                        help='веса действий broadcast, private, churn')
+    parser.add_argument('--grace', type=float, default=2.0,
+                        help='сколько ждать доставки после окончания отправки, сек')
+    parser.add_argument('--console-rate', type=int, default=16 * 1024,
+                        help='скорость чтения консоли сервера, байт в секунду')
+    parser.add_argument('--json', help='файл для сохранения результатов')
+    args = parser.parse_args(argv)
+
+    raise_fd_limit()
+    rows = []
+    with tempfile.TemporaryDirectory(prefix='messenger-log-') as log_dir:
+        for mode in args.modes:
+            for name, server_args, slow_console in scenarios(log_dir):
+                print(f"[БЕНЧМАРК] {mode}, журнал {name}...")
+                rows.append(run_scenario(mode, name, server_args, slow_console, args))
+
+    print_table(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Метрики сервера мессенджера
+Счетчики и гистограммы задержек с дешевым обновлением на горячем пути,
+показатели (gauge), которые вычисляются только при чтении,
+и HTTP выдача в текстовом формате Prometheus.
+"""
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин гистограмм задержек, сек
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Counter:
+    """Монотонный счетчик"""
+
+    __slots__ = ('name', 'help', 'value', 'lock')
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} counter',
+                f'{self.name} {self.value}']
+
+
+class Gauge:
+    """Показатель, который вычисляется функцией в момент чтения"""
+
+    __slots__ = ('name', 'help', 'func')
+
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    @property
+    def value(self):
+        try:
+            return self.func()
+        except Exception:
+            # Метрики не должны ронять сервер
+            return float('nan')
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} gauge',
+                f'{self.name} {self.value}']
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами"""
+
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, func):
+        metric = Gauge(name, help_text, func)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render_prometheus(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Краткая сводка для консоли"""
+        lines = []
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                p50, p99 = metric.quantile(0.5), metric.quantile(0.99)
+                lines.append(f"  {metric.name}: {metric.count} шт., "
+                             f"p50 <= {format_seconds(p50)}, p99 <= {format_seconds(p99)}")
+            else:
+                lines.append(f"  {metric.name}: {metric.value}")
+        return '\n'.join(lines)
+
+
+def format_seconds(value):
+    """Секунды в удобочитаемом виде"""
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return 'inf'
+    if value < 0.001:
+        return f'{value * 1e6:.0f} мкс'
+    if value < 1:
+        return f'{value * 1000:.1f} мс'
+    return f'{value:.2f} с'
+
+
+class ServerMetrics:
+    """Метрики горячего пути ChatServer"""
+
+    def __init__(self, registry=None):
+        self.registry = registry or MetricsRegistry()
+        r = self.registry
+        self.started = time.time()
+        self.messages_in = r.counter('messenger_messages_in_total', 'Принято сообщений от клиентов')
+        self.bytes_in = r.counter('messenger_bytes_in_total', 'Принято байт от клиентов')
+        self.messages_out = r.counter('messenger_messages_out_total', 'Отправлено кадров клиентам')
+        self.bytes_out = r.counter('messenger_bytes_out_total', 'Отправлено байт клиентам')
+        self.writes = r.counter('messenger_writes_total', 'Системных вызовов записи в сокеты')
+        self.send_failures = r.counter('messenger_send_failures_total',
+                                       'Ошибок отправки и отключений медленных клиентов')
+        self.dropped = r.counter('messenger_dropped_total', 'Кадров выброшено из переполненных очередей')
+        self.connections = r.counter('messenger_connections_total', 'Принято подключений')
+        self.disconnections = r.counter('messenger_disconnections_total', 'Отключилось пользователей')
+        self.reaped = r.counter('messenger_reaped_total', 'Соединений закрыто по простою')
+        self.resumed = r.counter('messenger_resumed_total', 'Сессий продолжено после обрыва')
+        self.drained = r.counter('messenger_drained_total',
+                                 'Клиентов отправлено к новому процессу при перезапуске')
+        self.throttled = r.counter('messenger_throttled_total', 'Сообщений отклонено лимитами частоты')
+        self.file_bytes_in = r.counter('messenger_file_bytes_in_total', 'Получено байт файлов')
+        self.file_bytes_out = r.counter('messenger_file_bytes_out_total', 'Отправлено байт файлов')
+        self.files_delivered = r.counter('messenger_files_delivered_total', 'Файлов получено целиком')
+        self.handle_seconds = r.histogram('messenger_handle_seconds',
+                                          'Время обработки одного входящего сообщения')
+        self.fanout_seconds = r.histogram('messenger_fanout_seconds',
+                                          'Время постановки рассылки во все очереди')
+        self.private_seconds = r.histogram('messenger_private_seconds',
+                                           'Время доставки приватного сообщения в очереди')
+        self.search_seconds = r.histogram('messenger_search_seconds',
+                                          'Время выполнения поискового запроса')
+        r.gauge('messenger_uptime_seconds', 'Время работы сервера', lambda: round(time.time() - self.started))
+
+    def record_write(self, batch):
+        """Пачка кадров ушла в сокет одной записью"""
+        self.writes.inc()
+        self.messages_out.inc(len(batch))
+        self.bytes_out.inc(sum(map(len, batch)))
+
+    def record_drop(self, count):
+        """Кадры выброшены из переполненной очереди"""
+        self.dropped.inc(count)
+
+    def record_eviction(self, pending):
+        """Медленный или отвалившийся клиент отключен вместе с его очередью"""
+        self.send_failures.inc()
+        if pending:
+            self.dropped.inc(pending)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Отдача /metrics"""
+
+    registry = None
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Запросы сборщика метрик не засоряют консоль
+        pass
+
+
+def start_http_server(registry, host='127.0.0.1', port=9555):
+    """HTTP сервер метрик в фоновом потоке"""
+    handler = type('BoundMetricsHandler', (MetricsHandler,), {'registry': registry})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
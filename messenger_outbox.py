@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Исходящие очереди подключений
+У каждого клиента своя ограниченная очередь кадров и свой писатель,
+поэтому медленный получатель не задерживает рассылку остальным.
+Писатель забирает все накопившиеся кадры и отправляет их одной
+векторной записью (sendmsg / writelines).
+
+Номер кадра - его порядковый номер в потоке соединения (frames_sent после
+его отправки). Очередь с replay > 0 помнит столько последних отправленных
+кадров, чтобы клиент после обрыва получил ровно то, что не успел прочитать.
+"""
+
+import asyncio
+import socket
+import threading
+import time
+from collections import deque
+
+# Что делать, когда очередь клиента заполнена
+DROP_OLDEST = 'drop_oldest'   # выбросить самый старый кадр
+DISCONNECT = 'disconnect'     # отключить медленного клиента
+BLOCK = 'block'               # притормозить отправителя до освобождения места
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+# Кадров в одной векторной записи (IOV_MAX в Linux - 1024)
+MAX_BATCH = 512
+
+# Сколько ждать дописывания остатка при закрытии очереди, сек
+CLOSE_TIMEOUT = 1.0
+
+
+def send_vectored(sock, buffers):
+    """Отправка списка буферов целиком, по возможности одним sendmsg"""
+    if not hasattr(sock, 'sendmsg'):
+        # На Windows sendmsg нет
+        sock.sendall(b''.join(buffers))
+        return
+    views = [memoryview(b) for b in buffers]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + MAX_BATCH])
+        # Пропускаем полностью отправленные буферы, остаток дописываем
+        while index < len(views) and sent >= len(views[index]):
+            sent -= len(views[index])
+            index += 1
+        if sent:
+            views[index] = views[index][sent:]
+
+
+def set_nodelay(sock):
+    """Отключение алгоритма Нейгла: склейку кадров делает сам писатель"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+
+def set_keepalive(sock, idle, count=3):
+    """TCP keepalive: ядро само проверит молчащее соединение через idle секунд"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            interval = max(1, int(idle) // count)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except (OSError, AttributeError):
+        pass
+
+
+class Outbox:
+    """Очередь кадров с потоком-писателем для блокирующего сокета"""
+
+    def __init__(self, sock, maxsize=1000, policy=DISCONNECT, block_timeout=5.0,
+                 flush_window=0.0, metrics=None, replay=0):
+        if policy not in POLICIES:
+            raise ValueError(f'Неизвестная политика очереди: {policy}')
+        self.sock = sock
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        # Сколько подождать после первого кадра, чтобы собрать пачку, сек
+        self.flush_window = flush_window
+        # ServerMetrics сервера, если он их ведет
+        self.metrics = metrics
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.frames_sent = 0
+        self.writes = 0
+        # Последние отправленные кадры для досылки после обрыва; None - не храним
+        self.history = deque(maxlen=replay) if replay else None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def depth(self):
+        """Число кадров, ожидающих отправки"""
+        return len(self.items)
+
+    def put(self, data):
+        """Постановка кадра в очередь согласно политике"""
+        with self.cond:
+            if self.closed:
+                raise ConnectionError('Очередь клиента закрыта')
+            if len(self.items) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped += 1
+                    if self.metrics is not None:
+                        self.metrics.record_drop(1)
+                elif self.policy == BLOCK:
+                    # Отправитель ждет, пока писатель освободит место
+                    has_space = self.cond.wait_for(
+                        lambda: self.closed or len(self.items) < self.maxsize,
+                        self.block_timeout)
+                    if self.closed:
+                        raise ConnectionError('Очередь клиента закрыта')
+                    if not has_space:
+                        self.evict()
+                        return
+                else:
+                    self.evict()
+                    return
+            self.items.append(data)
+            self.cond.notify_all()
+
+    def extend(self, frames):
+        """Постановка кадров без учета лимита (досылка пропущенного после обрыва)"""
+        with self.cond:
+            self.items.extend(frames)
+            self.cond.notify_all()
+
+    def run(self):
+        """Поток-писатель: отправка накопившихся кадров пачками"""
+        while True:
+            with self.cond:
+                while not self.items and not self.closed:
+                    self.cond.wait()
+                if not self.items:
+                    return
+            if self.flush_window:
+                time.sleep(self.flush_window)
+            with self.cond:
+                batch = [self.items.popleft() for _ in range(min(len(self.items), MAX_BATCH))]
+                self.cond.notify_all()
+            if not batch:
+                continue
+            try:
+                send_vectored(self.sock, batch)
+            except OSError:
+                with self.cond:
+                    # Неотправленная пачка нужна для досылки, если клиент вернется
+                    self.items.extendleft(reversed(batch))
+                    self.evict()
+                return
+            self.writes += 1
+            self.frames_sent += len(batch)
+            if self.history is not None:
+                self.history.extend(batch)
+            if self.metrics is not None:
+                self.metrics.record_write(batch)
+
+    def evict(self):
+        """Отключение клиента; вызывается под self.cond"""
+        if self.metrics is not None and not self.closed:
+            self.metrics.record_eviction(len(self.items))
+        self.closed = True
+        self.dropped += len(self.items)
+        if self.history is None:
+            self.items.clear()
+        self.cond.notify_all()
+        try:
+            # Поток чтения клиента получит EOF и выполнит обычное отключение
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self, wait=True):
+        """Закрытие очереди; при wait=True дожидаемся отправки остатка"""
+        self.stop()
+        if wait:
+            self.join(time.monotonic() + CLOSE_TIMEOUT)
+
+    def stop(self):
+        """Новых кадров не будет; остаток писатель дописывает сам"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def join(self, deadline):
+        """Ожидание писателя до момента deadline по time.monotonic()"""
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout=max(0.0, deadline - time.monotonic()))
+
+
+class AsyncOutbox:
+    """Очередь кадров с задачей-писателем для asyncio StreamWriter"""
+
+    def __init__(self, writer, maxsize=1000, policy=DISCONNECT, block_timeout=5.0,
+                 flush_window=0.0, congested=None, metrics=None, replay=0):
+        if policy not in POLICIES:
+            raise ValueError(f'Неизвестная политика очереди: {policy}')
+        self.writer = writer
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.flush_window = flush_window
+        self.metrics = metrics
+        # Общее множество переполненных очередей: обработчик отправителя
+        # ждет их освобождения, прежде чем читать дальше
+        self.congested = congested if congested is not None else set()
+        self.items = deque()
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.closed = False
+        self.dropped = 0
+        self.frames_sent = 0
+        self.writes = 0
+        self.history = deque(maxlen=replay) if replay else None
+        self.task = asyncio.ensure_future(self.run())
+
+    def depth(self):
+        """Число кадров, ожидающих отправки"""
+        return len(self.items)
+
+    def put(self, data):
+        """Постановка кадра в очередь согласно политике"""
+        if self.closed:
+            raise ConnectionError('Очередь клиента закрыта')
+        if len(self.items) >= self.maxsize:
+            if self.policy == DROP_OLDEST:
+                self.items.popleft()
+                self.dropped += 1
+                if self.metrics is not None:
+                    self.metrics.record_drop(1)
+            elif self.policy == BLOCK:
+                # Цикл событий блокировать нельзя: кадр принимаем,
+                # а отправителя тормозим в его обработчике
+                self.space.clear()
+                self.congested.add(self)
+            else:
+                self.evict()
+                return
+        self.items.append(data)
+        self.ready.set()
+
+    def extend(self, frames):
+        """Постановка кадров без учета лимита (досылка пропущенного после обрыва)"""
+        self.items.extend(frames)
+        self.ready.set()
+
+    async def wait_for_space(self):
+        """Ожидание освобождения места; по таймауту клиент отключается"""
+        try:
+            await asyncio.wait_for(self.space.wait(), self.block_timeout)
+        except asyncio.TimeoutError:
+            self.evict()
+
+    async def run(self):
+        """Задача-писатель: отправка накопившихся кадров пачками"""
+        try:
+            while True:
+                while not self.items:
+                    if self.closed:
+                        return
+                    self.ready.clear()
+                    await self.ready.wait()
+                if self.flush_window:
+                    await asyncio.sleep(self.flush_window)
+                batch = [self.items.popleft() for _ in range(min(len(self.items), MAX_BATCH))]
+                if not batch:
+                    continue
+                self.write_batch(batch)
+                if len(self.items) < self.maxsize:
+                    self.space.set()
+                # Ждем, пока буфер транспорта не опустеет ниже порога
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.evict()
+
+    def write_batch(self, batch):
+        """Передача пачки кадров в буфер транспорта с учетом номеров"""
+        self.writer.writelines(batch)
+        self.writes += 1
+        self.frames_sent += len(batch)
+        if self.history is not None:
+            self.history.extend(batch)
+        if self.metrics is not None:
+            self.metrics.record_write(batch)
+
+    def evict(self):
+        """Отключение клиента"""
+        if self.metrics is not None and not self.closed:
+            self.metrics.record_eviction(len(self.items))
+        self.closed = True
+        self.dropped += len(self.items)
+        if self.history is None:
+            self.items.clear()
+        self.ready.set()
+        self.space.set()
+        # Обработчик клиента получит ошибку чтения и выполнит обычное отключение
+        self.writer.transport.abort()
+
+    def close(self, wait=True):
+        """Закрытие очереди; остаток сразу передается в буфер транспорта"""
+        if wait and not self.closed and not self.writer.is_closing() and self.items:
+            self.write_batch(list(self.items))
+            self.items.clear()
+        self.closed = True
+        self.ready.set()
+        self.space.set()
+
+    def stop(self):
+        """То же, что close: остаток сразу уходит в буфер транспорта"""
+        self.close()
+
+    def join(self, deadline):
+        """Писатель - задача цикла событий, ждать в потоке нечего"""
+
+
+class ParkedOutbox:
+    """Очередь клиента, который потерял связь, но может вернуться
+
+    Новые кадры копятся здесь; вместе с историей и остатком старой очереди
+    это ровно то, что клиент пропустил. Переполнение - досылать уже нечего.
+    """
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+        self.maxsize = outbox.maxsize
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.overflow = False
+
+    def depth(self):
+        """Число кадров, ожидающих возвращения клиента"""
+        return len(self.items)
+
+    def put(self, data):
+        """Кадр для клиента, который вернется позже"""
+        with self.lock:
+            if self.closed:
+                raise ConnectionError('Очередь клиента закрыта')
+            if self.overflow:
+                return
+            if len(self.items) >= self.maxsize:
+                self.overflow = True
+                self.items.clear()
+                return
+            self.items.append(data)
+
+    def extend(self, frames):
+        """Несколько кадров для клиента, который вернется позже"""
+        for data in frames:
+            self.put(data)
+
+    def backlog(self, last_seq):
+        """Кадры после номера last_seq; None - часть из них уже не хранится
+
+        Вызывается под self.lock, когда писатель старой очереди уже остановлен.
+        """
+        old = self.outbox
+        if self.overflow or old.history is None or not isinstance(last_seq, int):
+            return None
+        sent = list(old.history)
+        unsent = list(old.items) + list(self.items)
+        first = old.frames_sent - len(sent)   # номер кадра перед самым старым в истории
+        if last_seq < first or last_seq > old.frames_sent + len(unsent):
+            return None
+        if last_seq <= old.frames_sent:
+            return sent[last_seq - first:] + unsent
+        return unsent[last_seq - old.frames_sent:]
+
+    def close(self, wait=True):
+        """Клиент не вернется: накопленное больше не нужно"""
+        with self.lock:
+            self.closed = True
+            self.items.clear()
+
+    def stop(self):
+        """То же, что close"""
+        self.close()
+
+    def join(self, deadline):
+        """Писателя нет"""
+
+
+def close_all(outboxes, timeout=CLOSE_TIMEOUT):
+    """Закрытие многих очередей: сначала сигнал всем, потом ожидание с общим сроком
+
+    Писатели дописывают остатки одновременно, и остановка сервера занимает
+    не больше timeout, а не по timeout на каждого клиента.
+    """
+    for outbox in outboxes:
+        outbox.stop()
+    deadline = time.monotonic() + timeout
+    for outbox in outboxes:
+        outbox.join(deadline)
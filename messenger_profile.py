@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Профилирование процесса сервера
+cProfile по всем потокам (у каждого потока свой профилировщик, в конце они
+складываются) и снимок tracemalloc. Сервер включает их флагами --profile и
+--trace-memory, а messenger_replay.py строит по файлам отчет о самых горячих
+функциях и местах выделения памяти.
+"""
+
+import cProfile
+import os
+import pstats
+import re
+import threading
+import tracemalloc
+
+# Сколько кадров стека помнить для каждого выделения памяти
+MEMORY_FRAMES = 1
+# Строки отчета по умолчанию
+TOP = 25
+# Профиль считает настенное время: ожидание сокетов, замков и таймеров - не работа
+# сервера, в отчет и в общее время оно не входит
+IDLE_FUNCTIONS = re.compile(r"method '_?(poll|select|control|accept|recv|recv_into|wait)' of|"
+                            r"method '(acquire|__enter__)' of '_thread\.|time\.sleep")
+# Адрес объекта в имени функции: от прогона к прогону разный
+ADDRESS = re.compile(r' at 0x[0-9a-f]+')
+
+
+class ServerProfiler:
+    """cProfile всех потоков и tracemalloc от start() до stop()"""
+
+    def __init__(self, profile_path=None, memory_path=None, frames=MEMORY_FRAMES):
+        self.profile_path = profile_path
+        self.memory_path = memory_path
+        self.frames = frames
+        self.profilers = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Включение в текущем потоке и во всех, что будут запущены дальше"""
+        if self.memory_path:
+            tracemalloc.start(self.frames)
+        if self.profile_path:
+            # Профилировщик не умеет следить за несколькими потоками сразу:
+            # первый вызов в новом потоке заводит ему собственный
+            threading.setprofile(self.thread_started)
+            self.thread_started()
+
+    def thread_started(self, *args):
+        """Профилировщик текущего потока; заменяет себя при первом вызове"""
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.profilers.append(profiler)
+        profiler.enable()
+
+    def stop(self):
+        """Запись профиля и снимка памяти в файлы"""
+        if self.memory_path and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(self.memory_path)
+        if self.profile_path:
+            threading.setprofile(None)
+            with self.lock:
+                profilers, self.profilers = self.profilers, []
+            # Потоки, которые еще работают, дальше не учитываются
+            stats = pstats.Stats()
+            for profiler in profilers:
+                profiler.create_stats()
+                if profiler.stats:
+                    stats.add(profiler)
+            stats.dump_stats(self.profile_path)
+
+
+def hot_functions(path, top=TOP, sort='tottime'):
+    """Самые затратные функции профиля: [{функция, вызовы, время...}]
+
+    tottime - время в самой функции, cumtime - вместе с вызванными;
+    share - доля собственного времени функции от всего времени работы
+    (без ожидания, см. IDLE_FUNCTIONS).
+    """
+    stats = pstats.Stats(path)
+    functions = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        label = function_label(filename, line, name)
+        if not IDLE_FUNCTIONS.search(label):
+            functions.append((label, calls, tottime, cumtime))
+    total = sum(tottime for _, _, tottime, _ in functions) or 1.0
+    rows = []
+    for label, calls, tottime, cumtime in functions:
+        rows.append({
+            'function': label,
+            'calls': calls,
+            'tottime': round(tottime, 4),
+            'cumtime': round(cumtime, 4),
+            'per_call_us': round(tottime / calls * 1e6, 2) if calls else 0.0,
+            'share': round(tottime / total * 100, 2),
+        })
+    rows.sort(key=lambda row: row[sort], reverse=True)
+    return rows[:top]
+
+
+def memory_top(path, top=TOP):
+    """Места, где выделено больше всего памяти, по снимку tracemalloc"""
+    snapshot = tracemalloc.Snapshot.load(path).filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ))
+    rows = []
+    for stat in snapshot.statistics('lineno')[:top]:
+        frame = stat.traceback[0]
+        rows.append({
+            'location': f'{os.path.basename(frame.filename)}:{frame.lineno}',
+            'kb': round(stat.size / 1024, 1),
+            'blocks': stat.count,
+        })
+    return rows
+
+
+def function_label(filename, line, name):
+    """Короткое имя функции: файл:строка(имя); встроенные - как есть"""
+    if filename == '~':
+        return ADDRESS.sub('', name)
+    return f'{os.path.basename(filename)}:{line}({name})'
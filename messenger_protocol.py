@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+"""
+Протокол мессенджера: кадры с префиксом длины
+Используется и сервером, и клиентом
+
+Кадр: версия протокола (1 байт) + длина нагрузки (4 байта, big-endian) + нагрузка.
+Нагрузка - JSON в UTF-8 или, если клиент согласовал это при входе,
+компактная двоичная кодировка; первый байт нагрузки говорит, что внутри:
+    '{'  - JSON
+    0x01 - двоичная кодировка
+    0x02 - сжатая zlib нагрузка одного из двух видов выше
+
+Двоичная кодировка: 0x01, номер типа сообщения, число полей и поля
+(номер ключа + значение). Частые ключи и типы заменены номерами,
+время HH:MM:SS - тремя байтами, а имена пользователей - номерами
+из таблицы имен, которую сервер присылает сообщениями 'names'
+(список имен - массивом 16-битных номеров little-endian).
+"""
+
+import json
+import re
+import struct
+import sys
+import threading
+import zlib
+from array import array
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BI')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 65536
+
+# Кодировки нагрузки в порядке предпочтения клиента
+ENCODING_JSON = 'json'
+ENCODING_BINARY = 'binary'
+ENCODINGS = (ENCODING_BINARY, ENCODING_JSON)
+
+MARK_BINARY = 0x01
+MARK_ZLIB = 0x02
+# Нагрузки меньше этого не сжимаются: выигрыша почти нет, а время тратится
+COMPRESS_THRESHOLD = 512
+COMPRESS_LEVEL = 1
+# Максимум имен в таблице; остальные передаются строками
+MAX_NAMES = 65536
+
+# Номера типов и ключей - часть протокола: новые только дописываются в конец
+TYPES = ('join', 'message', 'private', 'system', 'user_joined', 'user_left',
+         'user_list', 'room_join', 'room_leave', 'room_message', 'room_joined',
+         'room_left', 'names', 'ping', 'pong', 'file_offer', 'file_accept',
+         'file_decline', 'file_put', 'file_get', 'file_status', 'leave', 'search',
+         'search_results')
+KEYS = ('username', 'message', 'text', 'timestamp', 'target', 'room', 'users',
+        'ids', 'encoding', 'encodings', 'compress', 'id', 'name', 'size', 'offset', 'ref',
+        'query', 'results', 'next', 'from', 'since', 'until', 'before', 'limit', 'time')
+TYPE_TAGS = {name: tag for tag, name in enumerate(TYPES, 1)}
+KEY_TAGS = {name: tag for tag, name in enumerate(KEYS, 1)}
+# Поля, значения которых - имена пользователей
+NAME_KEYS = frozenset(('username', 'target', 'users'))
+
+# Виды значений двоичной кодировки
+V_NULL, V_TRUE, V_FALSE, V_INT, V_FLOAT, V_STR, V_NAME, V_CLOCK, V_LIST, V_DICT, V_NAMES = range(11)
+FLOAT = struct.Struct('!d')
+# Varint не длиннее 10 байт (64-битное число)
+MAX_VARINT_BYTES = 10
+# Вложенность списков и словарей в двоичной нагрузке
+MAX_DEPTH = 32
+CLOCK = re.compile(r'(\d\d):(\d\d):(\d\d)')
+
+
+class ProtocolError(Exception):
+    """Нарушение формата кадров"""
+
+
+def encode_frame(payload, version=PROTOCOL_VERSION):
+    """Упаковка байтов нагрузки в кадр"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f'Кадр слишком большой: {len(payload)} байт')
+    return HEADER.pack(version, len(payload)) + payload
+
+
+def encode_message(message):
+    """Сериализация сообщения в готовый к отправке кадр"""
+    return encode_frame(json.dumps(message).encode('utf-8'))
+
+
+def decode_message(payload, names=None):
+    """Разбор нагрузки кадра (bytes или memoryview) в сообщение
+
+    names - таблица имен соединения (NameTable) для двоичной кодировки.
+    """
+    if payload and payload[0] == MARK_ZLIB:
+        # Распакованная нагрузка не больше кадра: иначе маленький кадр
+        # с хорошо сжимаемыми данными занял бы всю память
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(payload[1:], MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise ProtocolError(f'Поврежденная сжатая нагрузка: {e}')
+        if decompressor.unconsumed_tail:
+            raise ProtocolError(f'Сжатая нагрузка больше {MAX_FRAME_SIZE} байт после распаковки')
+    if payload and payload[0] == MARK_BINARY:
+        return decode_binary(bytes(payload), names)
+    return json.loads(str(payload, 'utf-8'))
+
+
+def write_varint(out, value):
+    """Беззнаковое целое по 7 бит в байте"""
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    """Чтение varint; возвращает значение и новую позицию"""
+    value = 0
+    for shift in range(0, 7 * MAX_VARINT_BYTES, 7):
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+    raise ProtocolError(f'Число длиннее {MAX_VARINT_BYTES} байт')
+
+
+def read_bytes(data, pos, length):
+    """Срез заявленной длины; возвращает байты и новую позицию"""
+    end = pos + length
+    if end > len(data):
+        raise ProtocolError(f'Заявлено {length} байт, осталось {len(data) - pos}')
+    return data[pos:end], end
+
+
+def read_str(data, pos):
+    """Строка: длина и UTF-8; возвращает строку и новую позицию"""
+    length, pos = read_varint(data, pos)
+    raw, pos = read_bytes(data, pos, length)
+    return str(raw, 'utf-8'), pos
+
+
+def write_str(out, text):
+    """Строка: длина и UTF-8"""
+    data = text.encode('utf-8')
+    write_varint(out, len(data))
+    out += data
+
+
+def write_value(out, value, key=None, refs=None):
+    """Одно значение двоичной кодировки"""
+    if isinstance(value, str):
+        if refs is not None and key in NAME_KEYS:
+            ref = refs.get(value)
+            if ref is not None:
+                out.append(V_NAME)
+                write_varint(out, ref)
+                return
+        if key == 'timestamp' and len(value) == 8:
+            match = CLOCK.fullmatch(value)
+            if match:
+                out.append(V_CLOCK)
+                out += bytes(int(part) for part in match.groups())
+                return
+        out.append(V_STR)
+        write_str(out, value)
+    elif value is None:
+        out.append(V_NULL)
+    elif value is True:
+        out.append(V_TRUE)
+    elif value is False:
+        out.append(V_FALSE)
+    elif isinstance(value, int):
+        out.append(V_INT)
+        # zigzag: отрицательные числа тоже укладываются в короткий varint
+        write_varint(out, (~value << 1) | 1 if value < 0 else value << 1)
+    elif isinstance(value, float):
+        out.append(V_FLOAT)
+        out += FLOAT.pack(value)
+    elif isinstance(value, (list, tuple)):
+        if refs is not None and key in NAME_KEYS and value:
+            # Список имен (user_list) - массив 16-битных номеров, если все имена известны
+            try:
+                packed = array('H', [refs[name] for name in value])
+            except (KeyError, TypeError, OverflowError):
+                packed = None
+            if packed is not None:
+                if sys.byteorder == 'big':
+                    packed.byteswap()
+                out.append(V_NAMES)
+                write_varint(out, len(packed))
+                out += packed.tobytes()
+                return
+        out.append(V_LIST)
+        write_varint(out, len(value))
+        for item in value:
+            write_value(out, item, key, refs)
+    elif isinstance(value, dict):
+        out.append(V_DICT)
+        write_varint(out, len(value))
+        for name, item in value.items():
+            write_str(out, str(name))
+            write_value(out, item, name, refs)
+    else:
+        raise ProtocolError(f'Значение не поддерживается: {type(value).__name__}')
+
+
+def read_value(data, pos, names, depth=0):
+    """Чтение одного значения; возвращает значение и новую позицию
+
+    depth - вложенность в списки и словари: глубже MAX_DEPTH нагрузка
+    считается поврежденной, а не разбирается до переполнения стека.
+    """
+    kind = data[pos]
+    pos += 1
+    if kind == V_STR:
+        return read_str(data, pos)
+    if kind == V_NAME:
+        ref, pos = read_varint(data, pos)
+        if names is None:
+            raise ProtocolError('Ссылка на имя без таблицы имен')
+        return names.lookup(ref), pos
+    if kind == V_CLOCK:
+        clock, pos = read_bytes(data, pos, 3)
+        return f'{clock[0]:02d}:{clock[1]:02d}:{clock[2]:02d}', pos
+    if kind == V_INT:
+        value, pos = read_varint(data, pos)
+        return (value >> 1) ^ -(value & 1), pos
+    if kind in (V_LIST, V_DICT) and depth >= MAX_DEPTH:
+        raise ProtocolError(f'Вложенность больше {MAX_DEPTH}')
+    if kind == V_LIST:
+        count, pos = read_varint(data, pos)
+        items = []
+        for _ in range(count):
+            item, pos = read_value(data, pos, names, depth + 1)
+            items.append(item)
+        return items, pos
+    if kind == V_DICT:
+        count, pos = read_varint(data, pos)
+        items = {}
+        for _ in range(count):
+            name, pos = read_str(data, pos)
+            items[name], pos = read_value(data, pos, names, depth + 1)
+        return items, pos
+    if kind == V_NAMES:
+        count, pos = read_varint(data, pos)
+        if names is None:
+            raise ProtocolError('Ссылка на имя без таблицы имен')
+        raw, pos = read_bytes(data, pos, 2 * count)
+        packed = array('H', raw)
+        if sys.byteorder == 'big':
+            packed.byteswap()
+        return names.lookup_many(packed), pos
+    if kind == V_NULL:
+        return None, pos
+    if kind == V_TRUE:
+        return True, pos
+    if kind == V_FALSE:
+        return False, pos
+    if kind == V_FLOAT:
+        return FLOAT.unpack_from(data, pos)[0], pos + FLOAT.size
+    raise ProtocolError(f'Неизвестный вид значения: {kind}')
+
+
+def encode_binary(message, names=None):
+    """Сообщение в двоичную нагрузку; names - таблица имен сервера"""
+    out = bytearray((MARK_BINARY,))
+    message_type = message.get('type')
+    tag = TYPE_TAGS.get(message_type, 0)
+    out.append(tag)
+    if not tag:
+        write_str(out, str(message_type))
+    # Таблица имен сама передается строками
+    refs = names.published if names is not None and message_type != 'names' else None
+    write_varint(out, len(message) - ('type' in message))
+    for key, value in message.items():
+        if key == 'type':
+            continue
+        key_tag = KEY_TAGS.get(key, 0)
+        out.append(key_tag)
+        if not key_tag:
+            write_str(out, key)
+        write_value(out, value, key, refs)
+    return bytes(out)
+
+
+def decode_binary(data, names=None):
+    """Двоичная нагрузка в сообщение"""
+    try:
+        tag = data[1]
+        pos = 2
+        if tag:
+            message = {'type': TYPES[tag - 1]}
+        else:
+            message_type, pos = read_str(data, pos)
+            message = {'type': message_type}
+        count, pos = read_varint(data, pos)
+        for _ in range(count):
+            key_tag = data[pos]
+            pos += 1
+            if key_tag:
+                key = KEYS[key_tag - 1]
+            else:
+                key, pos = read_str(data, pos)
+            message[key], pos = read_value(data, pos, names)
+        if pos != len(data):
+            raise ProtocolError(f'Лишние байты после сообщения: {len(data) - pos}')
+    except (IndexError, UnicodeDecodeError, struct.error) as e:
+        raise ProtocolError(f'Поврежденная двоичная нагрузка: {e}')
+    return message
+
+
+class NameTable:
+    """Номера имен пользователей для двоичной кодировки
+
+    Сервер выдает номер при входе пользователя и сначала рассылает его
+    клиентам сообщением 'names', а уже потом начинает подставлять номер
+    вместо имени (published). Клиент наполняет таблицу из этих сообщений.
+    """
+
+    def __init__(self, limit=MAX_NAMES):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.ids = {}        # {имя: номер} - все выданные номера
+        self.published = {}  # {имя: номер} - номера, которые уже знают все клиенты
+        self.names = {}      # {номер: имя} - для разбора
+
+    def intern(self, name):
+        """Номер имени, при необходимости новый; None, если таблица заполнена"""
+        with self.lock:
+            ref = self.ids.get(name)
+            if ref is None and len(self.ids) < self.limit:
+                ref = len(self.ids)
+                self.ids[name] = ref
+                self.names[ref] = name
+            return ref
+
+    def publish(self, name):
+        """Номер разослан клиентам - его можно подставлять вместо имени"""
+        with self.lock:
+            ref = self.ids.get(name)
+            if ref is not None:
+                self.published[name] = ref
+
+    def definition(self, names=None):
+        """Сообщение 'names' с номерами указанных (по умолчанию всех) имен"""
+        with self.lock:
+            if names is None:
+                names = list(self.ids)
+            pairs = [(self.ids[name], name) for name in names if name in self.ids]
+        return {'type': 'names', 'ids': [ref for ref, _ in pairs],
+                'users': [name for _, name in pairs]}
+
+    def learn(self, message):
+        """Пополнение таблицы из сообщения 'names'"""
+        for ref, name in zip(message['ids'], message['users']):
+            self.names[ref] = name
+
+    def lookup_many(self, refs):
+        """Имена по списку номеров"""
+        try:
+            return [self.names[ref] for ref in refs]
+        except KeyError as e:
+            raise ProtocolError(f'Неизвестный номер имени: {e}')
+
+    def lookup(self, ref):
+        """Имя по номеру"""
+        try:
+            return self.names[ref]
+        except KeyError:
+            raise ProtocolError(f'Неизвестный номер имени: {ref}')
+
+
+class WireFormat:
+    """Кодировка соединения, согласованная в сообщении join
+
+    Сервер держит по одному объекту на каждую пару (кодировка, сжатие)
+    и перекодирует в нее готовые JSON кадры; результат кэшируется, так что
+    рассылка кодируется один раз на вариант, а не на каждого получателя.
+    """
+
+    CACHE_SIZE = 1024
+
+    def __init__(self, encoding=ENCODING_JSON, compress=False, names=None):
+        if encoding not in ENCODINGS:
+            raise ProtocolError(f'Неизвестная кодировка: {encoding}')
+        self.encoding = encoding
+        self.compress = compress
+        self.names = names if names is not None else NameTable()
+        self.cache = {}
+
+    def pack(self, payload):
+        """Сжатие большой нагрузки, если это выгодно"""
+        if self.compress and len(payload) >= COMPRESS_THRESHOLD:
+            packed = bytes((MARK_ZLIB,)) + zlib.compress(payload, COMPRESS_LEVEL)
+            if len(packed) < len(payload):
+                return packed
+        return payload
+
+    def encode_payload(self, message):
+        """Сообщение в нагрузку этой кодировки"""
+        if self.encoding == ENCODING_BINARY:
+            payload = encode_binary(message, self.names)
+        else:
+            payload = json.dumps(message).encode('utf-8')
+        return self.pack(payload)
+
+    def encode(self, message):
+        """Сообщение в готовый к отправке кадр"""
+        return encode_frame(self.encode_payload(message))
+
+    def decode(self, payload):
+        """Разбор нагрузки с учетом таблицы имен соединения"""
+        message = decode_message(payload, self.names)
+        if message.get('type') == 'names':
+            self.names.learn(message)
+        return message
+
+    def transcode(self, data):
+        """Перевод готовых JSON кадров (одного или нескольких подряд) в эту кодировку"""
+        result = self.cache.get(data)
+        if result is not None:
+            return result
+        frames = []
+        offset = 0
+        while offset < len(data):
+            _, length = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            offset = start + length
+            payload = data[start:offset]
+            if self.encoding == ENCODING_BINARY and payload[:1] == b'{':
+                payload = encode_binary(decode_message(payload), self.names)
+            frames.append(encode_frame(self.pack(payload)))
+        result = frames[0] if len(frames) == 1 else b''.join(frames)
+        if len(self.cache) >= self.CACHE_SIZE:
+            self.cache.clear()
+        self.cache[data] = result
+        return result
+
+
+def negotiate(message, supported=ENCODINGS):
+    """Выбор кодировки по сообщению join: первая из предложенных, которую знает сервер
+
+    Возвращает (кодировка, сжатие); старые клиенты без поля encodings получают JSON.
+    """
+    for encoding in message.get('encodings') or ():
+        if encoding in supported:
+            return encoding, bool(message.get('compress'))
+    return ENCODING_JSON, bool(message.get('compress'))
+
+
+class FrameDecoder:
+    """Потоковый разборщик кадров
+
+    feed() принимает куски байтов произвольной длины и возвращает
+    memoryview на нагрузку каждого полностью полученного кадра.
+    Нагрузка не копируется: представления ссылаются на внутренний буфер,
+    а при следующем feed() копируется только недочитанный хвост.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def feed(self, data):
+        """Добавление байтов; возвращает список нагрузок готовых кадров"""
+        if self.offset:
+            # Старый буфер может быть занят выданными memoryview,
+            # поэтому переносим хвост в новый, а не сдвигаем на месте
+            self.buffer = self.buffer[self.offset:]
+            self.offset = 0
+        self.buffer += data
+
+        frames = []
+        view = None
+        while len(self.buffer) - self.offset >= HEADER.size:
+            version, length = HEADER.unpack_from(self.buffer, self.offset)
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f'Неподдерживаемая версия протокола: {version}')
+            if length > self.max_frame_size:
+                raise ProtocolError(f'Кадр слишком большой: {length} байт')
+            start = self.offset + HEADER.size
+            end = start + length
+            if end > len(self.buffer):
+                break
+            if view is None:
+                view = memoryview(self.buffer)
+            frames.append(view[start:end])
+            self.offset = end
+        return frames
+
+    def pending(self):
+        """Число байтов недочитанного кадра"""
+        return len(self.buffer) - self.offset
+
+    def rest(self):
+        """Забрать байты после последнего кадра (когда дальше по соединению идут не кадры)"""
+        rest = bytes(self.buffer[self.offset:])
+        self.buffer = bytearray()
+        self.offset = 0
+        return rest
+
+
+def send_message(sock, message, wire=None):
+    """Полная отправка сообщения в блокирующий сокет"""
+    sock.sendall(wire.encode(message) if wire is not None else encode_message(message))
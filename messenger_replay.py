@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Воспроизведение записанного трафика на локальном сервере
+Берет запись сервера с --capture (см. messenger_capture.py) и повторяет те же
+подключения, входы, сообщения и отключения с теми же паузами - в реальном
+времени или ускоренно. Текст сообщений заменен заполнителем той же длины с
+отметкой времени на конце, поэтому задержка доставки считается, как в
+messenger_loadgen.py.
+
+С --profile и --trace-memory сервер, запущенный через --spawn, работает под
+cProfile и tracemalloc, а после прогона выводится отчет о самых горячих
+функциях и местах выделения памяти. --compare сравнивает доли функций с
+сохраненным ранее отчетом (--json), чтобы заметить регрессию на настоящей
+форме нагрузки.
+
+Пример:
+    python messenger_server.py --capture morning.gz
+    python messenger_replay.py morning.gz --spawn asyncio --speed 5 \\
+        --profile server.prof --trace-memory server.mem --json replay.json
+"""
+
+import argparse
+import asyncio
+import json
+import shlex
+import time
+from datetime import datetime
+
+from messenger_capture import read_capture
+from messenger_loadgen import (LoadClient, free_port, git_revision, percentile, raise_fd_limit,
+                               start_server, stop_server)
+from messenger_profile import TOP, hot_functions, memory_top
+from messenger_protocol import ENCODING_JSON
+
+# Заполнитель текста сообщений
+FILLER = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+# Отставание от расписания, после которого событие считается опоздавшим, сек
+LATE = 0.01
+# Сколько событий подряд выполнять без возврата в цикл событий, если опаздываем
+BATCH = 100
+
+
+def load_events(paths, until=None):
+    """События нескольких записей на общей шкале времени
+
+    Возвращает [(сек, (номер_файла, соединение), тип, аргументы)] и входы
+    {(номер_файла, соединение): (имя, возможности)}. Записи процессов sharded
+    сводятся по монотонным часам, общим для машины.
+    """
+    captures = [read_capture(path) for path in paths]
+    origin = min(header['clock'] for header, _ in captures)
+    events = []
+    joins = {}
+    for index, (header, capture) in enumerate(captures):
+        offset = header['clock'] - origin
+        for when, kind, conn, args in capture:
+            when += offset
+            if until is not None and when > until:
+                break
+            key = (index, conn)
+            if kind == 'join':
+                joins[key] = args
+            events.append((when, key, kind, args))
+    events.sort(key=lambda event: event[0])
+    return events, joins
+
+
+def filler_text(length):
+    """Текст длины length (но не короче отметки времени) с отметкой времени на конце"""
+    stamp = repr(time.perf_counter())
+    size = max(0, length - len(stamp) - 1)
+    text = FILLER * (size // len(FILLER) + 1)
+    return f'{text[:size]} {stamp}'
+
+
+def build_message(kind, args):
+    """Сообщение клиента по событию записи"""
+    if kind == 'message':
+        return {'type': 'message', 'text': filler_text(args[0])}
+    if kind == 'private':
+        return {'type': 'private', 'target': args[0], 'text': filler_text(args[1])}
+    if kind in ('room_join', 'room_leave'):
+        return {'type': kind, 'room': args[0]}
+    if kind == 'room_message':
+        return {'type': 'room_message', 'room': args[0], 'text': filler_text(args[1])}
+    return {'type': kind}
+
+
+class TrafficReplay:
+    """Повтор событий записи: у каждого соединения своя очередь и задача"""
+
+    def __init__(self, host, port, events, joins, speed=1.0, grace=2.0):
+        self.host = host
+        self.port = port
+        self.events = events
+        self.joins = joins
+        # 0 - без пауз, как можно быстрее
+        self.speed = speed
+        self.grace = grace
+        self.queues = {}
+        self.tasks = []
+        self.latencies = []
+        self.lags = []
+        self.counts = {}
+        self.delivered = 0
+        self.bytes_received = 0
+        self.errors = 0
+
+    async def drive(self, key, queue):
+        """Одно соединение: подключение, затем события по порядку до отключения"""
+        name, options = self.joins.get(key, (f'replay{key[0]}_{key[1]}', {}))
+        encodings = options.get('encodings') or [ENCODING_JSON]
+        client = LoadClient(name, self.latencies,
+                            wanted={'system', 'message', 'private', 'room_message'},
+                            keep_queue=False, encoding=encodings[0],
+                            compress=bool(options.get('compress')))
+        try:
+            await client.connect(self.host, self.port)
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                kind, args = event
+                if kind == 'join':
+                    await client.join()
+                else:
+                    client.send(build_message(kind, args))
+        except (OSError, asyncio.TimeoutError):
+            # В том числе отказ во входе: имя еще занято прошлым соединением
+            self.errors += 1
+        finally:
+            await client.close()
+            self.delivered += client.received
+            self.bytes_received += client.bytes_received
+
+    def apply(self, key, kind, args):
+        """Событие записи: новое соединение, его сообщение или отключение"""
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        if kind == 'connect':
+            queue = self.queues[key] = asyncio.Queue()
+            self.tasks.append(asyncio.ensure_future(self.drive(key, queue)))
+            return
+        queue = self.queues.get(key)
+        if queue is None:
+            return
+        if kind == 'disconnect':
+            del self.queues[key]
+            queue.put_nowait(None)
+        else:
+            queue.put_nowait((kind, args))
+
+    async def run(self):
+        """Прогон записи; возвращает словарь результатов"""
+        started = time.perf_counter()
+        in_row = 0
+        for when, key, kind, args in self.events:
+            if self.speed:
+                delay = started + when / self.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    in_row = 0
+                self.lags.append(max(0.0, -delay))
+            if in_row >= BATCH:
+                # Опаздываем: соединениям тоже нужно время, чтобы отправить свое
+                await asyncio.sleep(0)
+                in_row = 0
+            in_row += 1
+            self.apply(key, kind, args)
+        replay_seconds = time.perf_counter() - started
+
+        # Кто был подключен до конца записи, отключается после ожидания доставки
+        await asyncio.sleep(self.grace)
+        for queue in self.queues.values():
+            queue.put_nowait(None)
+        self.queues.clear()
+        await asyncio.gather(*self.tasks)
+
+        latencies = sorted(self.latencies)
+        lags = sorted(self.lags)
+
+        def ms(value):
+            return round(value * 1000, 3) if value is not None else None
+
+        capture_seconds = self.events[-1][0] if self.events else 0.0
+        return {
+            'events': len(self.events),
+            'counts': dict(self.counts),
+            'capture_seconds': round(capture_seconds, 3),
+            'replay_seconds': round(replay_seconds, 3),
+            'speed': self.speed,
+            'late_events': sum(lag > LATE for lag in lags),
+            'lag_p99_ms': ms(percentile(lags, 99)),
+            'lag_max_ms': ms(lags[-1] if lags else None),
+            'delivered': self.delivered,
+            'delivered_per_second': round(self.delivered / replay_seconds, 1)
+            if replay_seconds else None,
+            'latency_p50_ms': ms(percentile(latencies, 50)),
+            'latency_p99_ms': ms(percentile(latencies, 99)),
+            'latency_max_ms': ms(latencies[-1] if latencies else None),
+            'bytes_received': self.bytes_received,
+            'errors': self.errors,
+        }
+
+
+def compare_functions(rows, baseline):
+    """Доля каждой функции в прошлом отчете и изменение, в процентных пунктах"""
+    before = {row['function']: row['share'] for row in baseline}
+    for row in rows:
+        share = before.get(row['function'])
+        row['share_before'] = share
+        row['delta'] = round(row['share'] - share, 2) if share is not None else None
+
+
+def print_table(title, rows, columns):
+    """Вывод строк отчета таблицей"""
+    print(f'\n[{title}]')
+    print(' | '.join(columns))
+    for row in rows:
+        print(' | '.join(str(row.get(c)) for c in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Воспроизведение записанного трафика')
+    parser.add_argument('captures', nargs='+',
+                        help='файлы записи (у процессов sharded - все файлы сразу)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--spawn', metavar='MODE',
+                        help='запустить локальный сервер в режиме MODE на свободном порту')
+    parser.add_argument('--server-args', default='', help='дополнительные аргументы для --spawn')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='ускорение: 1 - как в записи, 10 - в десять раз быстрее, '
+                             '0 - без пауз')
+    parser.add_argument('--until', type=float,
+                        help='воспроизвести только первые столько секунд записи')
+    parser.add_argument('--grace', type=float, default=2.0,
+                        help='сколько ждать доставки после последнего события, сек')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='профиль cProfile сервера (только с --spawn)')
+    parser.add_argument('--trace-memory', metavar='PATH',
+                        help='снимок tracemalloc сервера (только с --spawn)')
+    parser.add_argument('--top', type=int, default=TOP, help='строк в отчете профиля')
+    parser.add_argument('--sort', choices=['tottime', 'cumtime', 'calls'], default='tottime',
+                        help='порядок функций в отчете')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='прошлый отчет (--json) для сравнения долей функций')
+    parser.add_argument('--label', help='метка прогона, например версия сервера')
+    parser.add_argument('--json', help='файл для сохранения результатов')
+    args = parser.parse_args(argv)
+    if (args.profile or args.trace_memory) and not args.spawn:
+        parser.error('--profile и --trace-memory работают только с --spawn')
+    if args.speed < 0:
+        parser.error('--speed не может быть отрицательным')
+
+    events, joins = load_events(args.captures, args.until)
+    raise_fd_limit()
+    proc = None
+    host, port = args.host, args.port
+    if args.spawn:
+        server_args = shlex.split(args.server_args)
+        if args.profile:
+            server_args += ['--profile', args.profile]
+        if args.trace_memory:
+            server_args += ['--trace-memory', args.trace_memory]
+        host, port = '127.0.0.1', free_port()
+        proc = start_server(args.spawn, port, server_args)
+    try:
+        replay = TrafficReplay(host, port, events, joins, args.speed, args.grace)
+        results = asyncio.run(replay.run())
+    finally:
+        if proc is not None:
+            # Профиль и снимок памяти сервер записывает при остановке
+            stop_server(proc)
+
+    report = {
+        'label': args.label,
+        'revision': git_revision(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'captures': args.captures,
+            'spawn': args.spawn,
+            'server_args': args.server_args,
+            'speed': args.speed,
+            'until': args.until,
+        },
+        'results': results,
+    }
+    if args.profile:
+        report['hot_functions'] = hot_functions(args.profile, args.top, args.sort)
+    if args.trace_memory:
+        report['memory'] = memory_top(args.trace_memory, args.top)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.profile:
+        columns = ['function', 'calls', 'tottime', 'cumtime', 'per_call_us', 'share']
+        if args.compare:
+            with open(args.compare) as f:
+                compare_functions(report['hot_functions'], json.load(f).get('hot_functions', []))
+            columns += ['share_before', 'delta']
+        print_table('ПРОФИЛЬ', report['hot_functions'], columns)
+    if args.trace_memory:
+        print_table('ПАМЯТЬ', report['memory'], ['location', 'kb', 'blocks'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
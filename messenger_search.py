@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Полнотекстовый поиск по сообщениям чата
+Обратный индекс пополняется по мере доставки сообщений: новый документ
+попадает в небольшой открытый сегмент, заполненный сегмент замораживается,
+а фоновый поток сливает мелкие сегменты в крупные (как в LSM) и удаляет
+самые старые сверх лимита памяти.
+
+Индексация, слияние и запросы выполняются в одном фоновом потоке: рассылка
+только ставит кадр в очередь и не ждет ни запросов, ни слияний.
+
+Документ - кадр сообщения и его номер; номера растут, поэтому результаты
+идут от новых к старым, а номер последнего найденного служит курсором
+следующей страницы.
+"""
+
+import bisect
+import heapq
+import queue
+import re
+import threading
+import time
+from array import array
+
+from messenger_log import log
+from messenger_protocol import HEADER, decode_message
+
+# Документов в открытом сегменте
+SEGMENT_DOCS = 1024
+# Сколько сегментов одного уровня сливать в один
+MERGE_FACTOR = 4
+# Уровень, выше которого не сливаем: самый старый сегмент удаляется целиком
+MAX_LEVEL = 3
+# Запросов в очереди фонового потока; сверх этого - отказ, а не ожидание
+QUEUE_SIZE = 64
+# Сообщений в очереди, после которых новые пропускаются, пока поток не догонит
+MAX_BACKLOG = 100000
+# Результатов на странице по умолчанию и максимум
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Слова длиннее этого не индексируются (base64, длинные ссылки целиком)
+MAX_TOKEN = 64
+# Примерная стоимость хранения одного вхождения слова и одного слова словаря, байт
+POSTING_BYTES = 4
+TERM_BYTES = 64
+
+TOKEN = re.compile(r'\w+')
+# Ключ словаря, по которому ищутся сообщения отправителя
+SENDER_PREFIX = '\x00'
+
+
+def normalize(text):
+    """Нижний регистр без различия е/ё"""
+    return text.casefold().replace('ё', 'е')
+
+
+def tokenize(text):
+    """Слова текста: буквы любого алфавита и цифры, без знаков препинания"""
+    return [token for token in TOKEN.findall(normalize(text)) if len(token) <= MAX_TOKEN]
+
+
+def parse_query(text):
+    """Слова запроса; слово со звездочкой на конце ищется по началу ('ссылк*')"""
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        for token in tokenize(word):
+            terms.append((token, False))
+        if prefix and terms:
+            terms[-1] = (terms[-1][0], True)
+    return terms
+
+
+class IndexSegment:
+    """Документы с номерами base, base + 1, ... и их обратный индекс
+
+    Открытый сегмент пополняется add(); после freeze() он больше не меняется.
+    """
+
+    def __init__(self, base, level=0):
+        self.base = base
+        self.level = level
+        self.frames = []
+        self.times = array('d')
+        self.senders = []
+        self.targets = []       # None - сообщение видят все
+        self.postings = {}      # {слово: номера документов в сегменте по возрастанию}
+        self.terms = None       # отсортированный словарь замороженного сегмента
+        self.size = 0           # примерный объем в памяти, байт
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, frame, when, sender, target, tokens):
+        """Новый документ открытого сегмента"""
+        local = len(self.frames)
+        self.frames.append(frame)
+        self.times.append(when)
+        self.senders.append(sender)
+        self.targets.append(target)
+        self.size += len(frame)
+        for token in tokens:
+            ids = self.postings.get(token)
+            if ids is None:
+                self.postings[token] = ids = []
+                self.size += TERM_BYTES
+            if not ids or ids[-1] != local:
+                ids.append(local)
+                self.size += POSTING_BYTES
+
+    def freeze(self):
+        """Компактные массивы вместо списков и словарь для поиска по началу слова"""
+        self.postings = {term: array('I', ids) for term, ids in self.postings.items()}
+        self.terms = sorted(self.postings)
+
+    @classmethod
+    def merge(cls, segments):
+        """Один сегмент из нескольких соседних, от старых к новым"""
+        merged = cls(segments[0].base, max(s.level for s in segments) + 1)
+        postings = {}
+        for segment in segments:
+            offset = segment.base - merged.base
+            merged.frames.extend(segment.frames)
+            merged.times.extend(segment.times)
+            merged.senders.extend(segment.senders)
+            merged.targets.extend(segment.targets)
+            for term, ids in segment.postings.items():
+                merged_ids = postings.get(term)
+                if merged_ids is None:
+                    postings[term] = merged_ids = array('I')
+                merged_ids.extend(local + offset for local in ids)
+        merged.postings = postings
+        merged.terms = sorted(postings)
+        merged.size = sum(s.size for s in segments)
+        return merged
+
+    def lookup(self, term, prefix):
+        """Номера документов со словом (или с началом слова) по возрастанию"""
+        if not prefix:
+            return self.postings.get(term, ())
+        if self.terms is not None:
+            start = bisect.bisect_left(self.terms, term)
+            stop = bisect.bisect_left(self.terms, term + '\uffff')
+            matched = self.terms[start:stop]
+        else:
+            matched = [t for t in self.postings if t.startswith(term)]
+        if len(matched) == 1:
+            return self.postings[matched[0]]
+        # Объединение списков без повторов
+        result = []
+        for local in heapq.merge(*(self.postings[t] for t in matched)):
+            if not result or result[-1] != local:
+                result.append(local)
+        return result
+
+    def search(self, terms, username, since, until, before, limit, results):
+        """Дописывает в results до limit подходящих документов, от новых к старым"""
+        count = len(self.frames)
+        if before is not None:
+            count = min(count, before - self.base)
+        if count <= 0 or (since is not None and self.times[count - 1] < since):
+            return
+        if until is not None and self.times[0] > until:
+            return
+        lists = [self.lookup(term, prefix) for term, prefix in terms]
+        if any(not ids for ids in lists):
+            return
+        lists.sort(key=len)
+        if lists:
+            first = lists[0]
+            candidates = (first[i] for i in range(bisect.bisect_left(first, count) - 1, -1, -1))
+        else:
+            candidates = range(count - 1, -1, -1)
+        for local in candidates:
+            when = self.times[local]
+            if since is not None and when < since:
+                # Время растет вместе с номером: дальше только старее
+                return
+            if until is not None and when > until:
+                continue
+            target = self.targets[local]
+            if target is not None and username not in (self.senders[local], target):
+                continue
+            if not all(contains(ids, local) for ids in lists[1:]):
+                continue
+            results.append((self.base + local, when, self.frames[local]))
+            if len(results) >= limit:
+                return
+
+
+def contains(ids, value):
+    """Есть ли value в отсортированном списке"""
+    i = bisect.bisect_left(ids, value)
+    return i < len(ids) and ids[i] == value
+
+
+class SearchIndex:
+    """Индекс сообщений с ограничением памяти и собственным потоком
+
+    Все изменения индекса и все запросы выполняются в одном фоновом потоке,
+    поэтому замки не нужны; путь рассылки только ставит кадр в очередь.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, clock=time.time):
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.sealed = []        # замороженные сегменты от старых к новым
+        self.active = IndexSegment(0)
+        self.next_id = 0
+        self.skipped = 0        # сообщений не проиндексировано из-за отставания потока
+        self.query_slots = threading.Semaphore(QUEUE_SIZE)
+        self.tasks = queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return sum(len(s) for s in list(self.sealed)) + len(self.active)
+
+    def memory(self):
+        """Примерный объем индекса в памяти, байт"""
+        return sum(s.size for s in list(self.sealed)) + self.active.size
+
+    def add(self, frame, private=False):
+        """Индексация доставленного сообщения; вызывается на пути рассылки"""
+        if self.tasks.qsize() >= MAX_BACKLOG:
+            # Поток не успевает: лучше пропустить сообщение в поиске, чем копить память
+            self.skipped += 1
+            return
+        self.tasks.put((self.index, (frame, private, self.clock())))
+
+    def submit(self, callback, *args):
+        """Запрос в фоновом потоке индекса; False, если запросов в очереди слишком много"""
+        if not self.query_slots.acquire(blocking=False):
+            return False
+        self.tasks.put((self.answer, (callback, args)))
+        return True
+
+    def answer(self, callback, args):
+        """Выполнение запроса и освобождение места в очереди"""
+        try:
+            callback(*args)
+        finally:
+            self.query_slots.release()
+
+    def run(self):
+        """Фоновый поток: документы, запросы и слияние сегментов по порядку"""
+        while True:
+            callback, args = self.tasks.get()
+            if callback is None:
+                return
+            try:
+                callback(*args)
+            except Exception as e:
+                log.error('ПОИСК', 'Ошибка: %s', e)
+
+    def index(self, frame, private, when):
+        """Добавление документа в открытый сегмент"""
+        message = decode_message(frame[HEADER.size:])
+        sender = message.get('username')
+        target = message.get('target') if private else None
+        tokens = tokenize(message.get('text') or '')
+        if sender:
+            tokens.append(SENDER_PREFIX + normalize(sender))
+        self.active.add(frame, when, sender, target, tokens)
+        self.next_id += 1
+        if len(self.active) >= SEGMENT_DOCS:
+            self.active.freeze()
+            self.sealed.append(self.active)
+            self.active = IndexSegment(self.next_id)
+            self.compact()
+
+    def compact(self):
+        """Слияние сегментов одного уровня и удаление старых сверх лимита памяти"""
+        group = merge_group(self.sealed)
+        while group is not None:
+            start = self.sealed.index(group[0])
+            self.sealed[start:start + len(group)] = [IndexSegment.merge(group)]
+            group = merge_group(self.sealed)
+        total = self.memory()
+        while self.sealed and total > self.max_bytes:
+            total -= self.sealed.pop(0).size
+
+    def search(self, query, username, sender=None, since=None, until=None, before=None,
+               limit=None):
+        """Страница результатов: [(номер, время, кадр)] от новых к старым и курсор следующей
+
+        Вызывается в фоновом потоке индекса (через submit).
+        """
+        terms = parse_query(query or '')
+        if sender:
+            terms.append((SENDER_PREFIX + normalize(sender), False))
+        limit = max(1, min(limit or PAGE_SIZE, MAX_PAGE_SIZE))
+        results = []
+        # На одну запись больше: так известно, есть ли следующая страница
+        want = limit + 1
+        for segment in [self.active] + self.sealed[::-1]:
+            if len(results) >= want:
+                break
+            segment.search(terms, username, since, until, before, want, results)
+        next_cursor = results[limit - 1][0] if len(results) > limit else None
+        return results[:limit], next_cursor
+
+    def close(self):
+        """Остановка фонового потока после уже поставленных задач"""
+        self.tasks.put((None, ()))
+
+
+def merge_group(segments):
+    """Подряд идущие MERGE_FACTOR замороженных сегментов одного уровня; None - сливать нечего"""
+    run = []
+    for segment in segments:
+        if segment.level >= MAX_LEVEL:
+            run = []
+            continue
+        if run and run[-1].level != segment.level:
+            run = []
+        run.append(segment)
+        if len(run) == MERGE_FACTOR:
+            return run
+    return None
@@ -4,44 +4,252 @@
 Запустите этот файл первым на одном компьютере
 """
 
+import argparse
+import asyncio
+import math
+import os
+import secrets
+import signal
 import socket
 import threading
-import json
+import time
 from datetime import datetime
 
+from messenger_capture import TrafficCapture
+from messenger_files import TRANSFER_TYPES, FileStore, format_size
+from messenger_handoff import HandoffListener, take_over
+from messenger_limits import LIMIT_SERVER, RateLimiter
+from messenger_log import LEVELS, log
+from messenger_metrics import ServerMetrics, start_http_server
+from messenger_outbox import (AsyncOutbox, DISCONNECT, Outbox, ParkedOutbox, POLICIES,
+                              close_all, set_keepalive, set_nodelay)
+from messenger_profile import ServerProfiler
+from messenger_protocol import (ENCODING_BINARY, ENCODING_JSON, FrameDecoder, HEADER, NameTable,
+                                ProtocolError, RECV_SIZE, WireFormat, decode_message,
+                                encode_message, negotiate)
+from messenger_search import SearchIndex
+from messenger_sessions import Session, SessionRegistry
+from messenger_store import MessageLog
+from messenger_timers import TimerWheel
+
+MAX_ROOM_NAME = 64
+# Шаг колеса проверок простоя, сек
+REAPER_TICK = 0.5
+PING_FRAME = encode_message({'type': 'ping'})
+PONG_FRAME = encode_message({'type': 'pong'})
+# Проверку связи не ограничиваем: иначе флудящего клиента еще и отключит по простою
+UNLIMITED_TYPES = frozenset(('ping', 'pong'))
+# Не чаще одного уведомления об ограничении в столько секунд
+LIMIT_NOTICE_INTERVAL = 1.0
+# Как часто поток приема проверяет, не передан ли слушающий сокет новому процессу, сек
+ACCEPT_POLL = 0.5
+# Шаг волн переподключения после передачи сокета, сек
+DRAIN_TICK = 0.5
+
+
+def room_name(room):
+    """Название комнаты в том виде, в каком оно хранится; None - недопустимое"""
+    room = str(room).strip()
+    if not room or len(room) > MAX_ROOM_NAME:
+        return None
+    return room
+
+
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555):
+    def __init__(self, host='0.0.0.0', port=5555, backlog=128,
+                 queue_size=1000, queue_policy=DISCONNECT, block_timeout=5.0,
+                 flush_window=0.0, history_dir=None, history_size=50,
+                 segment_bytes=16 * 1024 * 1024, retention_bytes=256 * 1024 * 1024,
+                 fsync_interval=1.0, metrics_port=None, presence_delay=0.05,
+                 ping_interval=20.0, idle_timeout=60.0,
+                 user_rate=20.0, user_bytes=64 * 1024, ip_rate=100.0, ip_bytes=256 * 1024,
+                 fanout_rate=200000, limit_burst=2.0,
+                 files_dir=None, max_file_size=100 * 1024 * 1024, files_ttl=24 * 3600,
+                 resume_timeout=30.0, replay_size=256, handoff_path=None, drain_rate=200,
+                 search_memory=64 * 1024 * 1024, capture_path=None):
         self.host = host
         self.port = port
-        self.clients = {}  # {client_socket: {'username': str, 'address': tuple}}
+        self.backlog = backlog
+        # Ограничение исходящей очереди каждого клиента и политика при переполнении
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.block_timeout = block_timeout
+        # Окно склейки исходящих кадров в одну запись, сек
+        self.flush_window = flush_window
+        # Журнал сообщений на диске и сколько последних показывать при входе;
+        # открывается при запуске, когда прежний процесс его уже отпустил
+        self.history = None
+        self.history_dir = history_dir
+        self.history_options = (segment_bytes, retention_bytes, fsync_interval)
+        self.history_size = history_size
+        # Подключенные пользователи по соединению и по имени, участники комнат
+        self.sessions = SessionRegistry()
+        # Номера имен для двоичной кодировки и кодировки, согласованные клиентами
+        self.names = NameTable()
+        self.wires = {}    # {(кодировка, сжатие): WireFormat}
+        # Изменения присутствия копятся presence_delay секунд и уходят одной дельтой
+        self.presence_delay = presence_delay
+        self.presence_seq = 0
+        self.presence_changes = set()
+        self.presence_scheduled = False
+        self.presence_lock = threading.Lock()
+        # Рассылки дельт не должны обгонять друг друга, иначе клиент увидит пропуск seq
+        self.presence_flush_lock = threading.Lock()
+        # Проверка связи: ping молчащему клиенту, отключение после idle_timeout (0 - не проверять)
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.reaper = TimerWheel(REAPER_TICK)
+        # Продолжение сессии после обрыва: сколько ждать клиента и сколько
+        # отправленных кадров помнить для досылки (0 - не продолжать)
+        self.resume_timeout = resume_timeout
+        self.replay_size = replay_size
+        self.resumable = {}   # {token: Session}; изменяется только под resume_lock
+        self.resume_lock = threading.Lock()
+        # Лимиты частоты до рассылки; None - все выключены
+        self.limiter = RateLimiter(user_rate, user_bytes, ip_rate, ip_bytes, fanout_rate, limit_burst)
+        if not self.limiter.enabled():
+            self.limiter = None
+        # Файлы, ожидающие получателя; байты идут по отдельным соединениям данных
+        self.files = FileStore(files_dir, max_file_size, files_ttl)
+        # Поиск по сообщениям с запуска процесса; None - выключен
+        self.search = SearchIndex(search_memory) if search_memory else None
+        # Запись входящего трафика для messenger_replay.py; None - не ведется
+        self.capture = TrafficCapture(capture_path) if capture_path else None
+        # Перезапуск без простоя: путь Unix сокета для следующего процесса
+        # и сколько клиентов в секунду отправлять к нему после передачи
+        self.handoff_path = handoff_path
+        self.drain_rate = drain_rate
+        self.handoff = None
+        self.draining = False
+        # Связь с другим процессом, пока старый отпускает клиентов, и его пользователи
+        self.handoff_link = None
+        self.relay_users = set()
+        self.relayed_users = None   # свой список, последний раз отправленный по связи
+        self.stopped = threading.Event()
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Метрики собираются всегда; HTTP выдача - только если задан порт
+        self.metrics = ServerMetrics()
+        self.metrics_port = metrics_port
+        self.metrics_http = None
+        self.register_gauges()
         
-    def start(self):
+    def register_gauges(self):
+        """Показатели, которые вычисляются только при чтении метрик"""
+        registry = self.metrics.registry
+        registry.gauge('messenger_users', 'Подключено пользователей', lambda: len(self.sessions))
+        registry.gauge('messenger_rooms', 'Открыто комнат', lambda: len(self.sessions.rooms))
+        registry.gauge('messenger_queue_depth_total', 'Кадров во всех исходящих очередях',
+                       lambda: sum(self.queue_depths().values()))
+        registry.gauge('messenger_queue_depth_max', 'Самая длинная исходящая очередь',
+                       lambda: max(self.queue_depths().values(), default=0))
+        registry.gauge('messenger_parked_sessions', 'Сессий, ожидающих возвращения клиента',
+                       lambda: sum(isinstance(session.outbox, ParkedOutbox)
+                                   for session in self.sessions.snapshot()))
+        registry.gauge('messenger_limiter_buckets', 'Ведер лимитов частоты в памяти',
+                       lambda: self.limiter.size() if self.limiter is not None else 0)
+        registry.gauge('messenger_search_documents', 'Сообщений в поисковом индексе',
+                       lambda: len(self.search) if self.search is not None else 0)
+        registry.gauge('messenger_search_bytes', 'Примерный объем поискового индекса, байт',
+                       lambda: self.search.memory() if self.search is not None else 0)
+        registry.gauge('messenger_log_dropped', 'Записей журнала пропущено при перегрузке',
+                       lambda: log.dropped)
+    
+    def start_metrics(self):
+        """Запуск HTTP выдачи метрик на локальном порту"""
+        if self.metrics_port:
+            self.metrics_http = start_http_server(self.metrics.registry, '127.0.0.1',
+                                                  self.metrics_port)
+            print(f"[МЕТРИКИ] http://127.0.0.1:{self.metrics_port}/metrics")
+    
+    def open_listener(self):
+        """Слушающий сокет (свой или унаследованный от работающего процесса) и журнал"""
+        listener, link = take_over(self.handoff_path) if self.handoff_path else (None, None)
+        if listener is not None:
+            self.server.close()
+            self.server = listener
+            log.info('ПЕРЕЗАПУСК', 'Слушающий сокет получен от работающего процесса')
+        else:
+            self.server.bind((self.host, self.port))
+            self.server.listen(self.backlog)
+        if self.history_dir:
+            self.history = MessageLog(self.history_dir, *self.history_options)
+        if link is not None:
+            # Пока старый процесс отпускает клиентов, чат с ними общий
+            self.attach_handoff(link)
+            link.start()
+        if self.handoff_path:
+            self.handoff = HandoffListener(self.handoff_path, self.server, self.hand_off)
+    
+    def start(self, console=True):
         """Запуск сервера"""
-        self.server.bind((self.host, self.port))
-        self.server.listen(5)
+        self.open_listener()
         print(f"[СЕРВЕР] Запущен на {self.host}:{self.port}")
         print(f"[СЕРВЕР] IP адрес сервера: {self.get_local_ip()}")
+        self.start_metrics()
+        self.start_reaper()
         
         # Поток для принятия новых подключений
         accept_thread = threading.Thread(target=self.accept_clients)
         accept_thread.daemon = True
         accept_thread.start()
         
-        # Основной цикл сервера
+        if console:
+            console_thread = threading.Thread(target=self.run_console_thread)
+            console_thread.daemon = True
+            console_thread.start()
+        
+        # Основной цикл сервера: до exit, Ctrl-C или конца передачи клиентов
         try:
-            while True:
-                command = input()
-                if command.lower() == 'exit':
-                    break
-                elif command.lower() == 'users':
-                    self.show_users()
+            self.stopped.wait()
         except KeyboardInterrupt:
             pass
         finally:
             self.shutdown()
     
+    def start_reaper(self):
+        """Один поток продвигает колесо проверок простоя всех соединений"""
+        if self.idle_timeout or self.resume_timeout:
+            reaper_thread = threading.Thread(target=self.run_reaper)
+            reaper_thread.daemon = True
+            reaper_thread.start()
+    
+    def run_reaper(self):
+        """Шаги колеса проверок простоя"""
+        while True:
+            time.sleep(self.reaper.tick)
+            try:
+                self.reaper.advance()
+            except Exception as e:
+                log.error('ОШИБКА', '%s', e)
+    
+    def run_console(self):
+        """Чтение консольных команд до команды exit"""
+        while True:
+            command = input().strip().lower()
+            if command == 'exit':
+                break
+            self.handle_command(command)
+    
+    def run_console_thread(self):
+        """Чтение консоли в отдельном потоке с остановкой сервера по exit"""
+        try:
+            self.run_console()
+        except EOFError:
+            pass
+        self.stop()
+    
+    def stop(self):
+        """Остановка сервера из любого потока"""
+        self.stopped.set()
+    
+    def handle_command(self, command):
+        """Выполнение консольной команды"""
+        if command == 'users':
+            self.show_users()
+        elif command == 'stats':
+            self.show_stats()
+    
     def get_local_ip(self):
         """Получение локального IP адреса"""
         try:
@@ -56,10 +264,19 @@ class ChatServer:
     
     def accept_clients(self):
         """Принятие новых клиентов"""
-        while True:
+        # Таймаут - чтобы перестать принимать, когда сокет передан новому процессу
+        self.server.settimeout(ACCEPT_POLL)
+        while not self.draining:
             try:
                 client_socket, address = self.server.accept()
-                print(f"[ПОДКЛЮЧЕНИЕ] Новое подключение от {address}")
+                set_nodelay(client_socket)
+                if self.idle_timeout:
+                    # Клиенты без ping проверяет само ядро
+                    set_keepalive(client_socket, self.idle_timeout)
+                self.metrics.connections.inc()
+                log.info('ПОДКЛЮЧЕНИЕ', 'Новое подключение от %s', address)
+                if self.capture is not None:
+                    self.capture.connect(client_socket)
                 
                 # Запускаем поток для обработки клиента
                 client_thread = threading.Thread(
@@ -68,151 +285,984 @@ class ChatServer:
                 )
                 client_thread.daemon = True
                 client_thread.start()
+            except socket.timeout:
+                continue
             except:
                 break
     
     def handle_client(self, client_socket, address):
         """Обработка сообщений от клиента"""
+        decoder = FrameDecoder()
+        username = None
+        join_timer = self.watch_join(client_socket)
         try:
-            # Получаем имя пользователя
-            data = client_socket.recv(1024).decode('utf-8')
-            message = json.loads(data)
-            
-            if message['type'] == 'join':
-                username = message['username']
-                self.clients[client_socket] = {
-                    'username': username,
-                    'address': address
-                }
-                
-                print(f"[ПОЛЬЗОВАТЕЛЬ] {username} присоединился к чату")
-                
-                # Отправляем подтверждение
-                response = {
-                    'type': 'system',
-                    'message': 'Успешно подключено к серверу',
-                    'timestamp': datetime.now().strftime('%H:%M:%S')
-                }
-                client_socket.send(json.dumps(response).encode('utf-8'))
-                
-                # Уведомляем всех о новом пользователе
-                self.broadcast({
-                    'type': 'user_joined',
-                    'username': username,
-                    'message': f'{username} присоединился к чату',
-                    'timestamp': datetime.now().strftime('%H:%M:%S')
-                }, exclude_client=client_socket)
-                
-                # Отправляем список активных пользователей
-                self.send_user_list()
+            while True:
+                data = client_socket.recv(RECV_SIZE)
+                if not data:
+                    break
+                self.metrics.bytes_in.inc(len(data))
+                self.touch(client_socket)
                 
-                # Обрабатываем сообщения от клиента
-                while True:
-                    data = client_socket.recv(1024).decode('utf-8')
-                    if not data:
-                        break
-                    
-                    message = json.loads(data)
-                    
-                    if message['type'] == 'message':
-                        # Добавляем информацию об отправителе
-                        message['username'] = username
-                        message['timestamp'] = datetime.now().strftime('%H:%M:%S')
-                        
-                        print(f"[СООБЩЕНИЕ] {username}: {message['text']}")
-                        
-                        # Рассылаем всем клиентам
-                        self.broadcast(message)
-                    
-                    elif message['type'] == 'private':
-                        # Приватное сообщение
-                        target_user = message['target']
-                        message['username'] = username
-                        message['timestamp'] = datetime.now().strftime('%H:%M:%S')
-                        
-                        self.send_private_message(message, target_user, client_socket)
+                # В одном куске может быть несколько кадров или часть кадра
+                for payload in decoder.feed(data):
+                    message = decode_message(payload)
+                    if username is None and message['type'] in TRANSFER_TYPES:
+                        # Соединение данных: дальше по нему идут сырые байты файла
+                        if join_timer is not None:
+                            join_timer.cancel()
+                        self.serve_transfer(client_socket, address, message, decoder.rest())
+                        return
+                    username = self.dispatch(client_socket, address, username,
+                                             message, len(payload))
         
         except Exception as e:
-            print(f"[ОШИБКА] {e}")
+            log.error('ОШИБКА', '%s', e)
         
         finally:
-            # Удаляем клиента при отключении
-            if client_socket in self.clients:
-                username = self.clients[client_socket]['username']
-                del self.clients[client_socket]
-                
-                print(f"[ОТКЛЮЧЕНИЕ] {username} покинул чат")
-                
-                # Уведомляем остальных
-                self.broadcast({
-                    'type': 'user_left',
-                    'username': username,
-                    'message': f'{username} покинул чат',
-                    'timestamp': datetime.now().strftime('%H:%M:%S')
-                })
-                
-                self.send_user_list()
-            
+            if join_timer is not None:
+                join_timer.cancel()
+            self.connection_lost(client_socket)
             client_socket.close()
     
+    def dispatch(self, client, address, username, message, size=0):
+        """Обработка входящего сообщения; возвращает имя пользователя соединения"""
+        started = time.perf_counter()
+        if self.capture is not None:
+            self.capture.message(client, message)
+        if username is None:
+            # Первым сообщением клиент сообщает свое имя
+            if message['type'] != 'join':
+                raise ProtocolError('Первым сообщением должен быть join')
+            username = message['username']
+            self.register_client(client, username, address, message)
+        elif self.limiter is None or self.admit(client, username, address, message, size):
+            self.process_message(client, username, message)
+        self.metrics.messages_in.inc()
+        self.metrics.handle_seconds.observe(time.perf_counter() - started)
+        return username
+    
+    def register_client(self, client, username, address, join=None):
+        """Регистрация нового пользователя после сообщения join"""
+        join = join or {}
+        if join.get('token') and self.resume_session(client, username, address, join):
+            return
+        # Клиенту, который умеет продолжать сессию, - токен и история отправленного
+        token = None
+        if join.get('resume') and self.resume_timeout and self.replay_size:
+            token = secrets.token_hex(16)
+        # Понимает ли клиент дельты присутствия; старым шлем полный список
+        session = Session(client, username, address,
+                          self.create_outbox(client, self.replay_size if token else 0),
+                          presence=bool(join.get('presence')),
+                          heartbeat=bool(join.get('heartbeat')), token=token)
+        encoding, compress = negotiate(join)
+        if encoding != ENCODING_JSON or compress:
+            session.wire = self.wire_for(encoding, compress)
+        if not self.add_session(session, lambda: self.greet(session, encoding, compress)):
+            # Второе подключение с тем же именем: отказ до выдачи имени и
+            # соединение закрывается обработчиком после ошибки
+            session.outbox.put(encode_message({
+                'type': 'system',
+                'error': 'username_taken',
+                'message': f'Имя {username} уже занято',
+                'timestamp': datetime.now().strftime('%H:%M:%S')
+            }))
+            session.outbox.close()
+            raise ProtocolError(f'Имя {username} уже занято')
+        if token:
+            with self.resume_lock:
+                self.resumable[token] = session
+        
+        log.info('ПОЛЬЗОВАТЕЛЬ', '%s присоединился к чату', username)
+        self.watch_idle(session)
+        
+        # Номер имени для двоичной кодировки остальных клиентов
+        self.publish_name(username)
+        
+        # Последние сообщения из журнала
+        self.send_history(client, username)
+        
+        # Уведомляем всех о новом пользователе
+        self.broadcast_notice({
+            'type': 'user_joined',
+            'username': username,
+            'message': f'{username} присоединился к чату',
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        }, exclude_client=client)
+        
+        # Полный список - только новому пользователю, остальным - дельта
+        self.send_to(client, encode_message(self.user_list_message()))
+        self.presence_changed(username)
+    
+    def admit(self, client, username, address, message, size):
+        """Проверка лимитов частоты до рассылки; False - сообщение отброшено"""
+        if message['type'] in UNLIMITED_TYPES:
+            return True
+        wait, scope = self.limiter.admit(username, address[0], size,
+                                         self.fanout_cost(client, message))
+        if not wait:
+            return True
+        self.metrics.throttled.inc()
+        # Одно уведомление на период ожидания, а не на каждое отброшенное сообщение
+        session = self.sessions.get(client)
+        now = time.monotonic()
+        if session is not None and now >= session.throttled_until:
+            session.throttled_until = now + max(wait, LIMIT_NOTICE_INTERVAL)
+            wait = max(wait, 0.1)
+            if scope == LIMIT_SERVER:
+                text = f'Сервер перегружен: сообщение не отправлено, повторите через {wait:.1f} с'
+            else:
+                text = f'Слишком много сообщений: сообщение не отправлено, подождите {wait:.1f} с'
+            log.warning('ЛИМИТ', '%s (%s): %s, ожидание %.1f с', username, address[0], scope, wait)
+            self.send_system(client, text, error='rate_limited')
+        return False
+    
+    def fanout_cost(self, client, message):
+        """Во сколько доставок обойдется сообщение"""
+        message_type = message['type']
+        if message_type == 'message':
+            return len(self.sessions)
+        if message_type == 'room_message':
+            return self.sessions.room_size(room_name(message.get('room')))
+        if message_type == 'private':
+            # Получатель и копия отправителю
+            return 2
+        return 1
+    
+    def greet(self, session, encoding, compress):
+        """Подтверждение входа; вызывается под замком реестра, раньше любой рассылки сессии"""
+        # Подтверждение с выбранной кодировкой всегда в JSON - мимо session.wire
+        ack = {
+            'type': 'system',
+            'message': 'Успешно подключено к серверу',
+            'encoding': encoding,
+            'compress': compress,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        }
+        if session.token:
+            ack['token'] = session.token
+        session.outbox.put(encode_message(ack))
+        if encoding == ENCODING_BINARY:
+            # Таблица имен до первого сообщения, которое на нее ссылается
+            self.deliver(session, encode_message(self.names.definition()))
+    
+    def process_message(self, client, username, message):
+        """Обработка одного сообщения от подключенного пользователя"""
+        if message['type'] == 'message':
+            # Добавляем информацию об отправителе
+            message['username'] = username
+            message['timestamp'] = datetime.now().strftime('%H:%M:%S')
+            
+            log.info('СООБЩЕНИЕ', '%s: %s', username, message['text'])
+            
+            # Рассылаем всем клиентам
+            frame = self.broadcast(message)
+            self.log_event(frame)
+        
+        elif message['type'] == 'private':
+            # Приватное сообщение
+            target_user = message['target']
+            message['username'] = username
+            message['timestamp'] = datetime.now().strftime('%H:%M:%S')
+            
+            frame = self.send_private_message(message, target_user, client)
+            if frame is not None:
+                self.log_event(frame, private=True)
+        
+        elif message['type'] == 'ping':
+            # Клиент проверяет связь: сам факт приема уже отметил активность
+            self.send_to(client, PONG_FRAME)
+        
+        elif message['type'] == 'pong':
+            pass
+        
+        elif message['type'] == 'file_offer':
+            self.offer_file(client, username, message)
+        
+        elif message['type'] in ('file_accept', 'file_decline'):
+            self.answer_file(client, username, message)
+        
+        elif message['type'] == 'search':
+            self.search_messages(client, username, message)
+        
+        elif message['type'] == 'leave':
+            # Клиент выходит сам: ждать его возвращения не нужно
+            with self.resume_lock:
+                self.resumable.pop(self.sessions.get(client).token, None)
+        
+        elif message['type'] == 'user_list':
+            # Клиент пропустил дельту (например, при drop_oldest) и просит полный список
+            self.send_to(client, encode_message(self.user_list_message()))
+        
+        elif message['type'] == 'room_join':
+            self.join_room(client, username, message['room'])
+        
+        elif message['type'] == 'room_leave':
+            self.leave_room(client, username, message['room'])
+        
+        elif message['type'] == 'room_message':
+            room = room_name(message['room'])
+            session = self.sessions.get(client)
+            if session is None or room not in session.rooms:
+                self.send_system(client, f'Вы не состоите в комнате {message["room"]}')
+                return
+            message['room'] = room
+            message['username'] = username
+            message['timestamp'] = datetime.now().strftime('%H:%M:%S')
+            
+            log.info('КОМНАТА', '%s %s: %s', room, username, message['text'])
+            
+            # Рассылаем только участникам комнаты
+            self.send_to_room(room, message)
+    
+    def offer_file(self, client, username, message):
+        """Предложение файла: место в хранилище и уведомление получателя"""
+        size = message.get('size')
+        if not isinstance(size, int) or size < 0:
+            self.send_system(client, 'Неверный размер файла', error='bad_file')
+            return
+        if size > self.files.max_size:
+            self.send_system(client, f'Файл больше {format_size(self.files.max_size)}',
+                             error='file_too_large')
+            return
+        target = message['target']
+        meta = self.files.create(username, target, message.get('name'), size)
+        offer = {
+            'type': 'file_offer',
+            'id': meta['id'],
+            'name': meta['name'],
+            'size': size,
+            'ref': message.get('ref'),
+            'username': username,
+            'target': target,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        }
+        # Получателю и копия отправителю: по ref он узнает id передачи
+        if self.send_private_message(offer, target, client) is None:
+            self.files.remove(meta['id'])
+            return
+        log.info('ФАЙЛ', '%s -> %s: %s (%s)', username, target, meta['name'], format_size(size))
+    
+    def answer_file(self, client, username, message):
+        """Согласие или отказ получателя; отправитель после согласия начинает загрузку"""
+        meta = self.files.meta(message.get('id'))
+        if meta is None or meta['target'] != username:
+            self.send_system(client, 'Файл не найден или уже получен', error='file_not_found')
+            return
+        if message['type'] == 'file_decline':
+            self.files.remove(meta['id'])
+        answer = {
+            'type': message['type'],
+            'id': meta['id'],
+            'name': meta['name'],
+            'size': meta['size'],
+            'username': username,
+            'target': meta['sender'],
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        }
+        if self.send_private_message(answer, meta['sender'], client) is None:
+            # Отправитель ушел, не загрузив файл: ждать нечего
+            self.files.remove(meta['id'])
+    
+    def serve_transfer(self, sock, address, request, initial):
+        """Соединение данных в потоке обработчика: загрузка или скачивание файла"""
+        # Зависшая загрузка не должна держать поток вечно
+        self.count_transfer(address, *self.files.serve(sock, request, initial,
+                                                       self.idle_timeout or None))
+    
+    def count_transfer(self, address, direction, count, done):
+        """Учет переданных байтов файла"""
+        if direction == 'file_put':
+            self.metrics.file_bytes_in.inc(count)
+            state = 'загружен' if done else 'загрузка прервана'
+        else:
+            self.metrics.file_bytes_out.inc(count)
+            if done:
+                self.metrics.files_delivered.inc()
+            state = 'получен' if done else 'скачивание прервано'
+        log.info('ФАЙЛ', '%s: %s, %s', address, state, format_size(count))
+    
+    def search_messages(self, client, username, message):
+        """Поисковый запрос: проверка и постановка в очередь потока индекса"""
+        if self.search is None:
+            self.send_system(client, 'Поиск на сервере выключен', error='search_disabled')
+            return
+        query = message.get('query') or ''
+        sender = message.get('from')
+        numbers = [message.get(key) for key in ('since', 'until', 'before', 'limit')]
+        if (not isinstance(query, str) or not (sender is None or isinstance(sender, str))
+                or not all(n is None or isinstance(n, (int, float)) and math.isfinite(n)
+                           for n in numbers)):
+            self.send_system(client, 'Неверный поисковый запрос', error='bad_search')
+            return
+        if not self.search.submit(self.answer_search, client, username, message):
+            self.send_system(client, 'Сервер занят поиском, повторите позже', error='search_busy')
+    
+    def answer_search(self, client, username, message):
+        """Выполнение запроса в потоке индекса и отправка страницы результатов"""
+        started = time.perf_counter()
+        before = message.get('before')
+        limit = message.get('limit')
+        results, next_cursor = self.search.search(
+            message.get('query') or '', username, message.get('from'),
+            message.get('since'), message.get('until'),
+            int(before) if before is not None else None, int(limit) if limit else None)
+        found = []
+        for _, when, frame in results:
+            event = decode_message(frame[HEADER.size:])
+            # Время сообщения в кадре - только часы; для поиска по датам нужно полное
+            event['time'] = round(when, 3)
+            found.append(event)
+        self.metrics.search_seconds.observe(time.perf_counter() - started)
+        self.send_from_thread(client, encode_message({
+            'type': 'search_results',
+            'query': message.get('query') or '',
+            'ref': message.get('ref'),
+            'results': found,
+            'next': next_cursor,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        }))
+    
+    def send_from_thread(self, client, data):
+        """Отправка кадра из фонового потока; клиент мог уже отключиться"""
+        try:
+            self.send_to(client, data)
+        except ConnectionError:
+            pass
+    
+    def join_room(self, client, username, room):
+        """Вход пользователя в комнату (комната создается при первом входе)"""
+        room = room_name(room)
+        if room is None:
+            self.send_system(client, 'Недопустимое название комнаты')
+            return
+        session = self.sessions.get(client)
+        if session is None or not self.sessions.join_room(session, room):
+            return
+        self.send_to_room(room, {
+            'type': 'room_joined',
+            'room': room,
+            'username': username,
+            'message': f'{username} вошел в комнату {room}',
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        })
+    
+    def leave_room(self, client, username, room):
+        """Выход пользователя из комнаты"""
+        room = room_name(room)
+        session = self.sessions.get(client)
+        if session is None or room not in session.rooms:
+            return
+        # Уходящий тоже получает уведомление, чтобы закрыть комнату у себя
+        self.send_to_room(room, self.room_left_message(username, room))
+        self.sessions.leave_room(session, room)
+    
+    def room_left_message(self, username, room):
+        """Уведомление участникам о выходе пользователя из комнаты"""
+        return {
+            'type': 'room_left',
+            'room': room,
+            'username': username,
+            'message': f'{username} вышел из комнаты {room}',
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        }
+    
+    def send_to_room(self, room, message):
+        """Отправка сообщения участникам комнаты; возвращает кадр"""
+        frame = encode_message(message)
+        self.room_frame(room, frame)
+        self.relay({'handoff': 'room', 'room': room, 'message': message})
+        return frame
+    
+    def room_frame(self, room, frame):
+        """Рассылка готового кадра участникам комнаты в этом процессе"""
+        for session in self.sessions.room_members(room):
+            try:
+                self.deliver(session, frame)
+            except:
+                pass
+    
+    def send_system(self, client, text, error=None):
+        """Системное сообщение одному клиенту; error - код ошибки для программ"""
+        message = {
+            'type': 'system',
+            'message': text,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        }
+        if error:
+            message['error'] = error
+        self.send_to(client, encode_message(message))
+    
+    def log_event(self, frame, private=False, relayed=False):
+        """Запись доставленного сообщения в журнал и поисковый индекс
+
+        relayed - запись пришла от другого процесса и обратно не пересылается.
+        """
+        history = self.history
+        if history is not None and history.append(frame, private) is not None:
+            pass
+        elif self.handoff_link is not None and not relayed:
+            # Журнал уже отдан новому процессу: запись делает он
+            self.relay({'handoff': 'log', 'message': decode_message(frame[HEADER.size:]),
+                        'private': private})
+        if self.search is not None:
+            self.search.add(frame, private)
+    
+    def send_history(self, client, username):
+        """Отправка последних сообщений из журнала новому пользователю"""
+        if self.history is None or not self.history_size:
+            return
+        # Приватные сообщения видят только их участники
+        frames = self.history.tail(
+            self.history_size,
+            visible=lambda m: username in (m.get('username'), m.get('target')))
+        if frames:
+            self.send_to(client, encode_message({
+                'type': 'system',
+                'message': f'История чата (сообщений: {len(frames)})',
+                'timestamp': datetime.now().strftime('%H:%M:%S')
+            }))
+            # Кадры журнала уже в формате протокола. В очередь - по одному: номер
+            # кадра для восстановления сессии считается по записям очереди
+            session = self.sessions.get(client)
+            if session is None:
+                raise ConnectionError('Клиент уже отключен')
+            if session.wire is not None:
+                frames = [session.wire.transcode(frame) for frame in frames]
+            session.outbox.extend(frames)
+    
+    def remove_client(self, client):
+        """Удаление клиента при отключении"""
+        # Удаляет только один из потоков, даже если отключение заметили несколько
+        session = self.sessions.remove(client)
+        if session is not None:
+            username = session.username
+            if session.token:
+                with self.resume_lock:
+                    self.resumable.pop(session.token, None)
+            for room in self.sessions.leave_rooms(session):
+                self.send_to_room(room, self.room_left_message(username, room))
+            self.metrics.disconnections.inc()
+            session.outbox.close(wait=False)
+            
+            log.info('ОТКЛЮЧЕНИЕ', '%s покинул чат', username)
+            
+            # Уведомляем остальных
+            self.broadcast_notice({
+                'type': 'user_left',
+                'username': username,
+                'message': f'{username} покинул чат',
+                'timestamp': datetime.now().strftime('%H:%M:%S')
+            })
+            
+            self.presence_changed(username)
+    
+    def connection_lost(self, client):
+        """Соединение закрылось: сессию, которую клиент может продолжить, придерживаем"""
+        if self.capture is not None:
+            self.capture.disconnect(client)
+        session = self.sessions.get(client)
+        if session is not None and self.resumable.get(session.token) is session:
+            self.park(session)
+        else:
+            self.remove_client(client)
+    
+    def park(self, session):
+        """Клиент потерял связь: кадры для него копятся resume_timeout секунд"""
+        with self.resume_lock:
+            outbox = session.outbox
+            if isinstance(outbox, ParkedOutbox):
+                return
+            session.outbox = ParkedOutbox(outbox)
+            if session.idle_timer is not None:
+                session.idle_timer.cancel()
+        # Писатель старой очереди должен остановиться: его остаток - часть досылки
+        outbox.close()
+        log.info('ОТКЛЮЧЕНИЕ', '%s потерял связь, ждем возвращения %.0f с',
+                 session.username, self.resume_timeout)
+        self.reaper.schedule(self.resume_timeout, self.expire_session, session, session.outbox)
+    
+    def expire_session(self, session, parked):
+        """Клиент не вернулся вовремя: обычный выход с рассылкой ухода"""
+        if session.outbox is parked:
+            self.forget_session(session)
+    
+    def forget_session(self, session):
+        """Удаление сессии без возможности продолжения"""
+        with self.resume_lock:
+            if self.resumable.get(session.token) is session:
+                del self.resumable[session.token]
+        if not isinstance(session.outbox, ParkedOutbox):
+            self.drop_connection(session.client)
+        self.remove_client(session.client)
+    
+    def resume_session(self, client, username, address, join):
+        """Продолжение сессии по токену с досылкой пропущенного; None - не получилось"""
+        session = self.resumable.get(join['token'])
+        if session is None or session.username != username:
+            return None
+        if not isinstance(session.outbox, ParkedOutbox):
+            # Сервер еще не заметил обрыв (например, клиент сменил сеть)
+            self.drop_connection(session.client)
+            self.park(session)
+        with self.resume_lock:
+            parked = session.outbox
+            if self.resumable.get(join['token']) is not session or \
+                    not isinstance(parked, ParkedOutbox):
+                return None
+            with parked.lock:
+                frames = parked.backlog(join.get('last_seq'))
+                if frames is not None:
+                    outbox = self.create_outbox(client, self.replay_size)
+                    # Нумерация продолжается с того, что клиент уже получил
+                    outbox.frames_sent = join['last_seq']
+                    outbox.put(encode_message({
+                        'type': 'system',
+                        'message': 'Связь восстановлена',
+                        'encoding': session.wire.encoding if session.wire else ENCODING_JSON,
+                        'compress': session.wire.compress if session.wire else False,
+                        'token': session.token,
+                        'resumed': True,
+                        'timestamp': datetime.now().strftime('%H:%M:%S')
+                    }))
+                    outbox.extend(frames)
+                    self.sessions.move(session, client)
+                    session.address = address
+                    session.last_seen = time.monotonic()
+                    session.outbox = outbox
+                    parked.closed = True
+        if frames is None:
+            # Пропущенного уже не восстановить: обычный вход с полным списком и историей
+            log.info('ПОЛЬЗОВАТЕЛЬ', '%s: пропущенное не сохранилось, новый вход', username)
+            self.forget_session(session)
+            return None
+        self.metrics.resumed.inc()
+        log.info('ПОЛЬЗОВАТЕЛЬ', '%s вернулся, дослано сообщений: %d', username, len(frames))
+        self.watch_idle(session)
+        return session
+    
+    def touch(self, client):
+        """Отметка активности соединения: проверка простоя смотрит на нее лениво"""
+        session = self.sessions.get(client)
+        if session is not None:
+            session.last_seen = time.monotonic()
+    
+    def watch_join(self, client):
+        """Проверка, что новое подключение вошло в чат за idle_timeout"""
+        if not self.idle_timeout:
+            return None
+        return self.reaper.schedule(self.idle_timeout, self.check_joined, client)
+    
+    def check_joined(self, client):
+        """Закрытие подключения, которое так и не прислало join"""
+        if client not in self.sessions:
+            log.info('ТАЙМАУТ', 'Подключение без входа за %.0f с', self.idle_timeout)
+            self.metrics.reaped.inc()
+            self.drop_connection(client)
+    
+    def watch_idle(self, session):
+        """Постановка первой проверки простоя сессии"""
+        if self.idle_timeout and session.heartbeat:
+            session.idle_timer = self.reaper.schedule(self.ping_interval or self.idle_timeout,
+                                                      self.check_idle, session)
+    
+    def check_idle(self, session):
+        """Проверка простоя: ping, следующая проверка или отключение"""
+        if self.sessions.get(session.client) is not session:
+            return  # клиент уже отключился
+        idle = time.monotonic() - session.last_seen
+        if idle >= self.idle_timeout:
+            self.reap(session, idle)
+            return
+        interval = self.ping_interval or self.idle_timeout
+        if idle >= interval:
+            # Клиент молчит: ответ на ping обновит last_seen
+            try:
+                self.deliver(session, PING_FRAME)
+            except:
+                pass
+            delay = min(interval, self.idle_timeout - idle)
+        else:
+            # Активность была: проверяем через interval после нее
+            delay = interval - idle
+        session.idle_timer = self.reaper.schedule(delay, self.check_idle, session)
+    
+    def reap(self, session, idle):
+        """Отключение молчащего клиента обычным путем, с рассылкой ухода"""
+        log.info('ТАЙМАУТ', '%s не отвечает %.0f с', session.username, idle)
+        self.metrics.reaped.inc()
+        # Сначала рвем соединение: писатель очереди не должен висеть на мертвом сокете
+        client = session.client
+        self.drop_connection(client)
+        self.connection_lost(client)
+    
+    def drop_connection(self, client):
+        """Разрыв соединения: поток обработчика выйдет из recv"""
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def end_connection(self, client):
+        """Закрытие соединения после отправленной очереди: клиент дочитает все до конца"""
+        try:
+            client.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+    
+    def hand_off(self, link):
+        """Новый процесс принимает подключения (вызывается в потоке передачи)"""
+        self.attach_handoff(link)
+        self.close_history()
+        self.begin_drain()
+    
+    def attach_handoff(self, link):
+        """Пересылка сообщений чата другому процессу на время передачи клиентов"""
+        link.attach(lambda message: self.from_handoff(self.apply_relay, message),
+                    lambda: self.from_handoff(self.relay_closed))
+        self.handoff_link = link
+        self.relayed_users = None
+        self.relay_presence()
+    
+    def from_handoff(self, callback, *args):
+        """Вызов из потока связи с другим процессом"""
+        callback(*args)
+    
+    def relay(self, message):
+        """Сообщение другому процессу, если передача клиентов еще идет"""
+        link = self.handoff_link
+        if link is not None:
+            link.relay(message)
+    
+    def relay_presence(self):
+        """Свой список пользователей другому процессу, если он изменился"""
+        if self.handoff_link is None:
+            return
+        local = self.sessions.usernames()
+        if local != self.relayed_users:
+            self.relayed_users = local
+            self.relay({'handoff': 'presence', 'users': local})
+    
+    def apply_relay(self, message):
+        """Сообщение от другого процесса: доставка своим клиентам"""
+        kind = message.get('handoff')
+        if kind == 'broadcast':
+            self.broadcast_frame(encode_message(message['message']))
+        elif kind == 'room':
+            self.room_frame(message['room'], encode_message(message['message']))
+        elif kind == 'notice':
+            self.legacy_frame(encode_message(message['message']))
+        elif kind == 'private':
+            session = self.sessions.find(message['target'])
+            if session is not None:
+                try:
+                    self.deliver(session, encode_message(message['message']))
+                except ConnectionError:
+                    pass
+        elif kind == 'presence':
+            old, self.relay_users = self.relay_users, set(message['users'])
+            for username in old.symmetric_difference(self.relay_users):
+                self.presence_changed(username)
+        elif kind == 'log':
+            self.log_event(encode_message(message['message']), message['private'], relayed=True)
+    
+    def relay_closed(self):
+        """Другой процесс закрыл связь: его пользователи исчезают из списка"""
+        self.handoff_link = None
+        users, self.relay_users = self.relay_users, set()
+        for username in users:
+            self.presence_changed(username)
+    
+    def close_handoff_link(self):
+        """Конец пересылки: отправленное дойдет, новое больше не уходит"""
+        link, self.handoff_link = self.handoff_link, None
+        if link is not None:
+            link.close()
+    
+    def close_history(self):
+        """Закрытие журнала: дальше его ведет новый процесс"""
+        history = self.history
+        self.history = None
+        if history is not None:
+            history.close()
+    
+    def begin_drain(self):
+        """Прекращение приема и отправка клиентов к новому процессу волнами
+
+        Сессии не передаются: клиент входит в новый процесс заново, без
+        досылки по токену, а пропущенное видит в истории из журнала.
+        """
+        self.draining = True
+        # Сессии продолжает уже не этот процесс
+        with self.resume_lock:
+            self.resumable.clear()
+        log.info('ПЕРЕЗАПУСК', 'Подключения принимает новый процесс, клиенты уходят к нему '
+                 'по %d в секунду', self.drain_rate)
+        self.drain_wave()
+    
+    def drain_wave(self):
+        """Одна волна: ограниченная часть клиентов переподключается к новому процессу"""
+        sessions = self.sessions.snapshot()
+        if not sessions:
+            log.info('ПЕРЕЗАПУСК', 'Все клиенты переведены на новый процесс')
+            self.stop()
+            return
+        notice = encode_message({
+            'type': 'system',
+            'message': 'Сервер перезапускается, переподключение...',
+            'reconnect': True,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        })
+        for session in sessions[:max(1, int(self.drain_rate * DRAIN_TICK))]:
+            self.drain_session(session, notice)
+        # Ушедшие тихо, но новый процесс должен убрать их из списка
+        self.relay_presence()
+        self.call_later(DRAIN_TICK, self.drain_wave)
+    
+    def drain_session(self, session, notice):
+        """Тихое отключение: остальные не видят выхода, а клиент сразу переподключается"""
+        client = session.client
+        if self.sessions.remove(client) is not session:
+            return
+        self.sessions.leave_rooms(session)
+        if session.idle_timer is not None:
+            session.idle_timer.cancel()
+        self.metrics.drained.inc()
+        if isinstance(session.outbox, ParkedOutbox):
+            session.outbox.close()
+            return
+        try:
+            self.deliver(session, notice)
+        except ConnectionError:
+            pass
+        # Очередь уходит клиенту целиком, затем соединение закрывается
+        session.outbox.close()
+        self.end_connection(client)
+    
+    def wire_for(self, encoding, compress):
+        """Общий для всех клиентов объект кодировки (кэш перекодированных кадров)"""
+        key = (encoding, compress)
+        wire = self.wires.get(key)
+        if wire is None:
+            wire = self.wires.setdefault(key, WireFormat(encoding, compress, self.names))
+        return wire
+    
+    def publish_name(self, username):
+        """Выдача номера имени и рассылка его клиентам с двоичной кодировкой"""
+        if username in self.names.published or self.names.intern(username) is None:
+            return
+        frame = encode_message(self.names.definition([username]))
+        # Клиент, чья таблица собрана до выдачи номера, но который еще не попал
+        # в реестр, иначе не узнал бы номер ни из таблицы, ни из этой рассылки
+        for session in self.sessions.snapshot(settled=True):
+            wire = session.wire
+            if wire is not None and wire.encoding == ENCODING_BINARY:
+                try:
+                    self.deliver(session, frame)
+                except:
+                    pass
+        # Номер подставляется вместо имени только после того, как его узнали все
+        self.names.publish(username)
+    
+    def create_outbox(self, client, replay=0):
+        """Исходящая очередь с собственным потоком-писателем"""
+        return Outbox(client, self.queue_size, self.queue_policy, self.block_timeout,
+                      self.flush_window, metrics=self.metrics, replay=replay)
+    
+    def add_session(self, session, on_added=None):
+        """Регистрация сессии; False, если имя уже занято"""
+        return self.sessions.add(session, on_added)
+    
+    def send_to(self, client, data):
+        """Постановка готового кадра в исходящую очередь клиента"""
+        session = self.sessions.get(client)
+        if session is None:
+            raise ConnectionError('Клиент уже отключен')
+        self.deliver(session, data)
+    
+    def deliver(self, session, data):
+        """Постановка готового кадра в исходящую очередь сессии"""
+        if session.wire is not None:
+            # Кадры собираются в JSON; перекодирование кэшируется на всю рассылку
+            data = session.wire.transcode(data)
+        outbox = session.outbox
+        try:
+            outbox.put(data)
+        except ConnectionError:
+            if session.outbox is outbox:
+                raise
+            # Очередь сменилась на ходу: связь потеряна или восстановлена
+            session.outbox.put(data)
+    
+    def queue_depths(self):
+        """Глубина исходящих очередей по пользователям"""
+        return {session.username: session.outbox.depth()
+                for session in self.sessions.snapshot()}
+    
     def broadcast(self, message, exclude_client=None):
-        """Отправка сообщения всем клиентам"""
-        message_json = json.dumps(message)
-        for client in list(self.clients.keys()):
-            if client != exclude_client:
+        """Отправка сообщения всем клиентам; возвращает отправленный кадр"""
+        frame = encode_message(message)
+        self.broadcast_frame(frame, exclude_client)
+        self.relay({'handoff': 'broadcast', 'message': message})
+        return frame
+    
+    def broadcast_frame(self, frame, exclude_client=None):
+        """Рассылка готового кадра всем клиентам этого процесса"""
+        started = time.perf_counter()
+        for session in self.sessions.snapshot():
+            if session.client is not exclude_client:
                 try:
-                    client.send(message_json.encode('utf-8'))
+                    self.deliver(session, frame)
                 except:
-                    # Удаляем клиента если не можем отправить
-                    if client in self.clients:
-                        del self.clients[client]
+                    # Клиент уже отключается: его обработчик сам
+                    # удалит запись и оповестит остальных
+                    self.metrics.send_failures.inc()
+        self.metrics.fanout_seconds.observe(time.perf_counter() - started)
     
     def send_private_message(self, message, target_username, sender_socket):
-        """Отправка приватного сообщения"""
-        message_json = json.dumps(message)
+        """Отправка приватного сообщения; возвращает кадр, если оно доставлено"""
+        started = time.perf_counter()
+        frame = encode_message(message)
         sent = False
         
-        for client, info in self.clients.items():
-            if info['username'] == target_username:
-                try:
-                    client.send(message_json.encode('utf-8'))
-                    # Отправляем копию отправителю
-                    sender_socket.send(message_json.encode('utf-8'))
-                    sent = True
-                    break
-                except:
-                    pass
+        target = self.sessions.find(target_username)
+        if target is not None:
+            try:
+                self.deliver(target, frame)
+                # Отправляем копию отправителю
+                self.send_to(sender_socket, frame)
+                sent = True
+            except:
+                self.metrics.send_failures.inc()
+        elif target_username in self.relay_users:
+            # Получатель еще (или уже) в другом процессе
+            self.relay({'handoff': 'private', 'target': target_username, 'message': message})
+            self.send_to(sender_socket, frame)
+            sent = True
         
+        self.metrics.private_seconds.observe(time.perf_counter() - started)
         if not sent:
             error_msg = {
                 'type': 'system',
                 'message': f'Пользователь {target_username} не найден',
                 'timestamp': datetime.now().strftime('%H:%M:%S')
             }
-            sender_socket.send(json.dumps(error_msg).encode('utf-8'))
+            self.send_to(sender_socket, encode_message(error_msg))
+            return None
+        return frame
     
-    def send_user_list(self):
-        """Отправка списка активных пользователей всем клиентам"""
-        users = [info['username'] for info in self.clients.values()]
-        message = {
+    def broadcast_notice(self, message, exclude_client=None):
+        """Рассылка user_joined/user_left: клиенты с дельтами узнают это из presence"""
+        frame = encode_message(message)
+        self.legacy_frame(frame, exclude_client)
+        self.relay({'handoff': 'notice', 'message': message})
+        return frame
+    
+    def legacy_frame(self, frame, exclude_client=None):
+        """Рассылка кадра клиентам без поддержки дельт присутствия"""
+        for session in self.sessions.snapshot():
+            if session.client is not exclude_client and not session.presence:
+                try:
+                    self.deliver(session, frame)
+                except:
+                    pass
+    
+    def call_later(self, delay, callback):
+        """Отложенный вызов в фоновом потоке"""
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+    
+    def presence_changed(self, username):
+        """Отметка входа или выхода; рассылка - одна на пачку изменений"""
+        with self.presence_lock:
+            self.presence_changes.add(username)
+            if self.presence_scheduled:
+                return
+            self.presence_scheduled = True
+        if self.presence_delay:
+            self.call_later(self.presence_delay, self.flush_presence)
+        else:
+            self.flush_presence()
+    
+    def flush_presence(self):
+        """Рассылка накопленных изменений присутствия"""
+        self.relay_presence()
+        with self.presence_flush_lock:
+            with self.presence_lock:
+                changed = self.presence_changes
+                self.presence_changes = set()
+                self.presence_scheduled = False
+            if not changed:
+                return
+            # Итог по каждому имени: вход и быстрый выход взаимно гасятся
+            online = set(self.usernames())
+            self.presence_seq += 1
+            self.send_presence({
+                'type': 'presence',
+                'seq': self.presence_seq,
+                'added': sorted(name for name in changed if name in online),
+                'removed': sorted(name for name in changed if name not in online),
+                'timestamp': datetime.now().strftime('%H:%M:%S')
+            })
+    
+    def send_presence(self, delta):
+        """Дельта - клиентам, которые ее понимают, полный список - остальным"""
+        frame = encode_message(delta)
+        full = None
+        for session in self.sessions.snapshot():
+            if session.presence:
+                data = frame
+            else:
+                if full is None:
+                    full = encode_message(self.user_list_message())
+                data = full
+            try:
+                self.deliver(session, data)
+            except:
+                pass
+    
+    def usernames(self):
+        """Имена всех пользователей в чате, включая еще не перешедших из другого процесса"""
+        users = self.sessions.usernames()
+        if self.relay_users:
+            users.extend(self.relay_users.difference(users))
+        return users
+    
+    def user_list_message(self):
+        """Сообщение со списком активных пользователей"""
+        return {
             'type': 'user_list',
-            'users': users,
+            'seq': self.presence_seq,
+            'users': self.usernames(),
             'timestamp': datetime.now().strftime('%H:%M:%S')
         }
-        self.broadcast(message)
     
     def show_users(self):
         """Показать список подключенных пользователей"""
-        if self.clients:
+        sessions = self.sessions.snapshot()
+        if sessions:
             print("\n[АКТИВНЫЕ ПОЛЬЗОВАТЕЛИ]")
-            for client, info in self.clients.items():
-                print(f"  - {info['username']} ({info['address'][0]}:{info['address'][1]})")
+            for session in sessions:
+                outbox = session.outbox
+                print(f"  - {session.username} ({session.address[0]}:{session.address[1]}) "
+                      f"очередь: {outbox.depth()}, потеряно: {outbox.dropped}")
         else:
             print("[АКТИВНЫЕ ПОЛЬЗОВАТЕЛИ] Нет подключенных пользователей")
     
+    def show_stats(self):
+        """Показать метрики сервера"""
+        print("\n[СТАТИСТИКА]")
+        print(self.metrics.registry.summary())
+    
     def shutdown(self):
         """Завершение работы сервера"""
         print("\n[СЕРВЕР] Завершение работы...")
+        # Прощание - только своим клиентам
+        self.close_handoff_link()
+        # Сервер останавливается: сессии не придерживаем
+        with self.resume_lock:
+            self.resumable.clear()
         
         # Уведомляем всех о закрытии сервера
         self.broadcast({
@@ -221,21 +1271,389 @@ class ChatServer:
             'timestamp': datetime.now().strftime('%H:%M:%S')
         })
         
-        # Закрываем все соединения
-        for client in list(self.clients.keys()):
-            client.close()
+        # Дописываем очереди (все одновременно) и закрываем все соединения
+        sessions = self.sessions.snapshot()
+        close_all([session.outbox for session in sessions])
+        for session in sessions:
+            session.client.close()
         
         self.server.close()
+        if self.handoff is not None:
+            self.handoff.close()
+        self.close_history()
+        if self.search is not None:
+            self.search.close()
+        if self.capture is not None:
+            self.capture.close()
+        if self.metrics_http is not None:
+            self.metrics_http.shutdown()
+            self.metrics_http.server_close()
+        # Последние события - до итоговой строки, а не после нее
+        log.flush()
         print("[СЕРВЕР] Остановлен")
 
+
+class AsyncChatServer(ChatServer):
+    """Сервер на asyncio: все подключения обслуживает один цикл событий"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.aio_server = None
+        self.stop_event = None
+        self.congested = set()  # переполненные очереди при политике block
+    
+    def start(self, console=True):
+        """Запуск сервера"""
+        try:
+            asyncio.run(self.serve(console))
+        except KeyboardInterrupt:
+            pass
+    
+    async def serve(self, console=True):
+        """Основная корутина сервера"""
+        # Цикл нужен уже при открытии: сообщения процесса, передавшего сокет
+        self.loop = asyncio.get_running_loop()
+        self.open_listener()
+        print(f"[СЕРВЕР] Запущен на {self.host}:{self.port} (asyncio)")
+        print(f"[СЕРВЕР] IP адрес сервера: {self.get_local_ip()}")
+        self.start_metrics()
+        
+        self.start_reaper()
+        self.stop_event = asyncio.Event()
+        self.aio_server = await asyncio.start_server(self.handle_client_async,
+                                                     sock=self.server)
+        
+        if console:
+            # input() блокирует, поэтому читаем консоль в отдельном потоке
+            console_thread = threading.Thread(target=self.run_console_thread)
+            console_thread.daemon = True
+            console_thread.start()
+        
+        try:
+            await self.stop_event.wait()
+        finally:
+            self.shutdown()
+    
+    def stop(self):
+        """Остановка цикла событий из любого потока"""
+        self.loop.call_soon_threadsafe(self.stop_event.set)
+    
+    def handle_command(self, command):
+        """Выполнение консольной команды в потоке цикла событий"""
+        self.loop.call_soon_threadsafe(super().handle_command, command)
+    
+    def send_from_thread(self, client, data):
+        """Очереди asyncio меняются только в цикле событий"""
+        self.loop.call_soon_threadsafe(super().send_from_thread, client, data)
+    
+    async def handle_client_async(self, reader, writer):
+        """Обработка сообщений от клиента"""
+        address = writer.get_extra_info('peername')
+        log.info('ПОДКЛЮЧЕНИЕ', 'Новое подключение от %s', address)
+        set_nodelay(writer.get_extra_info('socket'))
+        if self.idle_timeout:
+            set_keepalive(writer.get_extra_info('socket'), self.idle_timeout)
+        self.metrics.connections.inc()
+        if self.capture is not None:
+            self.capture.connect(writer)
+        decoder = FrameDecoder()
+        username = None
+        join_timer = self.watch_join(writer)
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                self.metrics.bytes_in.inc(len(data))
+                self.touch(writer)
+                
+                for payload in decoder.feed(data):
+                    message = decode_message(payload)
+                    if username is None and message['type'] in TRANSFER_TYPES:
+                        if join_timer is not None:
+                            join_timer.cancel()
+                        await self.serve_transfer_async(reader, writer, address, message,
+                                                        decoder.rest())
+                        return
+                    username = self.dispatch(writer, address, username, message, len(payload))
+                
+                # Обратное давление: не читаем дальше, пока получатели
+                # этого отправителя не разгребут свои очереди
+                if self.congested:
+                    congested = list(self.congested)
+                    self.congested.clear()
+                    for outbox in congested:
+                        await outbox.wait_for_space()
+        
+        except asyncio.CancelledError:
+            # Остановка цикла событий при завершении сервера
+            pass
+        
+        except Exception as e:
+            log.error('ОШИБКА', '%s', e)
+        
+        finally:
+            if join_timer is not None:
+                join_timer.cancel()
+            self.connection_lost(writer)
+            writer.close()
+    
+    def call_later(self, delay, callback):
+        """Отложенный вызов в цикле событий"""
+        self.loop.call_later(delay, callback)
+    
+    def start_reaper(self):
+        """Колесо проверок простоя продвигается в цикле событий"""
+        if self.idle_timeout or self.resume_timeout:
+            self.loop.call_later(self.reaper.tick, self.tick_reaper)
+    
+    def tick_reaper(self):
+        """Шаг колеса проверок простоя"""
+        try:
+            self.reaper.advance()
+        except Exception as e:
+            log.error('ОШИБКА', '%s', e)
+        self.loop.call_later(self.reaper.tick, self.tick_reaper)
+    
+    def drop_connection(self, writer):
+        """Разрыв соединения без дописывания буфера: клиент все равно не читает"""
+        writer.transport.abort()
+    
+    def end_connection(self, writer):
+        """Закрытие соединения после того, как буфер транспорта уйдет клиенту"""
+        writer.close()
+    
+    def hand_off(self, link):
+        """Журнал закрывается сразу, клиенты уходят уже из цикла событий"""
+        self.attach_handoff(link)
+        self.close_history()
+        self.loop.call_soon_threadsafe(self.begin_drain)
+    
+    def from_handoff(self, callback, *args):
+        """Сообщения другого процесса обрабатываются в цикле событий"""
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # Цикл уже остановлен: процесс завершается
+            pass
+    
+    def begin_drain(self):
+        """Прекращение приема в цикле событий и волны переподключений"""
+        self.aio_server.close()
+        super().begin_drain()
+    
+    async def serve_transfer_async(self, reader, writer, address, request, initial):
+        """Соединение данных в цикле событий: загрузка или скачивание файла"""
+        self.count_transfer(address, *await self.files.serve_async(
+            reader, writer, request, initial, self.idle_timeout or None))
+    
+    def create_outbox(self, client, replay=0):
+        """Исходящая очередь с задачей-писателем в цикле событий"""
+        return AsyncOutbox(client, self.queue_size, self.queue_policy, self.block_timeout,
+                           self.flush_window, congested=self.congested, metrics=self.metrics,
+                           replay=replay)
+    
+    def shutdown(self):
+        """Завершение работы сервера"""
+        if self.aio_server is not None:
+            self.aio_server.close()
+        super().shutdown()
+
+
+SERVER_MODES = {
+    'threaded': ChatServer,
+    'asyncio': AsyncChatServer,
+}
+
+
+def parse_args(argv=None):
+    """Разбор аргументов командной строки"""
+    parser = argparse.ArgumentParser(description='Сервер мессенджера')
+    parser.add_argument('--host', default='0.0.0.0', help='адрес для прослушивания')
+    parser.add_argument('--port', type=int, default=5555, help='порт сервера')
+    parser.add_argument('--mode', choices=sorted(SERVER_MODES) + ['sharded'], default='threaded',
+                        help='threaded - поток на клиента, asyncio - один цикл событий, '
+                             'sharded - несколько процессов asyncio на общем порту')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='число процессов в режиме sharded')
+    parser.add_argument('--backlog', type=int, default=128, help='очередь входящих подключений')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help='максимум кадров в исходящей очереди клиента')
+    parser.add_argument('--queue-policy', choices=POLICIES, default=DISCONNECT,
+                        help='при переполнении: drop_oldest - выбросить старый кадр, '
+                             'disconnect - отключить клиента, block - притормозить отправителя')
+    parser.add_argument('--block-timeout', type=float, default=5.0,
+                        help='сколько ждать места в очереди при политике block, сек')
+    parser.add_argument('--flush-window', type=float, default=0.0,
+                        help='окно склейки исходящих сообщений в одну запись, сек')
+    parser.add_argument('--history-dir', help='каталог журнала сообщений (по умолчанию не ведется)')
+    parser.add_argument('--history-size', type=int, default=50,
+                        help='сколько последних сообщений показывать при входе')
+    parser.add_argument('--segment-bytes', type=int, default=16 * 1024 * 1024,
+                        help='размер сегмента журнала, байт')
+    parser.add_argument('--retention-bytes', type=int, default=256 * 1024 * 1024,
+                        help='максимальный объем журнала на диске, байт')
+    parser.add_argument('--fsync-interval', type=float, default=1.0,
+                        help='период сброса журнала на диск, сек')
+    parser.add_argument('--presence-delay', type=float, default=0.05,
+                        help='сколько копить входы и выходы перед рассылкой дельты, сек')
+    parser.add_argument('--ping-interval', type=float, default=20.0,
+                        help='через сколько секунд молчания клиента отправлять ping')
+    parser.add_argument('--idle-timeout', type=float, default=60.0,
+                        help='отключать клиента после стольких секунд молчания (0 - не отключать)')
+    parser.add_argument('--rate-limits', choices=['on', 'off'], default='on',
+                        help='off - выключить все лимиты частоты (для бенчмарков)')
+    parser.add_argument('--user-rate', type=float, default=20.0,
+                        help='сообщений в секунду от одного пользователя (0 - без лимита)')
+    parser.add_argument('--user-bytes', type=int, default=64 * 1024,
+                        help='байт в секунду от одного пользователя (0 - без лимита)')
+    parser.add_argument('--ip-rate', type=float, default=100.0,
+                        help='сообщений в секунду с одного IP адреса (0 - без лимита)')
+    parser.add_argument('--ip-bytes', type=int, default=256 * 1024,
+                        help='байт в секунду с одного IP адреса (0 - без лимита)')
+    parser.add_argument('--fanout-rate', type=int, default=200000,
+                        help='доставок в секунду на весь процесс: сообщение в общий чат '
+                             'стоит столько, сколько в нем пользователей (0 - без лимита)')
+    parser.add_argument('--limit-burst', type=float, default=2.0,
+                        help='запас лимитов: сколько секунд их скорости можно израсходовать разом')
+    parser.add_argument('--files-dir',
+                        help='каталог файлов, ожидающих получателя (по умолчанию во временном)')
+    parser.add_argument('--max-file-size', type=int, default=100 * 1024 * 1024,
+                        help='максимальный размер передаваемого файла, байт')
+    parser.add_argument('--files-ttl', type=float, default=24 * 3600,
+                        help='сколько хранить файл, который не забрали, сек')
+    parser.add_argument('--resume-timeout', type=float, default=30.0,
+                        help='сколько ждать возвращения клиента после обрыва, сек (0 - не ждать)')
+    parser.add_argument('--replay-size', type=int, default=256,
+                        help='сколько последних отправленных сообщений помнить для досылки '
+                             'после обрыва')
+    parser.add_argument('--handoff-socket', metavar='PATH',
+                        help='Unix сокет для перезапуска без простоя: новый процесс с тем же '
+                             'путем забирает слушающий сокет у работающего')
+    parser.add_argument('--drain-rate', type=int, default=200,
+                        help='сколько клиентов в секунду отправлять к новому процессу '
+                             'при перезапуске')
+    parser.add_argument('--search-memory', type=int, default=64 * 1024 * 1024,
+                        help='объем поискового индекса в памяти, байт (0 - поиск выключен)')
+    parser.add_argument('--capture', metavar='PATH',
+                        help='записывать входящий трафик без содержимого для messenger_replay.py '
+                             '(в режиме sharded у каждого процесса свой файл)')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='записать профиль cProfile всех потоков сервера при остановке')
+    parser.add_argument('--trace-memory', metavar='PATH',
+                        help='записать снимок tracemalloc при остановке')
+    parser.add_argument('--node-id', help='имя узла федерации (по умолчанию имя_хоста:порт)')
+    parser.add_argument('--link-port', type=int,
+                        help='порт для подключения соседних узлов федерации (режим asyncio)')
+    parser.add_argument('--peers', nargs='+', default=[], metavar='HOST:PORT',
+                        help='соседние узлы федерации: их --link-port (режим asyncio)')
+    parser.add_argument('--link-host', default='127.0.0.1',
+                        help='адрес приема соседних узлов; не локальный - только с --link-secret')
+    parser.add_argument('--link-secret', default=os.environ.get('MESSENGER_LINK_SECRET'),
+                        help='общий секрет узлов федерации (по умолчанию из '
+                             'MESSENGER_LINK_SECRET)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='порт HTTP выдачи метрик Prometheus на 127.0.0.1 '
+                             '(в режиме sharded - базовый, плюс номер процесса)')
+    parser.add_argument('--log-level', choices=sorted(LEVELS, key=LEVELS.get), default='info',
+                        help='минимальный уровень событий в журнале')
+    parser.add_argument('--log-file', help='файл журнала (по умолчанию - консоль); в режиме '
+                                           'sharded у каждого процесса свой файл')
+    parser.add_argument('--log-max-bytes', type=int, default=10 * 1024 * 1024,
+                        help='размер файла журнала, после которого начинается новый, байт')
+    parser.add_argument('--log-backups', type=int, default=5,
+                        help='сколько прежних файлов журнала хранить')
+    parser.add_argument('--log-sync', action='store_true',
+                        help='писать журнал сразу в потоке обработчика: ничего не теряется, '
+                             'но медленный вывод тормозит сервер')
+    parser.add_argument('--no-console', action='store_true',
+                        help='не читать команды с консоли (для бенчмарков и служб)')
+    args = parser.parse_args(argv)
+    if (args.link_port or args.peers) and args.mode != 'asyncio':
+        parser.error('федерация узлов работает только в режиме asyncio')
+    if args.link_host not in ('127.0.0.1', '::1', 'localhost') and not args.link_secret:
+        parser.error('прием соседей не с локального адреса требует --link-secret')
+    if (args.profile or args.trace_memory) and args.mode == 'sharded':
+        parser.error('--profile и --trace-memory не работают в режиме sharded')
+    if args.handoff_socket:
+        if not hasattr(socket, 'send_fds'):
+            parser.error('передача сокета между процессами не поддерживается этой системой')
+        if args.mode == 'sharded' or args.link_port:
+            parser.error('--handoff-socket не работает в режиме sharded и с --link-port')
+    return args
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    log.configure(args.log_level, args.log_file, args.log_max_bytes, args.log_backups,
+                  args.log_sync)
+    
     print("=" * 50)
     print("СЕРВЕР МЕССЕНДЖЕРА")
     print("=" * 50)
     print("\nКоманды:")
     print("  users - показать список подключенных пользователей")
+    print("  stats - показать метрики сервера")
     print("  exit  - остановить сервер")
     print("\n" + "=" * 50)
     
-    server = ChatServer()
-    server.start()
\ No newline at end of file
+    server_kwargs = {
+        'queue_size': args.queue_size,
+        'queue_policy': args.queue_policy,
+        'block_timeout': args.block_timeout,
+        'flush_window': args.flush_window,
+        'history_dir': args.history_dir,
+        'history_size': args.history_size,
+        'segment_bytes': args.segment_bytes,
+        'retention_bytes': args.retention_bytes,
+        'fsync_interval': args.fsync_interval,
+        'metrics_port': args.metrics_port,
+        'presence_delay': args.presence_delay,
+        'ping_interval': args.ping_interval,
+        'idle_timeout': args.idle_timeout,
+        'user_rate': args.user_rate,
+        'user_bytes': args.user_bytes,
+        'ip_rate': args.ip_rate,
+        'ip_bytes': args.ip_bytes,
+        'fanout_rate': args.fanout_rate,
+        'limit_burst': args.limit_burst,
+        'files_dir': args.files_dir,
+        'max_file_size': args.max_file_size,
+        'files_ttl': args.files_ttl,
+        'resume_timeout': args.resume_timeout,
+        'replay_size': args.replay_size,
+        'handoff_path': args.handoff_socket,
+        'drain_rate': args.drain_rate,
+        'search_memory': args.search_memory,
+        'capture_path': args.capture,
+    }
+    if args.rate_limits == 'off':
+        for key in ('user_rate', 'user_bytes', 'ip_rate', 'ip_bytes', 'fanout_rate'):
+            server_kwargs[key] = 0
+    if args.mode == 'sharded':
+        from messenger_cluster import run_cluster
+        run_cluster(args.workers, args.host, args.port, args.backlog,
+                    console=not args.no_console, **server_kwargs)
+    else:
+        profiler = None
+        if args.capture or args.profile or args.trace_memory:
+            # SIGTERM - как Ctrl-C: запись трафика и профиль дописываются при остановке
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+        if args.profile or args.trace_memory:
+            profiler = ServerProfiler(args.profile, args.trace_memory)
+            profiler.start()
+        try:
+            if args.link_port or args.peers:
+                from messenger_federation import FederatedChatServer
+                server = FederatedChatServer(args.host, args.port, args.backlog,
+                                             node_id=args.node_id, link_port=args.link_port,
+                                             peers=args.peers, link_host=args.link_host,
+                                             link_secret=args.link_secret, **server_kwargs)
+            else:
+                server = SERVER_MODES[args.mode](args.host, args.port, args.backlog,
+                                                 **server_kwargs)
+            server.start(console=not args.no_console)
+        finally:
+            if profiler is not None:
+                profiler.stop()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Реестр подключенных пользователей сервера мессенджера
+Сессии хранятся в двух индексах - по соединению и по имени, - поэтому
+приватное сообщение находит получателя без перебора всех клиентов.
+Участники комнат хранятся здесь же, под тем же замком.
+Изменения идут под замком, а рассылки перебирают неизменяемый снимок.
+"""
+
+import threading
+import time
+
+
+class Session:
+    """Подключенный пользователь: соединение, имя и состояние доставки"""
+
+    # Без __dict__: на каждое соединение - одна компактная запись
+    __slots__ = ('client', 'username', 'address', 'outbox', 'rooms', 'wire', 'presence',
+                 'heartbeat', 'last_seen', 'throttled_until', 'token', 'idle_timer')
+
+    def __init__(self, client, username, address, outbox=None, presence=False, heartbeat=False,
+                 token=None):
+        self.client = client        # socket или asyncio StreamWriter
+        self.username = username
+        self.address = address
+        self.outbox = outbox
+        self.rooms = set()
+        self.wire = None            # None - JSON без сжатия, как у старых клиентов
+        self.presence = presence    # понимает ли клиент дельты присутствия
+        self.heartbeat = heartbeat  # отвечает ли клиент на ping
+        self.last_seen = time.monotonic()  # когда от клиента последний раз что-то пришло
+        self.throttled_until = 0.0  # до какого момента отправитель уже знает об ограничении
+        self.token = token          # токен продолжения сессии после обрыва; None - без него
+        self.idle_timer = None      # следующая проверка простоя в колесе таймеров
+
+
+class SessionRegistry:
+    """Потокобезопасный реестр сессий с индексом по имени пользователя"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_client = {}   # {client: Session}
+        self.by_name = {}     # {username: Session}
+        self.rooms = {}       # {room: set(Session)} - участники каждой комнаты
+        # Снимок для перебора; пересобирается при первом чтении после изменения
+        self.cached = ()
+        self.stale = False
+
+    def add(self, session, on_added=None):
+        """Добавление сессии; False, если имя уже занято
+
+        on_added вызывается под замком до вставки: другие потоки найдут
+        сессию только после него (так подтверждение входа уходит первым).
+        """
+        with self.lock:
+            if session.username in self.by_name or session.client in self.by_client:
+                return False
+            if on_added is not None:
+                on_added()
+            self.by_client[session.client] = session
+            self.by_name[session.username] = session
+            self.stale = True
+            return True
+
+    def remove(self, client):
+        """Удаление сессии соединения; возвращает ее или None, если ее уже нет"""
+        with self.lock:
+            session = self.by_client.pop(client, None)
+            if session is None:
+                return None
+            if self.by_name.get(session.username) is session:
+                del self.by_name[session.username]
+            self.stale = True
+            return session
+
+    def move(self, session, client):
+        """Перенос сессии на новое соединение (клиент вернулся после обрыва)"""
+        with self.lock:
+            if self.by_client.get(session.client) is session:
+                del self.by_client[session.client]
+            session.client = client
+            self.by_client[client] = session
+            self.stale = True
+
+    def join_room(self, session, room):
+        """Вход в комнату; False, если сессия уже в ней или уже удалена"""
+        with self.lock:
+            if self.by_client.get(session.client) is not session:
+                return False
+            members = self.rooms.setdefault(room, set())
+            if session in members:
+                return False
+            members.add(session)
+            session.rooms.add(room)
+            return True
+
+    def leave_room(self, session, room):
+        """Выход из комнаты; пустая комната закрывается. False - сессии в ней не было"""
+        with self.lock:
+            return self.discard_member(session, room)
+
+    def leave_rooms(self, session):
+        """Выход из всех комнат (отключение); возвращает их список"""
+        with self.lock:
+            rooms = list(session.rooms)
+            for room in rooms:
+                self.discard_member(session, room)
+            return rooms
+
+    def discard_member(self, session, room):
+        """Удаление участника из комнаты; вызывается под self.lock"""
+        members = self.rooms.get(room)
+        if not members or session not in members:
+            return False
+        members.discard(session)
+        if not members:
+            del self.rooms[room]
+        session.rooms.discard(room)
+        return True
+
+    def room_members(self, room):
+        """Кортеж участников комнаты"""
+        with self.lock:
+            return tuple(self.rooms.get(room, ()))
+
+    def room_size(self, room):
+        """Число участников комнаты"""
+        return len(self.rooms.get(room, ()))
+
+    def get(self, client):
+        """Сессия соединения или None"""
+        return self.by_client.get(client)
+
+    def find(self, username):
+        """Сессия пользователя по имени или None"""
+        return self.by_name.get(username)
+
+    def snapshot(self, settled=False):
+        """Кортеж всех сессий; его можно перебирать, пока реестр меняется
+
+        settled=True - дождаться добавлений, уже начатых в других потоках.
+        """
+        if self.stale or settled:
+            with self.lock:
+                if self.stale:
+                    self.cached = tuple(self.by_client.values())
+                    self.stale = False
+        return self.cached
+
+    def usernames(self):
+        """Имена всех пользователей"""
+        with self.lock:
+            return list(self.by_name)
+
+    def __len__(self):
+        return len(self.by_client)
+
+    def __contains__(self, client):
+        return client in self.by_client
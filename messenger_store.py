@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Журнал сообщений мессенджера на диске
+Сообщения дописываются в сегменты в том же виде, в каком уходят клиентам
+(кадры messenger_protocol), поэтому история отправляется без пересериализации.
+
+Каталог журнала:
+    00000000000000000000.log - кадры подряд
+    00000000000000000000.idx - индекс в mmap: смещение и вид каждой записи
+Имя сегмента - порядковый номер его первой записи.
+"""
+
+import mmap
+import os
+import struct
+import threading
+
+from messenger_protocol import HEADER, decode_message
+
+# Запись индекса: смещение в сегменте + 1 (ноль - пустая запись) и вид записи
+INDEX_ENTRY = struct.Struct('!IB')
+KIND_PUBLIC = 0
+KIND_PRIVATE = 1
+# Сколько записей на каждую нужную просматривает tail: чужие приватные пропускаются
+TAIL_SCAN = 4
+
+
+class Segment:
+    """Один файл журнала и его индекс"""
+
+    def __init__(self, directory, base, capacity):
+        self.base = base
+        self.capacity = capacity
+        name = os.path.join(directory, f'{base:020d}')
+        self.data_path = name + '.log'
+        self.index_path = name + '.idx'
+        self.file = open(self.data_path, 'ab+')
+        self.size = self.file.seek(0, os.SEEK_END)
+
+        index_size = capacity * INDEX_ENTRY.size
+        with open(self.index_path, 'ab+') as f:
+            if f.seek(0, os.SEEK_END) < index_size:
+                f.truncate(index_size)
+        self.index_file = open(self.index_path, 'r+b')
+        self.index = mmap.mmap(self.index_file.fileno(), index_size)
+        self.count = self.count_entries()
+
+    def count_entries(self):
+        """Число записей: индекс заполняется подряд, ищем первую пустую"""
+        low, high = 0, self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            if INDEX_ENTRY.unpack_from(self.index, middle * INDEX_ENTRY.size)[0]:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def rebuild_index(self):
+        """Восстановление индекса по данным после аварийной остановки"""
+        self.index[:] = bytes(len(self.index))
+        position = 0
+        count = 0
+        while position + HEADER.size <= self.size and count < self.capacity:
+            _, length = HEADER.unpack(os.pread(self.file.fileno(), HEADER.size, position))
+            end = position + HEADER.size + length
+            if end > self.size:
+                break
+            payload = os.pread(self.file.fileno(), length, position + HEADER.size)
+            kind = KIND_PRIVATE if decode_message(payload).get('type') == 'private' else KIND_PUBLIC
+            INDEX_ENTRY.pack_into(self.index, count * INDEX_ENTRY.size, position + 1, kind)
+            position = end
+            count += 1
+        # Обрезаем недописанный хвост
+        if position < self.size:
+            self.file.truncate(position)
+            self.size = position
+        self.count = count
+
+    def has_room(self, length):
+        """Поместится ли еще одна запись"""
+        return self.count < self.capacity and self.size + length <= 0xFFFFFFFE
+
+    def append(self, frame, kind):
+        """Дописывание кадра в конец сегмента"""
+        INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, self.size + 1, kind)
+        self.file.write(frame)
+        self.size += len(frame)
+        self.count += 1
+
+    def entry(self, i):
+        """Смещение и вид записи i"""
+        position, kind = INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+        return position - 1, kind
+
+    def bounds(self, i):
+        """Начало и конец записи i в файле сегмента"""
+        start, _ = self.entry(i)
+        end = self.entry(i + 1)[0] if i + 1 < self.count else self.size
+        return start, end
+
+    def flush(self, sync=False):
+        """Сброс буфера в файл; sync - до диска"""
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def close(self, sync=True):
+        """Закрытие файлов сегмента; sync - с сохранением на диск"""
+        self.flush(sync)
+        if sync:
+            self.index.flush()
+        self.index.close()
+        self.index_file.close()
+        self.file.close()
+
+    def remove(self):
+        """Удаление сегмента с диска"""
+        self.close(sync=False)
+        os.remove(self.data_path)
+        os.remove(self.index_path)
+
+
+class MessageLog:
+    """Сегментированный журнал с пакетным fsync и ограничением объема"""
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024,
+                 retention_bytes=256 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.fsync_interval = fsync_interval
+        # Минимальный кадр - несколько десятков байт, индекса хватит с запасом
+        self.capacity = max(1024, segment_bytes // 32)
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.sealed = []        # закрытые для записи сегменты, еще не сохраненные на диск
+        self.closed = False
+        self.stopping = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory)
+                       if name.endswith('.log') and name[:-4].isdigit())
+        self.segments = [Segment(directory, base, self.capacity) for base in bases]
+        if self.segments:
+            # Последний сегмент мог быть не дописан
+            self.segments[-1].rebuild_index()
+        else:
+            self.segments.append(Segment(directory, 0, self.capacity))
+
+        self.flusher = threading.Thread(target=self.run_flusher)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def next_seq(self):
+        """Номер следующей записи"""
+        active = self.segments[-1]
+        return active.base + active.count
+
+    def append(self, frame, private=False):
+        """Добавление кадра в журнал; возвращает номер записи"""
+        kind = KIND_PRIVATE if private else KIND_PUBLIC
+        with self.lock:
+            if self.closed:
+                # Журнал передан другому процессу: запоздавшие записи не нужны
+                return None
+            active = self.segments[-1]
+            if not active.has_room(len(frame)) or (
+                    active.count and active.size + len(frame) > self.segment_bytes):
+                active = self.rotate()
+            seq = active.base + active.count
+            active.append(frame, kind)
+            self.dirty = True
+            return seq
+
+    def rotate(self):
+        """Новый сегмент и удаление старых сверх лимита объема"""
+        old = self.segments[-1]
+        # fsync старого сегмента и его индекса - в фоновом потоке, без замка
+        old.flush()
+        self.sealed.append(old)
+        segment = Segment(self.directory, old.base + old.count, self.capacity)
+        self.segments.append(segment)
+
+        total = sum(s.size for s in self.segments)
+        while len(self.segments) > 1 and total > self.retention_bytes:
+            oldest = self.segments.pop(0)
+            total -= oldest.size
+            if oldest in self.sealed:
+                self.sealed.remove(oldest)
+            oldest.remove()
+        return segment
+
+    def run_flusher(self):
+        """Фоновый fsync раз в fsync_interval вместо fsync на каждую запись
+
+        Под замком буферы только сбрасываются в файлы, а fsync идет без
+        замка, по копиям дескрипторов: append и tail его не ждут, а копия
+        остается открытой, даже если сегмент тем временем удален.
+        """
+        while not self.stopping.wait(self.fsync_interval):
+            with self.lock:
+                if self.closed or not (self.dirty or self.sealed):
+                    continue
+                files = []
+                for segment in self.sealed:
+                    # Индекс закрытого сегмента при запуске не восстанавливается
+                    files += [segment.file, segment.index_file]
+                self.sealed = []
+                if self.dirty:
+                    self.segments[-1].flush()
+                    files.append(self.segments[-1].file)
+                    self.dirty = False
+                fds = [os.dup(f.fileno()) for f in files]
+            for fd in fds:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def tail(self, count, visible=None):
+        """Последние count кадров, от старых к новым
+
+        visible(message) решает, показывать ли приватную запись;
+        без него приватные записи пропускаются. Просматривается не больше
+        count * TAIL_SCAN последних записей: если среди них много чужих
+        приватных, кадров будет меньше count.
+
+        Под замком записи только выбираются по индексу, а читаются с диска
+        уже без него, по копиям дескрипторов сегментов.
+        """
+        records = []
+        fds = []
+        with self.lock:
+            if self.closed:
+                return []
+            self.segments[-1].flush()
+            scan = count * TAIL_SCAN
+            for segment in reversed(self.segments):
+                first = max(0, segment.count - scan)
+                if first < segment.count:
+                    fd = os.dup(segment.file.fileno())
+                    fds.append(fd)
+                    for i in range(segment.count - 1, first - 1, -1):
+                        kind = segment.entry(i)[1]
+                        if kind == KIND_PUBLIC or visible is not None:
+                            records.append((fd, kind) + segment.bounds(i))
+                scan -= segment.count - first
+                if scan <= 0:
+                    break
+        frames = []
+        try:
+            for fd, kind, start, end in records:
+                if len(frames) >= count:
+                    break
+                frame = os.pread(fd, end - start, start)
+                if kind == KIND_PRIVATE and not visible(decode_message(frame[HEADER.size:])):
+                    continue
+                frames.append(frame)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        frames.reverse()
+        return frames
+
+    def close(self):
+        """Сброс на диск и закрытие журнала"""
+        self.stopping.set()
+        with self.lock:
+            self.closed = True
+            for segment in self.segments:
+                segment.close()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Иерархическое колесо таймеров для сервера мессенджера
+Тысячи отложенных проверок (например, простоя соединений) живут в нескольких
+кольцах слотов: постановка и отмена - O(1), а за один шаг колеса
+просматривается только один слот. Ни потока, ни таймера на каждое соединение.
+
+Кольцо уровня 0 покрывает slots шагов, уровня 1 - slots * slots и т.д.
+Когда нижнее кольцо проходит полный круг, слот верхнего раскладывается вниз.
+"""
+
+import threading
+import time
+
+
+class TimerEntry:
+    """Отложенный вызов в колесе"""
+
+    __slots__ = ('tick', 'callback', 'args', 'cancelled')
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Отмена: запись просто пропускается, когда до нее дойдет колесо"""
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Колесо таймеров; advance() вызывает один поток или цикл событий"""
+
+    def __init__(self, tick=0.5, slots=64, levels=4, clock=time.monotonic):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.clock = clock
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.origin = clock()
+        self.current = 0   # номер последнего обработанного шага
+        self.count = 0     # записей в колесе, включая отмененные
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, callback, *args):
+        """Вызов callback(*args) не раньше чем через delay секунд"""
+        tick = int((self.clock() + delay - self.origin) / self.tick) + 1
+        entry = TimerEntry(tick, callback, args)
+        with self.lock:
+            self.place(entry)
+            self.count += 1
+        return entry
+
+    def place(self, entry):
+        """Запись в слот уровня, который покрывает ее срок"""
+        tick = max(entry.tick, self.current + 1)
+        delta = tick - self.current
+        span = self.slots
+        for level in range(self.levels):
+            if delta < span or level == self.levels - 1:
+                # Сроки дальше последнего уровня ждут в его последнем слоте
+                tick = min(tick, self.current + span - 1)
+                slot = (tick // (span // self.slots)) % self.slots
+                self.wheels[level][slot].append(entry)
+                return
+            span *= self.slots
+
+    def advance(self, now=None):
+        """Продвижение колеса до текущего времени и вызов созревших записей"""
+        if now is None:
+            now = self.clock()
+        target = int((now - self.origin) / self.tick)
+        due = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                self.cascade()
+                slot = self.wheels[0][self.current % self.slots]
+                if slot:
+                    self.wheels[0][self.current % self.slots] = []
+                    for entry in slot:
+                        if entry.tick > self.current:
+                            # Срок был за пределами колеса - ждет следующего круга
+                            self.place(entry)
+                            continue
+                        self.count -= 1
+                        if not entry.cancelled:
+                            due.append(entry)
+        # Вызовы вне замка: обработчик может поставить следующую проверку
+        for entry in due:
+            entry.callback(*entry.args)
+        return len(due)
+
+    def cascade(self):
+        """Раскладка слотов верхних уровней, когда нижний прошел полный круг"""
+        span = 1
+        for level in range(1, self.levels):
+            span *= self.slots
+            if self.current % span:
+                return
+            index = (self.current // span) % self.slots
+            slot = self.wheels[level][index]
+            if slot:
+                self.wheels[level][index] = []
+                for entry in slot:
+                    if entry.cancelled:
+                        self.count -= 1
+                    elif entry.tick <= self.current:
+                        # Срок - этот самый шаг: слот уровня 0 разбирается следом
+                        self.wheels[0][self.current % self.slots].append(entry)
+                    else:
+                        self.place(entry)
+
+    def __len__(self):
+        return self.count
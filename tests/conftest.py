@@ -0,0 +1,6 @@
+"""Модули мессенджера лежат в корне репозитория"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
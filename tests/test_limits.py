@@ -0,0 +1,113 @@
+"""Ведра токенов: пополнение со временем, лимиты отправителя и сервера"""
+
+import pytest
+
+from messenger_limits import (LIMIT_SENDER, LIMIT_SERVER, SWEEP_INTERVAL, RateLimiter,
+                              TokenBuckets)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_refills_at_rate_up_to_burst():
+    buckets = TokenBuckets(rate=10, burst=20)
+    assert buckets.level('a', 0) == 20
+    buckets.take('a', 20, 0)
+    assert buckets.level('a', 0) == 0
+    assert buckets.wait('a', 5, 0) == pytest.approx(0.5)
+    assert buckets.level('a', 1) == pytest.approx(10)
+    # Сверх запаса ведро не наполняется
+    assert buckets.level('a', 60) == 20
+    # Другой ключ - свое ведро
+    assert buckets.level('b', 0) == 20
+
+
+def test_amount_above_burst_waits_for_full_bucket():
+    buckets = TokenBuckets(rate=10, burst=20)
+    buckets.take('a', 5, 0)
+    assert buckets.wait('a', 100, 0) == pytest.approx(0.5)
+    assert buckets.wait('a', 100, 0.5) == 0.0
+    buckets.take('a', 100, 0.5)
+    assert buckets.level('a', 0.5) == 0
+
+
+def test_sweep_drops_only_full_buckets():
+    buckets = TokenBuckets(rate=10, burst=20)
+    buckets.take('a', 20, 0)
+    buckets.take('b', 1, 0)
+    buckets.sweep(1)
+    assert len(buckets) == 1 and 'a' in buckets.buckets
+    buckets.sweep(2)
+    assert len(buckets) == 0
+
+
+def test_sender_limit_and_refill():
+    clock = FakeClock()
+    limiter = RateLimiter(user_rate=2, user_bytes=0, ip_rate=0, ip_bytes=0, burst=2.0,
+                          clock=clock)
+    # Запас - burst секунд скорости: 4 сообщения подряд
+    for _ in range(4):
+        assert limiter.admit('alice', '10.0.0.1', 10) == (0.0, None)
+    wait, who = limiter.admit('alice', '10.0.0.1', 10)
+    assert who == LIMIT_SENDER and wait == pytest.approx(0.5)
+    # Другой пользователь со своим ведром не затронут
+    assert limiter.admit('bob', '10.0.0.1', 10) == (0.0, None)
+    clock.now += 0.5
+    assert limiter.admit('alice', '10.0.0.1', 10) == (0.0, None)
+    assert limiter.admit('alice', '10.0.0.1', 10)[1] == LIMIT_SENDER
+
+
+def test_refused_message_takes_no_tokens():
+    clock = FakeClock()
+    limiter = RateLimiter(user_rate=100, user_bytes=100, ip_rate=0, ip_bytes=0, burst=1.0,
+                          clock=clock)
+    assert limiter.admit('alice', 'ip', 60) == (0.0, None)
+    # Не хватает байт: ведро сообщений тоже не должно списаться
+    assert limiter.admit('alice', 'ip', 60)[1] == LIMIT_SENDER
+    assert limiter.user_messages.level('alice', clock.now) == pytest.approx(99)
+
+
+def test_ip_limit_covers_all_users_of_address():
+    clock = FakeClock()
+    limiter = RateLimiter(user_rate=0, user_bytes=0, ip_rate=1, ip_bytes=0, burst=3.0,
+                          clock=clock)
+    for user in ('a', 'b', 'c'):
+        assert limiter.admit(user, '10.0.0.1', 1) == (0.0, None)
+    assert limiter.admit('d', '10.0.0.1', 1)[1] == LIMIT_SENDER
+    assert limiter.admit('d', '10.0.0.2', 1) == (0.0, None)
+
+
+def test_fanout_budget_is_server_limit():
+    clock = FakeClock()
+    limiter = RateLimiter(user_rate=0, user_bytes=0, ip_rate=0, ip_bytes=0, fanout_rate=100,
+                          burst=1.0, clock=clock)
+    assert limiter.admit('alice', 'ip', 10, fanout=80) == (0.0, None)
+    wait, who = limiter.admit('bob', 'ip2', 10, fanout=80)
+    assert who == LIMIT_SERVER and wait == pytest.approx(0.6)
+    clock.now += 0.6
+    assert limiter.admit('bob', 'ip2', 10, fanout=80) == (0.0, None)
+
+
+def test_idle_buckets_are_swept():
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock)
+    limiter.admit('alice', 'ip', 100)
+    assert limiter.size() == 4
+    clock.now += SWEEP_INTERVAL
+    limiter.admit('bob', 'ip2', 100)
+    # Ведра alice успели наполниться и удалены; остались только ведра bob
+    assert limiter.size() == 4
+    assert 'alice' not in limiter.user_messages.buckets
+
+
+def test_disabled_limiter_admits_everything():
+    limiter = RateLimiter(user_rate=0, user_bytes=0, ip_rate=0, ip_bytes=0, fanout_rate=0)
+    assert not limiter.enabled()
+    for _ in range(1000):
+        assert limiter.admit('alice', 'ip', 10 ** 6, fanout=10 ** 6) == (0.0, None)
+    assert limiter.size() == 0
@@ -0,0 +1,99 @@
+"""Разбор двоичной кодировки: поврежденные нагрузки дают ProtocolError"""
+
+import pytest
+
+from messenger_protocol import (KEY_TAGS, MARK_BINARY, MAX_DEPTH, TYPE_TAGS, V_CLOCK, V_DICT,
+                                V_LIST, V_NAMES, V_STR, NameTable, ProtocolError, decode_binary,
+                                encode_binary, write_varint)
+
+
+def payload(key, value_bytes, type_name='message'):
+    """Нагрузка с одним полем key, значение которого уже закодировано"""
+    out = bytearray((MARK_BINARY, TYPE_TAGS[type_name]))
+    write_varint(out, 1)
+    out.append(KEY_TAGS[key])
+    out += value_bytes
+    return bytes(out)
+
+
+def client_names(*users):
+    """Таблица имен клиента, знающая users под номерами 0, 1..."""
+    names = NameTable()
+    names.learn({'ids': list(range(len(users))), 'users': list(users)})
+    return names
+
+
+def test_round_trip():
+    server = NameTable()
+    for name in ('alice', 'bob'):
+        server.intern(name)
+        server.publish(name)
+    message = {'type': 'user_list', 'users': ['alice', 'bob'], 'timestamp': '12:30:05',
+               'nested': {'list': [1, -2, 3.5, None, True, 'текст']}}
+    data = encode_binary(message, server)
+    assert decode_binary(data, client_names('alice', 'bob')) == message
+
+
+def test_truncated_string():
+    assert decode_binary(payload('text', bytes((V_STR, 3)) + b'abc')) == \
+        {'type': 'message', 'text': 'abc'}
+    with pytest.raises(ProtocolError):
+        decode_binary(payload('text', bytes((V_STR, 100)) + b'abc'))
+
+
+def test_truncated_dict_key():
+    value = bytearray((V_DICT,))
+    write_varint(value, 1)
+    value += bytes((50,)) + b'key'
+    with pytest.raises(ProtocolError):
+        decode_binary(payload('results', bytes(value)))
+
+
+def test_truncated_clock():
+    with pytest.raises(ProtocolError):
+        decode_binary(payload('timestamp', bytes((V_CLOCK, 12, 30))))
+
+
+@pytest.mark.parametrize('raw', [b'\x00\x00\x01', b'\x00\x00\x01\x00\x00'])
+def test_odd_or_short_name_list(raw):
+    value = bytearray((V_NAMES,))
+    write_varint(value, 2)
+    value += raw
+    with pytest.raises(ProtocolError):
+        decode_binary(payload('users', bytes(value), 'user_list'), client_names('a', 'b'))
+
+
+def test_overlong_varint():
+    with pytest.raises(ProtocolError):
+        decode_binary(payload('text', bytes((V_STR,)) + b'\xff' * 11 + b'\x01'))
+
+
+@pytest.mark.parametrize('kind', [V_LIST, V_DICT])
+def test_deep_nesting(kind):
+    depth = 5000
+    if kind == V_LIST:
+        value = bytes((V_LIST, 1)) * depth + bytes((V_LIST, 0))
+    else:
+        value = bytes((V_DICT, 1, 1)) + (b'k' + bytes((V_DICT, 1, 1))) * depth + b'k' + bytes((V_LIST, 0))
+    with pytest.raises(ProtocolError):
+        decode_binary(payload('results', value))
+
+
+def test_nesting_limit_allows_shallow():
+    value = bytes((V_LIST, 1)) * (MAX_DEPTH - 1) + bytes((V_LIST, 0))
+    message = decode_binary(payload('results', value))
+    assert message['results'] is not None
+
+
+def test_trailing_bytes():
+    data = payload('text', bytes((V_STR, 2)) + b'hi')
+    with pytest.raises(ProtocolError):
+        decode_binary(data + b'\x00')
+
+
+def test_every_prefix_is_rejected():
+    data = encode_binary({'type': 'private', 'username': 'alice', 'target': 'bob',
+                          'text': 'привет', 'timestamp': '01:02:03', 'size': 1.5})
+    for end in range(1, len(data)):
+        with pytest.raises(ProtocolError):
+            decode_binary(data[:end])
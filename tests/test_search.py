@@ -0,0 +1,108 @@
+"""Поиск по сообщениям: приватные видны только отправителю и получателю"""
+
+import queue
+
+import pytest
+
+import messenger_search
+from messenger_protocol import HEADER, decode_message, encode_message
+from messenger_search import SearchIndex
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def index():
+    index = SearchIndex(clock=FakeClock())
+    yield index
+    index.close()
+    index.thread.join(timeout=5)
+
+
+def post(index, username, text):
+    index.add(encode_message({'type': 'message', 'username': username, 'text': text}))
+
+
+def whisper(index, username, target, text):
+    index.add(encode_message({'type': 'private', 'username': username, 'target': target,
+                              'text': text}), private=True)
+
+
+def search(index, query, username, **kwargs):
+    """Запрос через очередь индекса, как у сервера; тексты найденного и курсор"""
+    answers = queue.Queue()
+    assert index.submit(lambda: answers.put(index.search(query, username, **kwargs)))
+    results, cursor = answers.get(timeout=5)
+    return [decode_message(frame[HEADER.size:])['text'] for _, _, frame in results], cursor
+
+
+def fill(index):
+    post(index, 'alice', 'release plan ready')
+    whisper(index, 'alice', 'bob', 'release password 1234')
+    whisper(index, 'carol', 'dave', 'release party secret')
+    post(index, 'bob', 'release tomorrow')
+
+
+def test_private_messages_visible_only_to_participants(index):
+    fill(index)
+    assert search(index, 'release', 'eve')[0] == ['release tomorrow', 'release plan ready']
+    assert search(index, 'release', 'alice')[0] == [
+        'release tomorrow', 'release password 1234', 'release plan ready']
+    assert search(index, 'release', 'bob')[0] == [
+        'release tomorrow', 'release password 1234', 'release plan ready']
+    assert search(index, 'release', 'dave')[0] == [
+        'release tomorrow', 'release party secret', 'release plan ready']
+    assert search(index, 'password', 'eve')[0] == []
+    assert search(index, 'pass*', 'carol')[0] == []
+
+
+def test_sender_filter_keeps_visibility(index):
+    fill(index)
+    assert search(index, '', 'eve', sender='alice')[0] == ['release plan ready']
+    assert search(index, '', 'bob', sender='alice')[0] == [
+        'release password 1234', 'release plan ready']
+    assert search(index, '', 'eve', sender='carol')[0] == []
+
+
+def test_hidden_messages_do_not_fill_pages(index):
+    post(index, 'alice', 'news one')
+    for i in range(5):
+        whisper(index, 'carol', 'dave', f'news hidden {i}')
+    post(index, 'alice', 'news two')
+    post(index, 'alice', 'news three')
+    texts, cursor = search(index, 'news', 'eve', limit=2)
+    assert texts == ['news three', 'news two']
+    texts, cursor = search(index, 'news', 'eve', limit=2, before=cursor)
+    assert texts == ['news one'] and cursor is None
+
+
+def test_visibility_survives_freeze_and_merge(index, monkeypatch):
+    # Мелкие сегменты: замораживание и слияния уже на десятках сообщений
+    monkeypatch.setattr(messenger_search, 'SEGMENT_DOCS', 4)
+    for i in range(40):
+        if i % 3:
+            post(index, 'alice', f'topic public {i}')
+        else:
+            whisper(index, 'alice', 'bob', f'topic private {i}')
+    texts, _ = search(index, 'topic', 'eve', limit=100)
+    assert len(texts) == 26 and all('public' in text for text in texts)
+    texts, _ = search(index, 'topic private', 'bob', limit=100)
+    assert texts == [f'topic private {i}' for i in range(39, -1, -3)]
+    assert any(segment.level > 0 for segment in index.sealed)
+
+
+def test_time_range(index):
+    index.clock.now = 1000.0
+    post(index, 'alice', 'deploy early')
+    index.clock.now = 2000.0
+    whisper(index, 'alice', 'bob', 'deploy private')
+    post(index, 'alice', 'deploy late')
+    assert search(index, 'deploy', 'eve', since=1500)[0] == ['deploy late']
+    assert search(index, 'deploy', 'bob', since=1500)[0] == ['deploy late', 'deploy private']
+    assert search(index, 'deploy', 'bob', until=1500)[0] == ['deploy early']
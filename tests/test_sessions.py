@@ -0,0 +1,61 @@
+"""Реестр сессий: участники комнат под замком реестра"""
+
+import threading
+
+from messenger_sessions import Session, SessionRegistry
+
+
+def add(registry, name):
+    session = Session(object(), name, ('127.0.0.1', 0))
+    assert registry.add(session)
+    return session
+
+
+def test_join_and_leave_room():
+    registry = SessionRegistry()
+    alice, bob = add(registry, 'alice'), add(registry, 'bob')
+    assert registry.join_room(alice, 'dev')
+    assert not registry.join_room(alice, 'dev')
+    assert registry.join_room(bob, 'dev')
+    assert set(registry.room_members('dev')) == {alice, bob}
+    assert registry.room_size('dev') == 2
+    assert registry.leave_room(alice, 'dev')
+    assert not registry.leave_room(alice, 'dev')
+    assert alice.rooms == set() and bob.rooms == {'dev'}
+    assert registry.leave_rooms(bob) == ['dev']
+    assert registry.rooms == {}
+
+
+def test_removed_session_cannot_join():
+    registry = SessionRegistry()
+    alice = add(registry, 'alice')
+    registry.remove(alice.client)
+    assert not registry.join_room(alice, 'dev')
+    assert registry.rooms == {}
+
+
+def test_rooms_follow_moved_session():
+    registry = SessionRegistry()
+    alice = add(registry, 'alice')
+    registry.join_room(alice, 'dev')
+    registry.move(alice, object())
+    assert registry.room_members('dev') == (alice,)
+
+
+def test_concurrent_join_and_leave_keep_index_consistent():
+    registry = SessionRegistry()
+    sessions = [add(registry, f'u{i}') for i in range(8)]
+
+    def churn(session):
+        for _ in range(2000):
+            registry.join_room(session, 'dev')
+            registry.leave_room(session, 'dev')
+        registry.join_room(session, 'dev')
+
+    threads = [threading.Thread(target=churn, args=(s,)) for s in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert set(registry.room_members('dev')) == set(sessions)
+    assert all(s.rooms == {'dev'} for s in sessions)
@@ -0,0 +1,139 @@
+"""Журнал сообщений: восстановление индекса, недописанный хвост, видимость в tail"""
+
+import os
+
+import pytest
+
+from messenger_protocol import HEADER, decode_message, encode_message
+from messenger_store import TAIL_SCAN, MessageLog
+
+
+def public(text):
+    return encode_message({'type': 'message', 'username': 'alice', 'text': text})
+
+
+def private(sender, target, text):
+    return encode_message({'type': 'private', 'username': sender, 'target': target, 'text': text})
+
+
+def texts(frames):
+    return [decode_message(frame[HEADER.size:])['text'] for frame in frames]
+
+
+@pytest.fixture
+def opened():
+    """Открытие журнала с закрытием в конце теста"""
+    logs = []
+
+    def open_log(directory, **kwargs):
+        log = MessageLog(str(directory), fsync_interval=60, **kwargs)
+        logs.append(log)
+        return log
+
+    yield open_log
+    for log in logs:
+        if not log.closed:
+            log.close()
+
+
+def segment_files(directory, suffix):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith(suffix))
+
+
+def test_append_numbers_records_and_tail_returns_newest(tmp_path, opened):
+    log = opened(tmp_path)
+    assert [log.append(public(str(i))) for i in range(5)] == [0, 1, 2, 3, 4]
+    assert texts(log.tail(3)) == ['2', '3', '4']
+    assert texts(log.tail(10)) == ['0', '1', '2', '3', '4']
+
+
+def test_reopen_continues_numbering(tmp_path, opened):
+    log = opened(tmp_path)
+    for i in range(3):
+        log.append(public(str(i)))
+    log.close()
+    log = opened(tmp_path)
+    assert log.next_seq() == 3
+    assert log.append(public('3')) == 3
+    assert texts(log.tail(10)) == ['0', '1', '2', '3']
+
+
+def test_index_is_rebuilt_from_data(tmp_path, opened):
+    log = opened(tmp_path)
+    log.append(public('a'))
+    log.append(private('alice', 'bob', 'secret'), private=True)
+    log.append(public('b'))
+    log.close()
+    # Индекс не успел попасть на диск
+    for path in segment_files(tmp_path, '.idx'):
+        with open(path, 'r+b') as f:
+            f.write(bytes(os.path.getsize(path)))
+    log = opened(tmp_path)
+    assert log.next_seq() == 3
+    # Вид записи восстановлен: приватная скрыта без visible
+    assert texts(log.tail(10)) == ['a', 'b']
+    assert texts(log.tail(10, lambda message: True)) == ['a', 'secret', 'b']
+
+
+@pytest.mark.parametrize('cut', [1, HEADER.size, HEADER.size + 3])
+def test_truncated_tail_is_dropped(tmp_path, opened, cut):
+    log = opened(tmp_path)
+    log.append(public('a'))
+    log.append(public('b'))
+    log.close()
+    path = segment_files(tmp_path, '.log')[-1]
+    intact = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(public('torn')[:cut])
+    log = opened(tmp_path)
+    assert os.path.getsize(path) == intact
+    assert log.next_seq() == 2
+    assert log.append(public('c')) == 2
+    assert texts(log.tail(10)) == ['a', 'b', 'c']
+
+
+def test_tail_spans_segments_and_retention_drops_oldest(tmp_path, opened):
+    frame = public('x' * 200)
+    log = opened(tmp_path, segment_bytes=len(frame) * 4, retention_bytes=len(frame) * 10)
+    for i in range(30):
+        log.append(public(f'{i:03d}' + 'x' * 197))
+    assert len(segment_files(tmp_path, '.log')) <= 4
+    assert log.segments[0].base > 0
+    tail = texts(log.tail(6))
+    assert [text[:3] for text in tail] == ['024', '025', '026', '027', '028', '029']
+
+
+def test_private_visibility_filter(tmp_path, opened):
+    log = opened(tmp_path)
+    log.append(public('hello'))
+    log.append(private('alice', 'bob', 'to bob'), private=True)
+    log.append(private('carol', 'dave', 'to dave'), private=True)
+    log.append(public('bye'))
+
+    def visible_to(username):
+        # Так же, как история при входе в messenger_server
+        return lambda message: username in (message.get('username'), message.get('target'))
+
+    assert texts(log.tail(10)) == ['hello', 'bye']
+    assert texts(log.tail(10, visible_to('bob'))) == ['hello', 'to bob', 'bye']
+    assert texts(log.tail(10, visible_to('carol'))) == ['hello', 'to dave', 'bye']
+    assert texts(log.tail(2, visible_to('alice'))) == ['to bob', 'bye']
+
+
+def test_tail_scans_limited_window(tmp_path, opened):
+    log = opened(tmp_path)
+    log.append(public('old'))
+    for i in range(TAIL_SCAN * 2):
+        log.append(private('carol', 'dave', str(i)), private=True)
+    # Чужие приватные занимают все окно просмотра (2 * TAIL_SCAN): старое не ищется
+    assert log.tail(2) == []
+    assert texts(log.tail(3)) == ['old']
+
+
+def test_closed_log_ignores_appends(tmp_path, opened):
+    log = opened(tmp_path)
+    log.append(public('a'))
+    log.close()
+    assert log.append(public('b')) is None
+    assert log.tail(10) == []
@@ -0,0 +1,98 @@
+"""Колесо таймеров: раскладка верхних уровней и сроки дальше колеса"""
+
+import pytest
+
+from messenger_timers import TimerWheel
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(wheel, clock, until):
+    """Шаги колеса по одному до момента until"""
+    while clock.now < until:
+        clock.now += wheel.tick
+        wheel.advance()
+
+
+def schedule_all(wheel, clock, delays):
+    fired = {}
+    for delay in delays:
+        wheel.schedule(delay, lambda d: fired.setdefault(d, clock.now), delay)
+    return fired
+
+
+def test_entries_fire_on_their_tick_on_every_level():
+    clock = FakeClock()
+    # Уровень 0 покрывает 4 шага, 1 - 16, 2 - 64
+    wheel = TimerWheel(tick=1.0, slots=4, levels=3, clock=clock)
+    delays = [0, 1, 3, 4, 5, 15, 16, 17, 40, 63]
+    fired = schedule_all(wheel, clock, delays)
+    assert len(wheel) == len(delays)
+    run(wheel, clock, 70)
+    # Срок округляется вверх до следующего шага, но никогда не раньше delay
+    assert fired == {delay: delay + 1 for delay in delays}
+    assert len(wheel) == 0
+
+
+@pytest.mark.parametrize('levels', [1, 2])
+def test_delay_beyond_wheel_is_placed_again(levels):
+    clock = FakeClock()
+    wheel = TimerWheel(tick=1.0, slots=4, levels=levels, clock=clock)
+    fired = schedule_all(wheel, clock, [100, 250])
+    run(wheel, clock, 300)
+    assert fired == {100: 101, 250: 251}
+
+
+def test_schedule_after_start_and_from_callback():
+    clock = FakeClock()
+    wheel = TimerWheel(tick=0.5, slots=8, levels=3, clock=clock)
+    fired = []
+
+    def again(count):
+        fired.append(clock.now)
+        if count:
+            wheel.schedule(10, again, count - 1)
+
+    clock.now = 7.25
+    wheel.advance()
+    wheel.schedule(10, again, 2)
+    run(wheel, clock, 60)
+    assert len(fired) == 3
+    previous = 7.25
+    for when in fired:
+        assert 10 <= when - previous <= 10 + wheel.tick
+        previous = when
+
+
+def test_cancelled_entries_do_not_fire_and_leave_the_wheel():
+    clock = FakeClock()
+    wheel = TimerWheel(tick=1.0, slots=4, levels=3, clock=clock)
+    fired = []
+    near = wheel.schedule(2, fired.append, 'near')
+    far = wheel.schedule(30, fired.append, 'far')
+    wheel.schedule(31, fired.append, 'kept')
+    near.cancel()
+    far.cancel()
+    run(wheel, clock, 40)
+    assert fired == ['kept']
+    assert len(wheel) == 0
+
+
+def test_advance_catches_up_after_a_pause():
+    clock = FakeClock()
+    wheel = TimerWheel(tick=1.0, slots=4, levels=3, clock=clock)
+    fired = []
+    for delay in (2, 9, 33):
+        wheel.schedule(delay, fired.append, delay)
+    clock.now = 20
+    assert wheel.advance() == 2
+    assert fired == [2, 9]
+    clock.now = 50
+    assert wheel.advance() == 1
+    assert fired == [2, 9, 33]